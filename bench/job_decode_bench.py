@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""Compare the cost of decoding job hashes in each format.
+
+Job hashes are built the way Redis returns them for completed jobs,
+saved as plain string fields, as a record the updates were folded back
+into, and as a record with the updates still over it like a running
+job. The lambda decoder below is how plain hashes were decoded before
+records, kept here only as the reference point. With hiredis
+installed, parsing the HGETALL reply of each hash is timed along with
+decoding it.
+
+Usage: ./bench/job_decode_bench.py [--rounds N] [--jobs N]
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+try:
+    import hiredis
+except ImportError:
+    hiredis = None
+
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
+
+
+import jobs
+
+
+def lambda_convert_job_hash(job_hash):
+    """Decode a plain job hash the way jobs did before records."""
+    _redis_string = lambda value: value.decode() if value != b'None' else None
+    _redis_number = lambda value: int(value) if value != b'None' else None
+    _redis_boolean = lambda value: value == b'True'
+
+    return jobs._job_dict(
+        _redis_string(job_hash[b'id']),
+        _redis_string(job_hash[b'status']),
+        _redis_number(job_hash[b'start']),
+        _redis_number(job_hash[b'end']),
+        _redis_number(job_hash[b'limit']),
+        _redis_number(job_hash[b'offset']),
+        _redis_string(job_hash[b'created_at']),
+        _redis_string(job_hash[b'last_updated']),
+        _redis_boolean(job_hash[b'has_plot']),
+        _redis_string(job_hash[b'job_type']),
+        _redis_string(job_hash.get(b'output', b'plot')),
+        _redis_number(job_hash.get(b'attempts', b'0')),
+        _redis_string(job_hash.get(b'error', b'None')),
+        _redis_string(job_hash.get(b'trace_id', b'None')),
+        _redis_string(job_hash.get(b'series', b'None'))
+    )
+
+
+class _HashPipe:
+    """Collects the fields a pipeline would set, as Redis returns them."""
+
+    def __init__(self, job_hash):
+        self.job_hash = job_hash
+
+    def hmset(self, key, mapping):
+        self.job_hash.update(_as_reply(mapping))
+
+
+def _as_reply(mapping):
+    return {
+        name.encode(): (value if isinstance(value, bytes)
+                        else str(value).encode())
+        for name, value in mapping.items()
+    }
+
+
+def build_hashes(count):
+    """Return job hashes in each format for count completed jobs."""
+    job_dicts = [
+        dict(jobs.build_job(start=1800, end=1900), status='completed',
+             has_plot=True)
+        for _ in range(count)
+    ]
+    plot_ref = '0' * 64
+    hashes = {
+        'plain': [_as_reply(dict(job_dict, plot_ref=plot_ref))
+                  for job_dict in job_dicts],
+        'record': [_as_reply(jobs.encode_job(job_dict, plot_ref=plot_ref))
+                   for job_dict in job_dicts],
+        'record_updated': []
+    }
+
+    for job_dict in job_dicts:
+        job_hash = _as_reply(jobs.encode_job(job_dict))
+        pipe = _HashPipe(job_hash)
+
+        # The updates a job gets from a worker rendering it, up to the
+        # last one which folds them into the record.
+        jobs._update_fields(pipe, job_dict['id'], status='processing',
+                            last_updated=jobs._get_iso_time())
+        jobs._update_fields(pipe, job_dict['id'], has_plot=True,
+                            plot_ref=plot_ref,
+                            last_updated=jobs._get_iso_time())
+
+        hashes['record_updated'].append(job_hash)
+
+    return hashes
+
+
+def format_reply(job_hash):
+    """Return the HGETALL reply of a job hash as Redis sends it."""
+    parts = [b'*%d\r\n' % (len(job_hash) * 2)]
+
+    for item in itertools.chain.from_iterable(job_hash.items()):
+        parts.append(b'$%d\r\n%s\r\n' % (len(item), item))
+
+    return b''.join(parts)
+
+
+def parse_reply(reply):
+    reader = hiredis.Reader()
+    reader.feed(reply)
+    items = reader.gets()
+
+    return dict(zip(items[::2], items[1::2]))
+
+
+def time_decodes(convert, job_hashes, rounds):
+    """Return the decode times per job in microseconds of each round."""
+    times = []
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+
+        for job_hash in job_hashes:
+            convert(job_hash)
+
+        times.append((time.perf_counter() - start) * 1e6 / len(job_hashes))
+
+    return times
+
+
+def summarize(times):
+    times = sorted(times)
+
+    return {
+        'mean_us': sum(times) / len(times),
+        'median_us': times[len(times) // 2],
+        'min_us': times[0],
+        'max_us': times[-1]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=20,
+                        help='times every job hash is decoded per format')
+    parser.add_argument('--jobs', type=int, default=10000,
+                        help='number of job hashes decoded a round')
+    args = parser.parse_args()
+
+    hashes = build_hashes(args.jobs)
+    results = {}
+
+    decoders = [('lambdas', 'plain', lambda_convert_job_hash)]
+    decoders.extend((name, name, jobs.convert_job_hash) for name in hashes)
+
+    for name, format_name, convert in decoders:
+        result = {
+            'size_bytes': len(format_reply(hashes[format_name][0])),
+            'decode': summarize(time_decodes(convert, hashes[format_name],
+                                             args.rounds))
+        }
+
+        if hiredis is not None:
+            replies = [format_reply(job_hash)
+                       for job_hash in hashes[format_name]]
+            result['reply_and_decode'] = summarize(time_decodes(
+                lambda reply: convert(parse_reply(reply)), replies,
+                args.rounds
+            ))
+
+        results[name] = result
+
+    baseline = results['lambdas']
+
+    for result in results.values():
+        for timing, summary in list(result.items()):
+            if timing != 'size_bytes':
+                summary['speedup'] = (baseline[timing]['mean_us'] /
+                                      summary['mean_us'])
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
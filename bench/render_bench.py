@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Compare plot render times of the pyplot path and the render module.
+
+The pyplot functions below are the plotting code the worker used
+before the render module, kept here only as the reference point.
+
+Usage: ./bench/render_bench.py [--rounds N] [--rows N]
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
+
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+import render
+
+
+def pyplot_render(data, job_type):
+    """Render a plot the way the worker did through global pyplot state."""
+    spots = [row['spots'] for row in data]
+    year = [row['year'] for row in data]
+
+    if job_type == 'line':
+        plt.plot(year, spots, color='red')
+        plt.title('Line Graph of Sunspots')
+        plt.xlabel('Year')
+        plt.ylabel('Number of Spots')
+    elif job_type == 'fun_facts':
+        unit = random.choice(render.UNITS)
+        fun_fact = ('Did you know?\n\n' + render.read_fun_data() + '\n\n'
+                    'The maximum number of spots during this time period'
+                    'was equal to  ' + str(max(spots) * unit['Units']) +
+                    ' ' + unit['Name'] + '.')
+
+        plt.plot(year, spots)
+        plt.grid(True)
+        plt.title('Fun Graph of Sunspots')
+        plt.xlabel('Year')
+        plt.ylabel('Number of Spots')
+        plt.axis([min(year), max(year), min(spots), max(spots)])
+
+        bbox_props = dict(boxstyle='round,pad=0.3', fc='cyan',
+                          ec='b', lw=2, alpha=0.5)
+        plt.text(year[0], max(spots) * 0.6, fun_fact, bbox=bbox_props,
+                 wrap=True)
+    elif job_type == 'histogram':
+        plt.hist(spots, bins=15, color='red')
+        plt.title('Histogram of Sunspots')
+        plt.xlabel('Number of Spots in a Year')
+        plt.ylabel('Frequency')
+    elif job_type == 'box_plot':
+        plt.boxplot(spots, vert=False)
+        plt.title('Box Plot of Sunspots')
+        plt.xlabel('Number of Sunspots in One Year')
+
+    file = io.BytesIO()
+    plt.savefig(file)
+
+    plt.close()
+
+    return file.getvalue()
+
+
+def time_renders(render_func, data, job_type, rounds):
+    """Return the per-plot render times in milliseconds."""
+    times = []
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+        render_func(data, job_type)
+        times.append((time.perf_counter() - start) * 1000)
+
+    return times
+
+
+def summarize(times):
+    times = sorted(times)
+
+    return {
+        'mean_ms': sum(times) / len(times),
+        'median_ms': times[len(times) // 2],
+        'min_ms': times[0],
+        'max_ms': times[-1]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=50,
+                        help='renders timed per job type and path')
+    parser.add_argument('--rows', type=int, default=100,
+                        help='number of synthetic sunspot rows plotted')
+    args = parser.parse_args()
+
+    data = [{'id': i, 'year': 1770 + i, 'spots': random.randint(0, 200)}
+            for i in range(args.rows)]
+
+    # Both paths get one untimed render first so font loading isn't
+    # counted against either of them.
+    render.warm_up()
+
+    results = {}
+
+    for job_type in render.JOB_TYPES:
+        pyplot_render(data, job_type)
+
+        pyplot = summarize(time_renders(pyplot_render, data, job_type,
+                                        args.rounds))
+        templates = summarize(time_renders(render.render_plot, data,
+                                           job_type, args.rounds))
+
+        results[job_type] = {
+            'pyplot': pyplot,
+            'render': templates,
+            'speedup': pyplot['mean_ms'] / templates['mean_ms']
+        }
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
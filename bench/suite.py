@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+"""Benchmark csv_parser, the API routes and the job pipeline.
+
+Each benchmark runs against generated sunspot datasets of the given
+sizes, at each concurrency level, with every thread making the same
+number of calls. The csv benchmarks only need the standard library.
+The API benchmarks call the Flask app in-process through its test
+client, and the pipeline benchmarks run jobs end to end: the API is
+served on a local port for the workers to fetch from and plots are
+rendered in a process pool like a concurrent worker. Both use
+fakeredis in place of Redis, so they need the bench requirements.
+
+Results are printed as JSON. With --baseline, they're compared against
+the results of an earlier run and the script exits with status 1 if
+any median time got slower by more than the tolerance.
+
+Usage: ./bench/suite.py [--groups csv,api,pipeline] [--sizes 1e3,1e4]
+                        [--concurrency 1,4] [--rounds N] [--output FILE]
+                        [--baseline FILE] [--tolerance FRACTION]
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
+
+
+# The project modules read these when they're imported. Rate limits and
+# load shedding are turned off so they don't throttle the benchmarks
+# themselves.
+os.environ.setdefault('REDIS_HOST', 'localhost')
+os.environ.setdefault('REDIS_PORT', '6379')
+os.environ.setdefault('REDIS_DB', '0')
+os.environ.setdefault('API_HOST', '127.0.0.1')
+os.environ.setdefault('API_PORT', '5000')
+os.environ['RATE_LIMITS'] = ''
+os.environ['SHED_QUEUE_DEPTH'] = '0'
+os.environ.pop('PLOT_STORE_DIR', None)
+
+
+import csv_parser
+
+
+# Seed for the generated datasets, so every run uses the same data.
+SEED = 332
+
+# Rows each pipeline job plots.
+JOB_ROWS = 1000
+
+GROUPS = ('csv', 'api', 'pipeline')
+
+
+def generate_dataset(rows, data_dir):
+    """Write a sunspot CSV with the given number of rows, if needed.
+
+    Years start at 1770 and go up by one a row like the real data.
+    Returns the path of the file.
+    """
+    path = os.path.join(data_dir, f'sunspots-{rows}-{SEED}.csv')
+
+    if not os.path.exists(path):
+        rand = random.Random(SEED)
+        tmp_path = path + '.tmp'
+
+        with open(tmp_path, 'w') as f:
+            # Writing in chunks so large datasets aren't held in memory.
+            for chunk_start in range(0, rows, 100000):
+                chunk_end = min(chunk_start + 100000, rows)
+                f.write(''.join(
+                    f'{1770 + i},{rand.randint(0, 250)}\n'
+                    for i in range(chunk_start, chunk_end)
+                ))
+
+        os.replace(tmp_path, path)
+
+    return path
+
+
+def use_dataset(path, work_dir):
+    """Point csv_parser at a fresh copy of a dataset.
+
+    Appends go to the copy so the generated file is left as it was. The
+    append log and lock of the last copy are removed with it, or their
+    rows would be read over the new dataset.
+    """
+    copy_path = os.path.join(work_dir, 'sunspots.csv')
+
+    for stale_path in (csv_parser._log_path(copy_path), copy_path + '.lock'):
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+
+    shutil.copyfile(path, copy_path)
+
+    csv_parser.CSV_FILE = copy_path
+    csv_parser._cache.clear()
+    csv_parser.preload()
+
+
+def run_concurrently(func, concurrency, rounds):
+    """Call func(i) rounds times in each of concurrency threads.
+
+    Every thread starts at once after one untimed warm up call. Returns
+    the call times in milliseconds and the total wall time in seconds.
+    """
+    func(-1)
+
+    barrier = threading.Barrier(concurrency + 1)
+    counter = itertools.count()
+    times = []
+    errors = []
+
+    def run():
+        barrier.wait()
+
+        try:
+            for _ in range(rounds):
+                i = next(counter)
+                start = time.perf_counter()
+                func(i)
+                times.append((time.perf_counter() - start) * 1000)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run) for _ in range(concurrency)]
+
+    for thread in threads:
+        thread.start()
+
+    barrier.wait()
+    start = time.perf_counter()
+
+    for thread in threads:
+        thread.join()
+
+    wall_seconds = time.perf_counter() - start
+
+    if errors:
+        raise errors[0]
+
+    return times, wall_seconds
+
+
+def summarize(times, wall_seconds):
+    times = sorted(times)
+
+    def percentile(p):
+        return times[min(len(times) - 1, int(len(times) * p))]
+
+    return {
+        'calls': len(times),
+        'calls_per_sec': len(times) / wall_seconds,
+        'mean_ms': sum(times) / len(times),
+        'p50_ms': percentile(0.5),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'max_ms': times[-1]
+    }
+
+
+def case_name(group, name, rows, concurrency):
+    return f'{group}.{name}[rows={rows},c={concurrency}]'
+
+
+def bench_csv(rows, concurrency, rounds):
+    """Time the csv_parser functions on the current dataset."""
+    mid = rows // 2
+    last_year = 1770 + rows
+
+    cases = {
+        'read_data': lambda i: csv_parser.read_data(),
+        'read_data_range': lambda i: csv_parser.read_data_range(
+            start=1770 + mid, end=1770 + mid + 100
+        ),
+        'read_data_offset': lambda i: csv_parser.read_data_offset(
+            limit=100, offset=mid
+        ),
+        # Every call appends a new year after the generated ones.
+        'append_data': lambda i: csv_parser.append_data(
+            last_year + 1 + i, 100
+        )
+    }
+
+    return {
+        case_name('csv', name, rows, concurrency):
+            summarize(*run_concurrently(func, concurrency, rounds))
+        for name, func in cases.items()
+    }
+
+
+def use_fake_redis():
+    """Make the project modules use a shared fakeredis client."""
+    import fakeredis
+
+    import redis_pool
+
+    fake_redis = fakeredis.FakeStrictRedis()
+
+    # Has to happen before the API is imported, since it makes its
+    # client proxy with this function.
+    redis_pool.get_client = lambda: fake_redis
+
+    return fake_redis
+
+
+def bench_api(fake_redis, rows, concurrency, rounds):
+    """Time every API route through the Flask test client."""
+    import api
+    import jobs
+    import plot_store
+    import registry
+
+    fake_redis.flushall()
+    api.plots = plot_store.RedisPlotStore(fake_redis)
+
+    # Jobs to read, with a plot and result each, and separate ones to
+    # cancel and replay one per call.
+    job_ids = [jobs.create_job(fake_redis)['id'] for _ in range(100)]
+
+    for job_id in job_ids:
+        jobs.update_plot(fake_redis, job_id, os.urandom(20000), api.plots)
+        jobs.update_result(fake_redis, job_id, {'counts': [1, 2, 3]})
+
+    calls = concurrency * rounds + 1
+    cancel_ids = [jobs.create_job(fake_redis)['id'] for _ in range(calls)]
+    dead_ids = [jobs.create_job(fake_redis)['id'] for _ in range(calls)]
+
+    for job_id in dead_ids:
+        jobs.fail_job(fake_redis, job_id, 1, 'RuntimeError: bench')
+
+    registry.register_worker(fake_redis, 'bench', 1)
+
+    mid = rows // 2
+    last_year = 1770 + rows
+    local = threading.local()
+
+    def client():
+        # The test client keeps cookies, so each thread gets its own.
+        if not hasattr(local, 'client'):
+            local.client = api.app.test_client()
+
+        return local.client
+
+    def job_id(i):
+        return job_ids[i % len(job_ids)]
+
+    cases = {
+        'get_spots': lambda i: client().get('/spots'),
+        'get_spots_range': lambda i: client().get(
+            f'/spots?start={1770 + mid}&end={1770 + mid + 100}'
+        ),
+        'get_spots_offset': lambda i: client().get(
+            f'/spots?limit=100&offset={mid}'
+        ),
+        'post_spots': lambda i: client().post(
+            '/spots', data=json.dumps({'year': last_year + 2 + i,
+                                       'spots': 100})
+        ),
+        'get_spots_id': lambda i: client().get(f'/spots/{mid}'),
+        'get_spots_year': lambda i: client().get(
+            f'/spots/year/{1770 + mid}'
+        ),
+        'post_jobs': lambda i: client().post(
+            '/jobs', data=json.dumps({'start': 1770, 'end': 1770 + mid})
+        ),
+        'get_jobs': lambda i: client().get('/jobs'),
+        'get_job': lambda i: client().get(f'/jobs/{job_id(i)}'),
+        'delete_job': lambda i: client().delete(
+            f'/jobs/{cancel_ids[i + 1]}'
+        ),
+        'get_job_plot': lambda i: client().get(f'/jobs/{job_id(i)}/plot'),
+        'get_job_result': lambda i: client().get(
+            f'/jobs/{job_id(i)}/result'
+        ),
+        'get_dead_jobs': lambda i: client().get('/dead-jobs'),
+        'replay_dead_job': lambda i: client().post(
+            f'/dead-jobs/{dead_ids[i + 1]}/replay'
+        ),
+        'get_workers': lambda i: client().get('/workers'),
+        'get_workers_scaling': lambda i: client().get('/workers/scaling')
+    }
+
+    results = {}
+
+    for name, request in cases.items():
+        def checked_request(i):
+            response = request(i)
+
+            if response.status_code >= 400:
+                raise RuntimeError(f'{name} returned {response.status}')
+
+        results[case_name('api', name, rows, concurrency)] = summarize(
+            *run_concurrently(checked_request, concurrency, rounds)
+        )
+
+    return results
+
+
+def bench_pipeline(fake_redis, rows, concurrency, rounds):
+    """Time jobs end to end through a worker rendering in a pool.
+
+    The worker runs concurrency render processes with a job thread for
+    each, and works through rounds jobs per thread after they're all
+    queued. Times are per job, from being claimed to being completed.
+    """
+    from werkzeug.serving import make_server
+
+    import api
+    import jobs
+    import plot_store
+    import registry
+    import render
+    import worker
+
+    fake_redis.flushall()
+    api.plots = worker.plots = plot_store.RedisPlotStore(fake_redis)
+    worker.redis_client = fake_redis
+    worker.worker_id = 'bench'
+    registry.register_worker(fake_redis, worker.worker_id, concurrency)
+
+    # Forking the pool before starting any threads, like the worker.
+    render.warm_up()
+    pool = multiprocessing.Pool(concurrency)
+
+    server = make_server('127.0.0.1', 0, api.app, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever,
+                                     daemon=True)
+    server_thread.start()
+    worker.API_BASE = f'http://127.0.0.1:{server.server_port}'
+
+    def create_plot(*args):
+        return pool.apply(worker._render_job, args)
+
+    limit = min(rows, JOB_ROWS)
+    job_ids = [
+        jobs.create_job(fake_redis, limit=limit, offset=rows - limit)['id']
+        for _ in range(concurrency * rounds + 1)
+    ]
+
+    def run_job(i):
+        job_id = jobs.get_new_job(fake_redis, timeout=1)
+        worker._run_job(job_id, create_plot)
+
+    try:
+        results = {
+            case_name('pipeline', 'line_job', rows, concurrency):
+                summarize(*run_concurrently(run_job, concurrency, rounds))
+        }
+    finally:
+        server.shutdown()
+        server.server_close()
+        pool.terminate()
+
+    failed = [job_id for job_id in job_ids
+              if jobs.get_job(fake_redis, job_id)['status'] != 'completed']
+
+    if failed:
+        raise RuntimeError(f'{len(failed)} pipeline jobs did not complete')
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Compare median times against a baseline.
+
+    Returns the comparison for every case in both, and the names of
+    those which got slower by more than the tolerance.
+    """
+    comparison = {}
+    regressions = []
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        before = baseline[name]['p50_ms']
+        after = result['p50_ms']
+        change = (after - before) / before
+
+        comparison[name] = {
+            'baseline_p50_ms': before,
+            'p50_ms': after,
+            'change': change
+        }
+
+        if change > tolerance:
+            regressions.append(name)
+
+    return comparison, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--groups', default=','.join(GROUPS),
+                        help='comma separated benchmark groups to run')
+    parser.add_argument('--sizes', default='1e3,1e4,1e5',
+                        help='comma separated dataset sizes in rows, up to '
+                             '1e7 (which needs several GB of memory)')
+    parser.add_argument('--concurrency', default='1,4,16',
+                        help='comma separated numbers of concurrent callers')
+    parser.add_argument('--rounds', type=int, default=20,
+                        help='calls timed per caller for each benchmark')
+    parser.add_argument('--data-dir',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'sunspots-bench'),
+                        help='directory the generated datasets are kept in')
+    parser.add_argument('--output', help='also write the results to a file')
+    parser.add_argument('--baseline',
+                        help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction a median time can grow by before '
+                             'it counts as a regression')
+    args = parser.parse_args()
+
+    groups = args.groups.split(',')
+    sizes = [int(float(size)) for size in args.sizes.split(',')]
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    for group in groups:
+        if group not in GROUPS:
+            parser.error(f'unknown group {group}')
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    fake_redis = None
+
+    if 'api' in groups or 'pipeline' in groups:
+        fake_redis = use_fake_redis()
+
+    results = {}
+
+    for rows in sizes:
+        dataset = generate_dataset(rows, args.data_dir)
+
+        for concurrency in levels:
+            with tempfile.TemporaryDirectory() as work_dir:
+                if 'csv' in groups:
+                    use_dataset(dataset, work_dir)
+                    results.update(bench_csv(rows, concurrency, args.rounds))
+
+                if 'api' in groups:
+                    use_dataset(dataset, work_dir)
+                    results.update(bench_api(fake_redis, rows, concurrency,
+                                             args.rounds))
+
+                if 'pipeline' in groups:
+                    use_dataset(dataset, work_dir)
+                    results.update(bench_pipeline(fake_redis, rows,
+                                                  concurrency, args.rounds))
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count(),
+            'seed': SEED,
+            'sizes': sizes,
+            'concurrency': levels,
+            'rounds': args.rounds
+        },
+        'results': results
+    }
+
+    regressions = []
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+        report['comparison'], regressions = compare(results, baseline,
+                                                    args.tolerance)
+        report['regressions'] = regressions
+
+    output = json.dumps(report, indent=2)
+    print(output)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
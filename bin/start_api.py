@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import gc
+import multiprocessing
 import os
 import sys
 
@@ -7,9 +9,64 @@ import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
 
 
-from api import app
+import csv_parser
+
+
+def run_gunicorn():
+    """Serve the app with gunicorn worker processes and threads.
+
+    The app and the dataset are loaded once in the master process
+    before forking, so the workers share them copy-on-write. Sending
+    SIGHUP to the master gracefully replaces the workers.
+    """
+    from gunicorn.app.base import BaseApplication
+
+    from api import app
+
+    class ApiServer(BaseApplication):
+
+        def load_config(self):
+            workers = os.environ.get('API_WORKERS') or \
+                multiprocessing.cpu_count() * 2 + 1
+
+            self.cfg.set('bind', '0.0.0.0:5000')
+            self.cfg.set('workers', int(workers))
+            self.cfg.set('threads', int(os.environ.get('API_THREADS', '4')))
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('keepalive',
+                         int(os.environ.get('API_KEEPALIVE', '5')))
+            self.cfg.set('preload_app', True)
+
+        def load(self):
+            return app
+
+    csv_parser.preload()
+
+    # Keeping the garbage collector from touching (and so copying) the
+    # preloaded objects in each worker, where it's supported.
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+    ApiServer().run()
+
+
+def run_aiohttp():
+    """Serve the asyncio version of the app on a single event loop."""
+    import async_api
+
+    csv_parser.preload()
+    async_api.run()
 
 
 if __name__ == '__main__':
     debug = os.environ.get('DEBUG', '0') == '1'
-    app.run(debug=debug, host='0.0.0.0')
+    server = os.environ.get('API_SERVER', 'gunicorn')
+
+    if debug or server == 'flask':
+        from api import app
+
+        app.run(debug=debug, host='0.0.0.0')
+    elif server == 'aiohttp':
+        run_aiohttp()
+    else:
+        run_gunicorn()
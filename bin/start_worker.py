@@ -1,5 +1,11 @@
 #!/usr/bin/env python3
 
+import time
+
+# Taken before any imports so the reported startup time includes them.
+BOOT_TIME = time.monotonic()
+
+import logging
 import os
 import sys
 
@@ -7,8 +13,17 @@ import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
 
 
-from worker import start_worker
+from worker import start_fork_server, start_worker
 
 
 if __name__ == '__main__':
-    start_worker()
+    logging.basicConfig(level=logging.INFO)
+
+    # Number of workers forked from a preloaded parent process, or 0 to
+    # run a single worker in this process.
+    forks = int(os.environ.get('WORKER_FORKS', '0'))
+
+    if forks > 0:
+        start_fork_server(forks, BOOT_TIME)
+    else:
+        start_worker(BOOT_TIME)
@@ -0,0 +1,327 @@
+"""Time series analysis of the sunspot data.
+
+Moving averages, smoothing and the solar cycle are worked out with
+NumPy over whole columns of years and spots at once. The columns are
+built once per version of a series, and results are memoized by the
+version and the parameters, so repeat queries over data that hasn't
+changed don't compute anything. Both are kept in one cache bounded by
+its size in memory.
+"""
+
+from collections import OrderedDict
+import os
+import threading
+
+import numpy as np
+
+import csv_parser
+
+
+# Megabytes of columns and analysis results kept in memory. The least
+# recently used are dropped past this.
+ANALYSIS_CACHE_MB = float(os.environ.get('ANALYSIS_CACHE_MB', '256'))
+
+# Default points in the moving average and in the smoothing. The
+# smoothing is the tapered 13 point mean used for the smoothed sunspot
+# number, where the points at each end count half.
+MOVING_AVERAGE_WINDOW = 11
+SMOOTHING_WINDOW = 13
+
+# Most points either window can have, well past any cycle, so a request
+# can't make the smoothing allocate and convolve an enormous window.
+MAX_WINDOW = 1000
+
+# Strongest periods of the spectrum reported for the cycle.
+SPECTRUM_PEAKS = 5
+
+# Job types computed here instead of being plotted.
+JOB_TYPES = ('moving_average', 'smoothing', 'cycles')
+
+# Rough bytes of memory each year of a result takes, counting the
+# numbers in its lists of years, spots, averages and smoothed values.
+_RESULT_YEAR_BYTES = 150
+
+# The columns of each series keyed by ('columns', series), and results
+# keyed by ('result', series, version, *params), with the most recently
+# used last.
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def analyze(series=None, start=None, end=None,
+            window=MOVING_AVERAGE_WINDOW, smoothing=SMOOTHING_WINDOW):
+    """Return the analysis of a series over the years start to end.
+
+    Years are inclusive and either end can be left open. Raises a
+    ValueError for a window or smoothing it can't use.
+    """
+    _check_windows(window, smoothing)
+
+    series = series or csv_parser.DEFAULT_SERIES
+    result = _get_result((series, csv_parser.read_data_version(series),
+                          start, end, window, smoothing))
+
+    if result is not None:
+        return result
+
+    # The data may have changed since its version was read, so the
+    # result is kept under the version of the columns it came from.
+    version, years, spots = _get_columns(series)
+    key = (series, version, start, end, window, smoothing)
+
+    mask = np.ones(len(years), dtype=bool)
+
+    if start is not None:
+        mask &= years >= start
+    if end is not None:
+        mask &= years <= end
+
+    result = analyze_columns(years[mask], spots[mask], window, smoothing)
+
+    with _lock:
+        _store(('result',) + key, result)
+
+    return result
+
+
+def compute_analysis(data, job_type):
+    """Return the part of the analysis a job type asks for over data rows.
+
+    This is what analysis jobs store as their result, using the default
+    windows.
+    """
+    if job_type not in JOB_TYPES:
+        raise ValueError(f'no analysis for job type {job_type}')
+
+    years, spots = _rows_to_columns(data)
+    result = analyze_columns(years, spots)
+
+    return {'years': result['years'], job_type: result[job_type]}
+
+
+def analyze_columns(years, spots, window=MOVING_AVERAGE_WINDOW,
+                    smoothing=SMOOTHING_WINDOW):
+    """Return the analysis of years and spots sorted by year."""
+    _check_windows(window, smoothing)
+
+    average = moving_average(spots, window)
+    smoothed = smooth(spots, smoothing)
+
+    return {
+        'count': int(len(years)),
+        'years': years.tolist(),
+        'spots': spots.tolist(),
+        'moving_average': {'window': window, 'values': _to_list(average)},
+        'smoothing': {'window': smoothing, 'values': _to_list(smoothed)},
+        'cycles': cycles(years, spots)
+    }
+
+
+def moving_average(spots, window):
+    """Return the mean of each point and the window - 1 points before it.
+
+    Points without enough before them are NaN.
+    """
+    spots = np.asarray(spots, dtype=float)
+    averages = np.full(len(spots), np.nan)
+
+    if len(spots) >= window:
+        sums = np.cumsum(np.concatenate(([0.0], spots)))
+        averages[window - 1:] = (sums[window:] - sums[:-window]) / window
+
+    return averages
+
+
+def smooth(spots, window):
+    """Return the tapered centred mean of each point over an odd window.
+
+    The points at each end of the window count half, so a 13 point
+    window is the smoothing used for the smoothed sunspot number.
+    Points within half a window of either end are NaN.
+    """
+    spots = np.asarray(spots, dtype=float)
+
+    if window == 1:
+        return spots.copy()
+
+    smoothed = np.full(len(spots), np.nan)
+
+    if len(spots) >= window:
+        weights = np.ones(window)
+        weights[[0, -1]] = 0.5
+        weights /= weights.sum()
+
+        half = window // 2
+        smoothed[half:-half] = np.convolve(spots, weights, mode='valid')
+
+    return smoothed
+
+
+def cycles(years, spots):
+    """Return the periodicity of the spots along with their peaks.
+
+    The spectrum comes from an FFT of the spots, which assumes the
+    points are evenly spaced at the most common step between years.
+    Maxima and minima are the highest and lowest points at least half
+    the strongest period apart. Returns None with fewer than 4 points.
+    """
+    years = np.asarray(years)
+    spots = np.asarray(spots, dtype=float)
+
+    if len(spots) < 4:
+        return None
+
+    steps = np.diff(years)
+    values, counts = np.unique(steps, return_counts=True)
+    step = float(values[np.argmax(counts)]) or 1.0
+
+    power = np.abs(np.fft.rfft(spots - spots.mean())) ** 2
+    frequencies = np.fft.rfftfreq(len(spots), d=step)
+
+    # The zero frequency is only the mean, which was taken out anyway.
+    power, frequencies = power[1:], frequencies[1:]
+    strongest = np.argsort(power)[::-1][:SPECTRUM_PEAKS]
+    periods = 1 / frequencies[strongest]
+
+    distance = max(int(periods[0] / step / 2), 1)
+    maxima = find_peaks(spots, distance)
+    minima = find_peaks(-spots, distance)
+
+    return {
+        'period': round(float(periods[0]), 3),
+        'spectrum': [
+            {'period': round(float(period), 3),
+             'power': round(float(power[i]), 3)}
+            for period, i in zip(periods, strongest)
+        ],
+        'maxima': [{'year': int(years[i]), 'spots': int(spots[i])}
+                   for i in maxima],
+        'minima': [{'year': int(years[i]), 'spots': int(spots[i])}
+                   for i in minima],
+        'mean_period': _mean_step(years[maxima])
+    }
+
+
+def find_peaks(values, distance):
+    """Return the indices of the peaks in values in order.
+
+    A peak is a point no lower than its neighbours, and only the
+    highest peaks at least distance points apart are kept.
+    """
+    values = np.asarray(values)
+
+    if len(values) < 3:
+        return np.array([], dtype=int)
+
+    middle = values[1:-1]
+    candidates = np.flatnonzero((middle > values[:-2]) &
+                                (middle >= values[2:])) + 1
+
+    # Keeping the highest peaks first, and dropping any lower ones
+    # within distance of them.
+    kept = np.zeros(len(values), dtype=bool)
+    taken = np.zeros(len(values), dtype=bool)
+
+    for i in candidates[np.argsort(values[candidates], kind='stable')[::-1]]:
+        if not taken[i]:
+            kept[i] = True
+            taken[max(i - distance + 1, 0):i + distance] = True
+
+    return np.flatnonzero(kept)
+
+
+def _get_result(key):
+    with _lock:
+        return _get_cached(('result',) + key)
+
+
+def _get_columns(series):
+    """Return the version of a series with its years and spots by year.
+
+    The columns are kept for the latest version of each series.
+    """
+    version = csv_parser.read_data_version(series)
+
+    with _lock:
+        columns = _get_cached(('columns', series))
+
+        if columns is not None and columns[0] == version:
+            return columns
+
+    version, rows = csv_parser.read_versioned_data(series)
+    years, spots = _rows_to_columns(rows)
+
+    with _lock:
+        _store(('columns', series), (version, years, spots))
+
+    return version, years, spots
+
+
+def _get_cached(key):
+    """Return a cached value, marking it as the latest used.
+
+    The caller holds _lock.
+    """
+    value = _cache.get(key)
+
+    if value is not None:
+        _cache.move_to_end(key)
+
+    return value
+
+
+def _store(key, value):
+    """Cache a value, dropping the least recently used past the limit.
+
+    The caller holds _lock.
+    """
+    _cache[key] = value
+    _cache.move_to_end(key)
+
+    limit = ANALYSIS_CACHE_MB * 1024 * 1024
+    total = sum(_approx_bytes(key, value) for key, value in _cache.items())
+
+    while total > limit and _cache:
+        total -= _approx_bytes(*_cache.popitem(last=False))
+
+
+def _approx_bytes(key, value):
+    """Return roughly how much memory a cached value takes."""
+    if key[0] == 'columns':
+        return value[1].nbytes + value[2].nbytes
+    else:
+        return value['count'] * _RESULT_YEAR_BYTES
+
+
+def _rows_to_columns(rows):
+    years = np.fromiter((row['year'] for row in rows), dtype=np.int64,
+                        count=len(rows))
+    spots = np.fromiter((row['spots'] for row in rows), dtype=np.int64,
+                        count=len(rows))
+
+    # Rows added later can have earlier years.
+    order = np.argsort(years, kind='stable')
+
+    return years[order], spots[order]
+
+
+def _check_windows(window, smoothing):
+    if not 1 <= window <= MAX_WINDOW:
+        raise ValueError(f'window must be from 1 to {MAX_WINDOW}')
+
+    if not 1 <= smoothing <= MAX_WINDOW or smoothing % 2 == 0:
+        raise ValueError(f'smoothing must be an odd number from 1 to '
+                         f'{MAX_WINDOW}')
+
+
+def _to_list(values):
+    """Return values rounded for JSON, with None in place of NaN."""
+    return [None if np.isnan(value) else round(value, 3)
+            for value in values.tolist()]
+
+
+def _mean_step(values):
+    if len(values) < 2:
+        return None
+    else:
+        return round(float(np.diff(values).mean()), 3)
@@ -1,22 +1,184 @@
 import os
 import io
+import logging
+import time
 
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, Response, g, jsonify, request, send_file
+from flask.json import JSONEncoder
 import redis
+from werkzeug.local import LocalProxy
 
+import analysis
 import csv_parser
+import export
 import jobs
+import plot_store
+import profiling
+import rate_limit
+import redis_pool
+import registry
+import timing
+import tracing
+import warm_cache
+
+
+# Each server process gets its own pooled client the first time this
+# is used, rather than all of them sharing one made before forking.
+redis_client = LocalProxy(redis_pool.get_client)
+plots = plot_store.from_env(redis_client)
+app = Flask(__name__)
 
+# Settings for working out how many worker replicas are needed: how
+# quickly a backlog should be cleared in seconds, the extra capacity
+# to keep as a multiple, and the bounds on the number of replicas.
+SCALING_TARGET_DRAIN = float(os.environ.get('SCALING_TARGET_DRAIN', '60'))
+SCALING_HEADROOM = float(os.environ.get('SCALING_HEADROOM', '1.2'))
+SCALING_MIN_REPLICAS = int(os.environ.get('SCALING_MIN_REPLICAS', '1'))
+SCALING_MAX_REPLICAS = int(os.environ.get('SCALING_MAX_REPLICAS', '20'))
 
-redis_client = redis.StrictRedis(host=os.environ['REDIS_HOST'],
-                                 port=os.environ['REDIS_PORT'],
-                                 db=os.environ['REDIS_DB'])
-app = Flask(__name__)
+# Stored files never change for a given ETag, so they can be cached for
+# as long as clients like.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Whether to time the phases of each request and send them back in a
+# Server-Timing header, and the milliseconds after which a timed request
+# is logged as slow (0 to not log them).
+REQUEST_TIMING = os.environ.get('REQUEST_TIMING', '0') == '1'
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', '1000'))
+
+logger = logging.getLogger(__name__)
+
+
+class _TimedJSONEncoder(JSONEncoder):
+    """Counts the time spent encoding responses against the request."""
+
+    def encode(self, o):
+        with timing.phase('json'):
+            return super().encode(o)
+
+
+if REQUEST_TIMING:
+    app.json_encoder = _TimedJSONEncoder
+
+
+@app.before_request
+def start_request_timing():
+    """Start timing the request, and profiling it if it's picked.
+
+    Requests are profiled when they have an X-Profile header with the
+    mode to use (cprofile or stack) or are part of the sample, as long
+    as PROFILE_DIR is set.
+    """
+    if REQUEST_TIMING:
+        timing.start_request()
+
+    mode = profiling.choose_mode(request.headers.get('X-Profile'))
+
+    if mode:
+        g.profiler = profiling.start(mode)
+
+
+@app.after_request
+def add_server_timing(response):
+    """Send back the time spent in each phase, logging slow requests."""
+    timer = timing.finish_request()
+
+    if timer:
+        response.headers['Server-Timing'] = timer.server_timing()
+        total_ms = timer.total_ms()
+
+        if SLOW_REQUEST_MS and total_ms >= SLOW_REQUEST_MS:
+            logger.warning('slow request %s %s took %.1fms: %s',
+                           request.method, request.full_path, total_ms,
+                           timer.describe())
+
+    return response
+
+
+@app.teardown_request
+def stop_profiling(exc):
+    """Write out the request's profile, even if it failed."""
+    profiler = g.pop('profiler', None)
+
+    if profiler:
+        path = profiling.stop(profiler,
+                              f'{request.method}-{request.endpoint}')
+        logger.info('profiled %s %s to %s', request.method,
+                    request.full_path, path)
+
+
+@app.before_request
+def start_trace():
+    """Start a span for a request that's part of a job's trace."""
+    trace_id = request.headers.get(tracing.TRACE_HEADER)
+
+    if tracing.is_trace_id(trace_id):
+        g.trace = tracing.Trace(trace_id, 'api')
+        g.trace_start = time.time()
+
+
+@app.after_request
+def save_trace(response):
+    """Save the request's span to its trace."""
+    trace = g.pop('trace', None)
+
+    if trace:
+        trace.add_span(f'{request.method} {request.path}', g.trace_start,
+                       time.time(), status=response.status_code)
+
+        try:
+            trace.save(redis_client)
+        except redis.RedisError:
+            logger.exception('could not save the span for trace %s',
+                             trace.trace_id)
+
+    return response
+
+
+@app.before_request
+def limit_rate():
+    """Turn away clients over their rate limit.
+
+    New jobs are limited separately from other requests, and are also
+    turned away while the queue is too deep for the workers to catch up.
+    """
+    is_new_job = request.endpoint == 'jobs_index' and \
+        request.method == 'POST'
+    route_class = 'jobs' if is_new_job else 'default'
+
+    try:
+        decision = rate_limit.check(redis_client, request.remote_addr,
+                                    route_class, shed=is_new_job)
+    except redis.RedisError:
+        # Requests are let through rather than failing them all while
+        # Redis can't be reached.
+        logger.exception('could not check the rate limit')
+        return None
+
+    g.rate_limit = decision
+
+    if decision and decision.shed:
+        return _make_error('too many jobs are queued, try again later.'), 503
+    elif decision and not decision.allowed:
+        return _make_error('rate limit exceeded, try again later.'), 429
+
+
+@app.after_request
+def add_rate_limit_headers(response):
+    """Tell the client about its rate limit."""
+    decision = g.get('rate_limit')
+
+    if decision:
+        for name, value in rate_limit.get_headers(decision).items():
+            response.headers[name] = value
+
+    return response
 
 
 @app.route('/spots', methods=['POST', 'GET'])
 def spots_index():
     """Handle the root spots collection."""
+    series = request.args.get('series')
 
     if request.method == 'POST':
         # Parse the data and make sure that it has a year and a
@@ -47,35 +209,62 @@ def spots_index():
 
         # Catch an error if the year isn't unique.
         try:
-            row = csv_parser.append_data(year, spots)
+            row = csv_parser.append_data(year, spots, series=series)
         except ValueError as e:
             return _make_error(e.args[0]), 400
         else:
+            _schedule_warming(series)
             return jsonify(row)
     elif request.method == 'GET':
-        # Return the sunspots data over a range or offset.
+        # Return the sunspots data over a range or offset, or for a
+        # list of years or ids.
         start = request.args.get('start')
         end = request.args.get('end')
         limit = request.args.get('limit')
         offset = request.args.get('offset')
+        years = request.args.get('years')
+        ids = request.args.get('ids')
 
         is_range_case = start is not None or end is not None
         is_offset_case = limit is not None or offset is not None
+        is_lookup_case = years is not None or ids is not None
 
-        if is_range_case and is_offset_case:
+        data_format = request.args.get('format', 'json')
+
+        if data_format not in ('json', 'csv'):
+            return _make_error(
+                'format must be json, csv, or not given (defaulting to json)'
+            ), 400
+        elif is_lookup_case and data_format == 'csv':
+            return _make_error(
+                'years and ids can only be looked up as json'
+            ), 400
+        elif is_range_case and is_offset_case:
             return _make_error(
                 'limit and/or offset cannot be combined with start and/or end'
             ), 400
+        elif is_lookup_case and (is_range_case or is_offset_case):
+            return _make_error(
+                'years and ids cannot be combined with start, end, limit or '
+                'offset'
+            ), 400
+        elif is_lookup_case:
+            return _handle_lookup_case(years, ids, series)
         elif is_range_case:
-            return _handle_range_case(start, end)
+            return _handle_range_case(start, end, series)
         elif is_offset_case:
-            return _handle_offset_case(limit, offset)
+            return _handle_offset_case(limit, offset, series)
         else:
-            data = csv_parser.read_data()
-            return jsonify(data)
+            # Sending the version of the data with it so workers can
+            # tell which version they rendered plots from.
+            version, data = csv_parser.read_versioned_data(series)
+            response = _send_rows(data)
+            response.headers[warm_cache.VERSION_HEADER] = version
 
+            return response
 
-def _handle_range_case(start, end):
+
+def _handle_range_case(start, end, series):
     # Converting the start and end to integers if they were
     # provided.
     try:
@@ -90,11 +279,12 @@ def _handle_range_case(start, end):
             'start and end, if provided, must be integers.'
         ), 400
     else:
-        data = csv_parser.read_data_range(start=start, end=end)
-        return jsonify(data)
+        data = csv_parser.read_data_range(start=start, end=end,
+                                          series=series)
+        return _send_rows(data)
 
 
-def _handle_offset_case(limit, offset):
+def _handle_offset_case(limit, offset, series):
     # Converting the limit and offset to integers if they were
     # provided and checking if they are non-negative.
     try:
@@ -115,8 +305,81 @@ def _handle_offset_case(limit, offset):
                 'limit and offset, if provided, must be non-negative'
             ), 400
         else:
-            data = csv_parser.read_data_offset(limit=limit, offset=offset)
-            return jsonify(data)
+            data = csv_parser.read_data_offset(limit=limit, offset=offset,
+                                               series=series)
+            return _send_rows(data)
+
+
+def _send_rows(data):
+    # Rows asked for as CSV are encoded a batch at a time as they're
+    # sent, so large ranges aren't built up in memory.
+    if request.args.get('format') == 'csv':
+        return Response(export.iter_csv(data), mimetype='text/csv')
+    else:
+        return jsonify(data)
+
+
+def _handle_lookup_case(years, ids, series):
+    # The years or ids are either comma separated in the query or lists
+    # in the body of a lookup.
+    if years is not None and ids is not None:
+        return _make_error('years and ids cannot be combined'), 400
+
+    try:
+        if years is not None:
+            rows, missing = csv_parser.read_data_years(_parse_keys(years),
+                                                       series=series)
+        else:
+            rows, missing = csv_parser.read_data_ids(_parse_keys(ids),
+                                                     series=series)
+    except ValueError as e:
+        return _make_error(e.args[0]), 400
+    else:
+        return jsonify(rows=rows, missing=missing)
+
+
+@app.route('/spots/lookup', methods=['POST'])
+def spots_lookup():
+    """Return the rows for a list of years or ids too long for a query."""
+    try:
+        body = request.get_json(force=True) or {}
+    except Exception as e:
+        return _make_error(f'Invalid JSON: {e}'), 400
+
+    return _handle_lookup_case(body.get('years'), body.get('ids'),
+                               request.args.get('series'))
+
+
+@app.route('/spots/analysis', methods=['GET'])
+def spots_analysis():
+    """Return moving averages, smoothing and cycles of the sunspot data."""
+    try:
+        # These conversions might fail if they aren't None or integer
+        # strings.
+        start, end, window, smoothing = _parse_ints(
+            request.args.get('start'), request.args.get('end'),
+            request.args.get('window'), request.args.get('smoothing')
+        )
+    except ValueError:
+        return _make_error(
+            'start, end, window and smoothing, if provided, must be integers.'
+        ), 400
+
+    params = {'start': start, 'end': end}
+
+    if window is not None:
+        params['window'] = window
+    if smoothing is not None:
+        params['smoothing'] = smoothing
+
+    try:
+        with timing.phase('analysis'):
+            result = analysis.analyze(series=request.args.get('series'),
+                                      **params)
+    except ValueError as e:
+        return _make_error(e.args[0]), 400
+    else:
+        return jsonify(result)
 
 
 @app.route('/spots/<id>', methods=['GET'])
@@ -134,7 +397,8 @@ def spots_id(id):
     except ValueError:
         return _make_error('invalid value provided for row id.'), 400
 
-    data = csv_parser.read_data_offset(offset=id, limit=1)
+    data = csv_parser.read_data_offset(offset=id, limit=1,
+                                       series=request.args.get('series'))
 
     if len(data) == 1:
         return jsonify(data[0])
@@ -142,9 +406,9 @@ def spots_id(id):
         return _make_error('row not found for row id.'), 404
 
 
-@app.route('/spots/year/<year>', methods=['GET'])
+@app.route('/spots/year/<year>', methods=['GET', 'PUT', 'DELETE'])
 def spots_year(year):
-    """Return the value by id."""
+    """Return, set or delete the value by year."""
     # Turn the year into an integer. Unlike the id, it's technically
     # alright if the year is negative, it's just that this dataset
     # doesn't have any negative years in the rows.
@@ -154,10 +418,44 @@ def spots_year(year):
     except ValueError:
         return _make_error('invalid value provided for year.'), 400
 
-    data = csv_parser.read_data_range(start=year, end=year)
+    series = request.args.get('series')
 
-    if len(data) == 1:
-        return jsonify(data[0])
+    if request.method == 'PUT':
+        try:
+            body = request.get_json(force=True) or {}
+        except Exception as e:
+            return _make_error(f'Invalid JSON: {e}'), 400
+
+        spots = body.get('spots')
+
+        if spots is None:
+            return _make_error('spots must be provided'), 400
+
+        try:
+            spots = int(spots)
+        except ValueError:
+            return _make_error('spots must be an integer.'), 400
+
+        if spots < 0:
+            return _make_error('spots must be non-negative'), 400
+
+        try:
+            row = csv_parser.update_data(year, spots, series=series)
+        except ValueError as e:
+            return _make_error(e.args[0]), 400
+        else:
+            _schedule_warming(series)
+            return jsonify(row)
+    elif request.method == 'DELETE':
+        row = csv_parser.delete_data(year, series=series)
+
+        if row:
+            _schedule_warming(series)
+    else:
+        row = csv_parser.read_data_year(year, series=series)
+
+    if row:
+        return jsonify(row)
     else:
         return _make_error('row not found for year.'), 404
 
@@ -179,12 +477,18 @@ def jobs_index():
         limit = body.get('limit')
         offset = body.get('offset')
         job_type = body.get('job_type', 'line')
+        series = body.get('series')
 
-        if job_type not in ('line', 'fun_facts', 'histogram', 'box_plot'):
-            return _make_error(
-                'job_type must be line, fun_facts, histogram, box_plot, or not'
-                ' given (defaulting to line)'
-            ), 400
+        # Each job type has its own outputs, and its own default.
+        try:
+            output = jobs.check_output(job_type, body.get('output'))
+        except ValueError as e:
+            return _make_error(e.args[0]), 400
+
+        if series is not None and not isinstance(series, str):
+            return _make_error('series, if provided, must be a string.'), 400
+        elif series is not None and not csv_parser.series_exists(series):
+            return _make_error('series not found.'), 400
 
         is_range_case = start is not None or end is not None
         is_offset_case = limit is not None or offset is not None
@@ -194,18 +498,21 @@ def jobs_index():
                 'limit and/or offset cannot be combined with start and/or end'
             ), 400
         elif is_range_case:
-            return _handle_post_range_job(start, end, job_type)
+            return _handle_post_range_job(start, end, job_type, output,
+                                          series)
         elif is_offset_case:
-            return _handle_post_offset_job(limit, offset, job_type)
+            return _handle_post_offset_job(limit, offset, job_type, output,
+                                           series)
         else:
-            job_dict = jobs.create_job(redis_client, job_type=job_type)
+            job_dict = _create_job(job_type=job_type, output=output,
+                                   series=series)
             return jsonify(job_dict)
     elif request.method == 'GET':
         job_dicts = jobs.get_all_jobs(redis_client)
         return jsonify(job_dicts)
 
 
-def _handle_post_range_job(start, end, job_type):
+def _handle_post_range_job(start, end, job_type, output, series):
     # Converting the start and end to integers if they were
     # provided.
     try:
@@ -220,12 +527,12 @@ def _handle_post_range_job(start, end, job_type):
             'start and end, if provided, must be integers.'
         ), 400
     else:
-        job_dict = jobs.create_job(redis_client, start=start, end=end,
-                                   job_type=job_type)
+        job_dict = _create_job(start=start, end=end, job_type=job_type,
+                               output=output, series=series)
         return jsonify(job_dict)
 
 
-def _handle_post_offset_job(limit, offset, job_type):
+def _handle_post_offset_job(limit, offset, job_type, output, series):
     # Converting the limit and offset to integers if they were
     # provided and checking if they are non-negative.
     try:
@@ -240,15 +547,60 @@ def _handle_post_offset_job(limit, offset, job_type):
             'limit and offset, if provided, must be integers.'
         ), 400
     else:
-        job_dict = jobs.create_job(redis_client, limit=limit, offset=offset,
-                                   job_type=job_type)
+        job_dict = _create_job(limit=limit, offset=offset,
+                               job_type=job_type, output=output,
+                               series=series)
         return jsonify(job_dict)
 
 
-@app.route('/jobs/<id>', methods=['GET'])
+def _create_job(start=None, end=None, limit=None, offset=None,
+                job_type='line', output='plot', series=None):
+    # Plots of popular queries may already be rendered from the current
+    # data, in which case the job is done as soon as it's made.
+    params = dict(start=start, end=end, limit=limit, offset=offset,
+                  job_type=job_type)
+
+    if output == 'plot':
+        ref = warm_cache.lookup(redis_client,
+                                series or csv_parser.DEFAULT_SERIES,
+                                csv_parser.read_data_version(series),
+                                **params)
+
+        if ref:
+            return jobs.create_cached_job(redis_client, ref, output=output,
+                                          series=series, **params)
+
+    return jobs.create_job(redis_client, output=output, series=series,
+                           **params)
+
+
+def _schedule_warming(series):
+    # Queue the series' popular plots to be rendered again from the
+    # changed data. The change has already been made, so it isn't
+    # failed if Redis can't be reached.
+    series = series or csv_parser.DEFAULT_SERIES
+
+    try:
+        warm_cache.schedule(redis_client, series,
+                            csv_parser.read_data_version(series))
+    except redis.RedisError:
+        logger.exception('could not schedule warming series %s', series)
+
+
+@app.route('/jobs/<id>', methods=['GET', 'DELETE'])
 def job_by_id(id):
-    """Return a job by id."""
-    job_dict = jobs.get_job(redis_client, id)
+    """Return or cancel a job by id."""
+
+    if request.method == 'GET':
+        job_dict = jobs.get_job(redis_client, id)
+    elif request.method == 'DELETE':
+        # Queued jobs are cancelled right away, and running ones are
+        # stopped by their worker shortly after.
+        job_dict = jobs.cancel_job(redis_client, id)
+
+        if job_dict and job_dict['status'] in ('completed', 'failed',
+                                               'timed_out'):
+            return _make_error('job has already finished.'), 409
 
     if job_dict:
         return jsonify(job_dict)
@@ -259,15 +611,147 @@ def job_by_id(id):
 @app.route('/jobs/<id>/plot', methods=['GET'])
 def job_plot(id):
     """Return a plot for a job by job id."""
-    plot = jobs.get_plot(redis_client, id)
+    ref = jobs.get_plot_ref(redis_client, id)
+    file = None
+
+    if ref:
+        file = plots.open(ref)
+    else:
+        # Older jobs have their plot stored directly on Redis.
+        plot = jobs.get_plot(redis_client, id)
+
+        if plot:
+            ref = plot_store.content_ref(plot)
+            file = io.BytesIO(plot)
 
-    if plot:
-        return send_file(io.BytesIO(plot), mimetype='image/png',
-                         as_attachment=True, attachment_filename=f'{id}.png')
+    if file:
+        return _send_stored_file(file, ref, 'image/png', f'{id}.png')
     else:
         return _make_error('plot not found for job id.'), 404
 
 
+@app.route('/jobs/<id>/export', methods=['GET'])
+def job_export(id):
+    """Return the file made by an export job by job id."""
+    job_dict = jobs.get_job(redis_client, id)
+    ref = jobs.get_export_ref(redis_client, id) if job_dict else None
+    file = plots.open(ref) if ref else None
+
+    if file:
+        mimetype, extension = export.FORMATS[job_dict['output']]
+        return _send_stored_file(file, ref, mimetype, f'{id}{extension}')
+    else:
+        return _make_error('export not found for job id.'), 404
+
+
+@app.route('/jobs/<id>/result', methods=['GET'])
+def job_result(id):
+    """Return the statistics for a json output job by job id."""
+    result = jobs.get_result(redis_client, id)
+
+    if result:
+        # The result is already stored as JSON so it's sent as is.
+        return Response(result, mimetype='application/json')
+    else:
+        return _make_error('result not found for job id.'), 404
+
+
+@app.route('/jobs/<id>/trace', methods=['GET'])
+def job_trace(id):
+    """Return the spans recorded while handling a job by job id."""
+    job_dict = jobs.get_job(redis_client, id)
+
+    if job_dict is None:
+        return _make_error('job not found for job id.'), 404
+    elif job_dict['trace_id'] is None:
+        return _make_error('trace not found for job id.'), 404
+
+    spans = tracing.get_spans(redis_client, job_dict['trace_id'])
+
+    return jsonify(job_id=id, trace_id=job_dict['trace_id'], spans=spans)
+
+
+@app.route('/dead-jobs', methods=['GET'])
+def dead_jobs_index():
+    """Return the jobs which failed for good, most recent first."""
+    job_dicts = jobs.get_dead_jobs(redis_client)
+    return jsonify(job_dicts)
+
+
+@app.route('/dead-jobs/<id>/replay', methods=['POST'])
+def dead_job_replay(id):
+    """Queue a failed job again by job id."""
+    job_dict = jobs.replay_job(redis_client, id)
+
+    if job_dict:
+        return jsonify(job_dict)
+    else:
+        return _make_error('dead job not found for job id.'), 404
+
+
+@app.route('/workers', methods=['GET'])
+def workers_index():
+    """Return all live workers."""
+    worker_dicts = registry.get_workers(redis_client)
+    return jsonify(worker_dicts)
+
+
+@app.route('/workers/scaling', methods=['GET'])
+def workers_scaling():
+    """Return the load on the workers and how many replicas it needs."""
+    signal = registry.scaling_signal(
+        redis_client, target_drain_seconds=SCALING_TARGET_DRAIN,
+        headroom=SCALING_HEADROOM, min_replicas=SCALING_MIN_REPLICAS,
+        max_replicas=SCALING_MAX_REPLICAS
+    )
+    return jsonify(signal)
+
+
+@app.errorhandler(csv_parser.SeriesNotFound)
+def series_not_found(e):
+    """Answer requests for a series that doesn't exist."""
+    return _make_error('series not found.'), 404
+
+
+# Send a file from the plot store with its reference as a strong ETag.
+# Flask streams real files with the server's file wrapper (sendfile
+# where it's supported), and conditional and range requests are
+# answered with 304 and 206 responses.
+def _send_stored_file(file, ref, mimetype, filename):
+    size = file.seek(0, io.SEEK_END)
+    file.seek(0)
+
+    response = send_file(file, mimetype=mimetype, as_attachment=True,
+                         attachment_filename=filename, add_etags=False)
+    response.set_etag(ref)
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+
+    # Werkzeug only says ranges are accepted when one is asked for, so
+    # clients wouldn't know they can resume a download.
+    response.headers['Accept-Ranges'] = 'bytes'
+
+    return response.make_conditional(request, accept_ranges=True,
+                                     complete_length=size)
+
+
+# Convert values which aren't None to integers.
+def _parse_ints(*values):
+    return [int(value) if value is not None else None for value in values]
+
+
+# Convert comma separated keys, or a list of them, to integers.
+def _parse_keys(keys):
+    if isinstance(keys, str):
+        keys = [key for key in keys.split(',') if key]
+    elif not isinstance(keys, list):
+        raise ValueError('years and ids must be lists of integers.')
+
+    try:
+        return [int(key) for key in keys]
+    except (TypeError, ValueError):
+        raise ValueError('years and ids must be lists of integers.')
+
+
 # Format a simple JSON error message.
 def _make_error(message):
     return jsonify(status='Error', message=message)
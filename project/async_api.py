@@ -0,0 +1,918 @@
+"""An asyncio version of the API for lots of concurrent connections.
+
+This serves the same routes as api.py with aiohttp and an async Redis
+client, so slow clients, clients waiting on a job and large downloads
+don't each hold a thread. Sunspot data is streamed out in batches as
+the client reads it, and GET /jobs/<id> can wait for a job to finish
+(with the wait query param) on a single shared pub/sub connection.
+
+The job administration routes (cancelling, dead jobs and workers)
+aren't latency sensitive, so they reuse the synchronous functions in a
+thread. Reads of the data go through a thread too, since parsing a
+changed series or waiting on its lock file would stall every
+connection.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+
+from aiohttp import web
+import aioredis
+
+import analysis
+import csv_parser
+import export
+import jobs
+import plot_store
+import rate_limit
+import redis_pool
+import registry
+import tracing
+import warm_cache
+
+
+REDIS_ADDRESS = f"redis://{os.environ['REDIS_HOST']}:{os.environ['REDIS_PORT']}"
+REDIS_DB = int(os.environ['REDIS_DB'])
+
+# Most clients allowed to wait on jobs at once, to bound the memory
+# they use, and the longest any of them can wait in seconds.
+ASYNC_MAX_WAITERS = int(os.environ.get('ASYNC_MAX_WAITERS', '50000'))
+MAX_WAIT = 60
+
+# Seconds an idle keep-alive connection is held open.
+ASYNC_KEEPALIVE = float(os.environ.get('ASYNC_KEEPALIVE', '75'))
+
+# Number of rows encoded and sent at a time when streaming data.
+STREAM_BATCH_SIZE = 1000
+
+# Seconds to wait before reconnecting the job updates subscription.
+RESUBSCRIBE_DELAY = 1
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+logger = logging.getLogger(__name__)
+
+routes = web.RouteTableDef()
+
+
+def make_app():
+    """Return the aiohttp application."""
+    app = web.Application(middlewares=[_trace_request, _limit_rate,
+                                       _series_not_found])
+    app.add_routes(routes)
+    app.on_response_prepare.append(_add_rate_limit_headers)
+    app.on_startup.append(_start_redis)
+    app.on_cleanup.append(_stop_redis)
+
+    return app
+
+
+def run():
+    """Serve the application on port 5000."""
+    web.run_app(make_app(), host='0.0.0.0', port=5000,
+                keepalive_timeout=ASYNC_KEEPALIVE)
+
+
+async def _start_redis(app):
+    app['redis'] = await aioredis.create_redis_pool(
+        REDIS_ADDRESS, db=REDIS_DB, maxsize=redis_pool.REDIS_MAX_CONNECTIONS
+    )
+    app['plots'] = plot_store.from_env(redis_pool.get_client())
+    app['waiters'] = _JobWaiters()
+    app['listener'] = asyncio.ensure_future(_listen_job_updates(app))
+
+
+async def _stop_redis(app):
+    app['listener'].cancel()
+    app['redis'].close()
+    await app['redis'].wait_closed()
+
+
+async def _listen_job_updates(app):
+    """Wake up clients waiting on jobs as job statuses change."""
+    while True:
+        try:
+            conn = await aioredis.create_redis(REDIS_ADDRESS, db=REDIS_DB)
+
+            try:
+                channel, = await conn.subscribe(jobs.UPDATES_CHANNEL)
+
+                async for message in channel.iter():
+                    app['waiters'].notify(message.decode())
+            finally:
+                conn.close()
+        except (aioredis.RedisError, OSError):
+            # Waiting clients still get the job when their wait runs out,
+            # so updates missed while reconnecting aren't lost for good.
+            await asyncio.sleep(RESUBSCRIBE_DELAY)
+
+
+@web.middleware
+async def _trace_request(request, handler):
+    """Record a span for a request that's part of a job's trace."""
+    trace_id = request.headers.get(tracing.TRACE_HEADER)
+
+    if not tracing.is_trace_id(trace_id):
+        return await handler(request)
+
+    start = time.time()
+    response = await handler(request)
+    span = tracing.encode_span(f'{request.method} {request.path}', 'api',
+                               start, time.time(), status=response.status)
+
+    try:
+        await _save_spans(request.app['redis'], trace_id, [span])
+    except (aioredis.RedisError, OSError):
+        logger.exception('could not save the span for trace %s', trace_id)
+
+    return response
+
+
+@web.middleware
+async def _series_not_found(request, handler):
+    """Answer requests for a series that doesn't exist."""
+    try:
+        return await handler(request)
+    except csv_parser.SeriesNotFound:
+        return _make_error('series not found.', 404)
+
+
+@web.middleware
+async def _limit_rate(request, handler):
+    """Turn away clients over their rate limit, like api.limit_rate."""
+    is_new_job = request.match_info.handler is jobs_create
+    route_class = 'jobs' if is_new_job else 'default'
+    decision = None
+
+    if rate_limit.is_checked(route_class, shed=is_new_job):
+        keys, args = rate_limit.script_args(request.remote, route_class,
+                                            shed=is_new_job)
+
+        try:
+            result = await request.app['redis'].eval(
+                rate_limit.TOKEN_BUCKET_SCRIPT, keys=keys, args=args
+            )
+        except (aioredis.RedisError, OSError):
+            logger.exception('could not check the rate limit')
+        else:
+            decision = rate_limit.parse_result(result, route_class)
+
+    request['rate_limit'] = decision
+
+    if decision and decision.shed:
+        return _make_error('too many jobs are queued, try again later.', 503)
+    elif decision and not decision.allowed:
+        return _make_error('rate limit exceeded, try again later.', 429)
+    else:
+        return await handler(request)
+
+
+async def _add_rate_limit_headers(request, response):
+    # Added as the response is prepared so streamed responses get them
+    # too, before their headers are sent.
+    decision = request.get('rate_limit')
+
+    if decision:
+        response.headers.update(rate_limit.get_headers(decision))
+
+
+class _JobWaiters:
+    """Futures for clients waiting on job updates, by job id."""
+
+    def __init__(self):
+        self._futures = {}
+        self.count = 0
+
+    def add(self, job_id):
+        """Return a future which is done at the next update to a job.
+
+        It has to be given back to remove once it isn't needed.
+        """
+        future = asyncio.get_event_loop().create_future()
+
+        self._futures.setdefault(job_id, set()).add(future)
+        self.count += 1
+
+        return future
+
+    def remove(self, job_id, future):
+        """Stop waiting on a job with a future from add."""
+        futures = self._futures[job_id]
+
+        futures.discard(future)
+        self.count -= 1
+
+        if not futures:
+            del self._futures[job_id]
+
+    def notify(self, job_id):
+        """Wake everything waiting on a job."""
+        for future in self._futures.get(job_id, ()):
+            if not future.done():
+                future.set_result(None)
+
+
+@routes.post('/spots')
+async def spots_create(request):
+    """Add a row of sunspot data."""
+    # Parse the data and make sure that it has a year and a
+    # non-negative amount of spots.
+    try:
+        body = await request.json() or {}
+    except ValueError as e:
+        return _make_error(f'Invalid JSON: {e}', 400)
+
+    year = body.get('year')
+    spots = body.get('spots')
+
+    if year is None or spots is None:
+        return _make_error('both year and spots must be provided', 400)
+
+    try:
+        year = int(year)
+        spots = int(spots)
+    except ValueError:
+        return _make_error('year and spots must be integers.', 400)
+
+    if spots < 0:
+        return _make_error('spots must be non-negative', 400)
+
+    # Appending writes to the change log, so it's done off the event loop.
+    try:
+        row = await _run_sync(csv_parser.append_data, year, spots,
+                              series=request.query.get('series'))
+    except ValueError as e:
+        return _make_error(e.args[0], 400)
+    else:
+        await _schedule_warming(request)
+        return _json(row)
+
+
+@routes.get('/spots')
+async def spots_index(request):
+    """Stream the sunspot data over a range or offset."""
+    query = request.query
+    start, end = query.get('start'), query.get('end')
+    limit, offset = query.get('limit'), query.get('offset')
+    years, ids = query.get('years'), query.get('ids')
+    series = query.get('series')
+
+    is_range_case = start is not None or end is not None
+    is_offset_case = limit is not None or offset is not None
+    is_lookup_case = years is not None or ids is not None
+    data_format = query.get('format', 'json')
+    headers = {}
+
+    if data_format not in ('json', 'csv'):
+        return _make_error(
+            'format must be json, csv, or not given (defaulting to json)', 400
+        )
+    elif is_lookup_case and data_format == 'csv':
+        return _make_error('years and ids can only be looked up as json', 400)
+    elif is_range_case and is_offset_case:
+        return _make_error(
+            'limit and/or offset cannot be combined with start and/or end',
+            400
+        )
+    elif is_lookup_case and (is_range_case or is_offset_case):
+        return _make_error(
+            'years and ids cannot be combined with start, end, limit or '
+            'offset', 400
+        )
+    elif is_lookup_case:
+        return await _lookup_rows(years, ids, series)
+    elif is_range_case:
+        try:
+            start, end = _parse_ints(start, end)
+        except ValueError:
+            return _make_error(
+                'start and end, if provided, must be integers.', 400
+            )
+
+        data = await _run_sync(csv_parser.read_data_range, start=start,
+                               end=end, series=series)
+    elif is_offset_case:
+        try:
+            limit, offset = _parse_ints(limit, offset)
+        except ValueError:
+            return _make_error(
+                'limit and offset, if provided, must be integers.', 400
+            )
+
+        if (limit is not None and limit < 0) or \
+                (offset is not None and offset < 0):
+            return _make_error(
+                'limit and offset, if provided, must be non-negative', 400
+            )
+
+        data = await _run_sync(csv_parser.read_data_offset, limit=limit,
+                               offset=offset, series=series)
+    else:
+        # Sending the version of the data with it so workers can tell
+        # which version they rendered plots from.
+        version, data = await _run_sync(csv_parser.read_versioned_data,
+                                        series)
+        headers[warm_cache.VERSION_HEADER] = version
+
+    if data_format == 'csv':
+        return await _stream_csv(request, data, headers)
+    else:
+        return await _stream_json_list(request, data, headers)
+
+
+@routes.post('/spots/lookup')
+async def spots_lookup(request):
+    """Return the rows for a list of years or ids too long for a query."""
+    try:
+        body = await request.json() or {}
+    except ValueError as e:
+        return _make_error(f'Invalid JSON: {e}', 400)
+
+    return await _lookup_rows(body.get('years'), body.get('ids'),
+                              request.query.get('series'))
+
+
+async def _lookup_rows(years, ids, series):
+    """Return the rows for years or ids with the ones that are missing.
+
+    The keys are either comma separated in the query or lists in the
+    body of a lookup.
+    """
+    if years is not None and ids is not None:
+        return _make_error('years and ids cannot be combined', 400)
+
+    try:
+        if years is not None:
+            rows, missing = await _run_sync(csv_parser.read_data_years,
+                                            _parse_keys(years), series=series)
+        else:
+            rows, missing = await _run_sync(csv_parser.read_data_ids,
+                                            _parse_keys(ids), series=series)
+    except ValueError as e:
+        return _make_error(e.args[0], 400)
+    else:
+        return _json({'rows': rows, 'missing': missing})
+
+
+# Registered before /spots/{id} so analysis isn't taken for an id.
+@routes.get('/spots/analysis')
+async def spots_analysis(request):
+    """Return moving averages, smoothing and cycles of the sunspot data."""
+    query = request.query
+
+    try:
+        start, end, window, smoothing = _parse_ints(
+            query.get('start'), query.get('end'), query.get('window'),
+            query.get('smoothing')
+        )
+    except ValueError:
+        return _make_error(
+            'start, end, window and smoothing, if provided, must be integers.',
+            400
+        )
+
+    params = {'start': start, 'end': end}
+
+    if window is not None:
+        params['window'] = window
+    if smoothing is not None:
+        params['smoothing'] = smoothing
+
+    # Working out a new result can take a while on a large series, so
+    # it's done off the event loop.
+    try:
+        result = await _run_sync(analysis.analyze,
+                                 series=query.get('series'), **params)
+    except ValueError as e:
+        return _make_error(e.args[0], 400)
+    else:
+        return _json(result)
+
+
+@routes.get('/spots/{id}')
+async def spots_id(request):
+    """Return a sunspots data row by id."""
+    try:
+        id = int(request.match_info['id'])
+
+        if id < 0:
+            raise ValueError
+    except ValueError:
+        return _make_error('invalid value provided for row id.', 400)
+
+    data = await _run_sync(csv_parser.read_data_offset, offset=id, limit=1,
+                           series=request.query.get('series'))
+
+    if len(data) == 1:
+        return _json(data[0])
+    else:
+        return _make_error('row not found for row id.', 404)
+
+
+@routes.get('/spots/year/{year}')
+async def spots_year(request):
+    """Return a sunspots data row by year."""
+    try:
+        year = int(request.match_info['year'])
+    except ValueError:
+        return _make_error('invalid value provided for year.', 400)
+
+    row = await _run_sync(csv_parser.read_data_year, year,
+                          series=request.query.get('series'))
+
+    if row:
+        return _json(row)
+    else:
+        return _make_error('row not found for year.', 404)
+
+
+@routes.put('/spots/year/{year}')
+async def spots_year_update(request):
+    """Set the sunspots for a year, adding the year if it's new."""
+    try:
+        year = int(request.match_info['year'])
+    except ValueError:
+        return _make_error('invalid value provided for year.', 400)
+
+    try:
+        body = await request.json() or {}
+    except ValueError as e:
+        return _make_error(f'Invalid JSON: {e}', 400)
+
+    spots = body.get('spots')
+
+    if spots is None:
+        return _make_error('spots must be provided', 400)
+
+    try:
+        spots = int(spots)
+    except ValueError:
+        return _make_error('spots must be an integer.', 400)
+
+    if spots < 0:
+        return _make_error('spots must be non-negative', 400)
+
+    try:
+        row = await _run_sync(csv_parser.update_data, year, spots,
+                              series=request.query.get('series'))
+    except ValueError as e:
+        return _make_error(e.args[0], 400)
+    else:
+        await _schedule_warming(request)
+        return _json(row)
+
+
+@routes.delete('/spots/year/{year}')
+async def spots_year_delete(request):
+    """Delete the sunspots data row for a year."""
+    try:
+        year = int(request.match_info['year'])
+    except ValueError:
+        return _make_error('invalid value provided for year.', 400)
+
+    row = await _run_sync(csv_parser.delete_data, year,
+                          series=request.query.get('series'))
+
+    if row:
+        await _schedule_warming(request)
+        return _json(row)
+    else:
+        return _make_error('row not found for year.', 404)
+
+
+@routes.post('/jobs')
+async def jobs_create(request):
+    """Create a new job."""
+    try:
+        body = await request.json() or {}
+    except ValueError as e:
+        return _make_error(f'Invalid JSON: {e}', 400)
+
+    start, end = body.get('start'), body.get('end')
+    limit, offset = body.get('limit'), body.get('offset')
+    job_type = body.get('job_type', 'line')
+    series = body.get('series')
+
+    try:
+        output = jobs.check_output(job_type, body.get('output'))
+    except ValueError as e:
+        return _make_error(e.args[0], 400)
+
+    if series is not None and not isinstance(series, str):
+        return _make_error('series, if provided, must be a string.', 400)
+    elif series is not None and \
+            not await _run_sync(csv_parser.series_exists, series):
+        return _make_error('series not found.', 400)
+
+    is_range_case = start is not None or end is not None
+    is_offset_case = limit is not None or offset is not None
+
+    if is_range_case and is_offset_case:
+        return _make_error(
+            'limit and/or offset cannot be combined with start and/or end',
+            400
+        )
+
+    try:
+        start, end = _parse_ints(start, end)
+    except ValueError:
+        return _make_error('start and end, if provided, must be integers.',
+                           400)
+
+    try:
+        limit, offset = _parse_ints(limit, offset)
+    except ValueError:
+        return _make_error('limit and offset, if provided, must be integers.',
+                           400)
+
+    # Creating the job is a few quick Redis calls, made with the same
+    # functions as the Flask API so the jobs they save are the same.
+    job_dict = await _run_sync(_create_job, output, series, start=start,
+                               end=end, limit=limit, offset=offset,
+                               job_type=job_type)
+
+    return _json(job_dict)
+
+
+def _create_job(output, series, **params):
+    """Create a job like api._create_job, in a thread.
+
+    Plots of popular queries may already be rendered from the current
+    data, in which case the job is done as soon as it's made.
+    """
+    redis_client = redis_pool.get_client()
+
+    if output == 'plot':
+        ref = warm_cache.lookup(redis_client,
+                                series or csv_parser.DEFAULT_SERIES,
+                                csv_parser.read_data_version(series),
+                                **params)
+
+        if ref:
+            return jobs.create_cached_job(redis_client, ref, output=output,
+                                          series=series, **params)
+
+    return jobs.create_job(redis_client, output=output, series=series,
+                           **params)
+
+
+@routes.get('/jobs')
+async def jobs_index(request):
+    """Stream all jobs."""
+    redis = request.app['redis']
+    keys = await redis.smembers('job-keys')
+
+    pipe = redis.pipeline()
+    futures = [pipe.hgetall(key) for key in keys]
+    await pipe.execute()
+
+    job_dicts = [jobs.convert_job_hash(future.result())
+                 for future in futures if future.result()]
+
+    return await _stream_json_list(request, job_dicts)
+
+
+@routes.get('/jobs/{id}')
+async def job_by_id(request):
+    """Return a job by id, optionally waiting for it to finish.
+
+    With the wait query param, the response is held until the job
+    finishes or up to that many seconds pass, whichever is first.
+    """
+    job_id = request.match_info['id']
+
+    try:
+        wait = float(request.query.get('wait', 0))
+    except ValueError:
+        return _make_error('wait, if provided, must be a number.', 400)
+
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + min(max(wait, 0), MAX_WAIT)
+    waiters = request.app['waiters']
+
+    while True:
+        # Waiting starts before the job is read, so an update published
+        # while it's being read still wakes the request.
+        future = waiters.add(job_id) if deadline > loop.time() else None
+
+        try:
+            job_dict = await _get_job(request.app['redis'], job_id)
+
+            if job_dict is None:
+                return _make_error('job not found for job id.', 404)
+
+            remaining = deadline - loop.time()
+
+            if (future is None or remaining <= 0 or
+                    job_dict['status'] in jobs.FINISHED_STATUSES):
+                return _json(job_dict)
+
+            # The count includes this request's own future.
+            if waiters.count > ASYNC_MAX_WAITERS:
+                return _make_error('too many clients are waiting on jobs.',
+                                   503)
+
+            await asyncio.wait([future], timeout=remaining)
+        finally:
+            if future is not None:
+                waiters.remove(job_id, future)
+
+
+@routes.delete('/jobs/{id}')
+async def job_cancel(request):
+    """Cancel a job by id."""
+    job_dict = await _run_sync(jobs.cancel_job, redis_pool.get_client(),
+                               request.match_info['id'])
+
+    if job_dict and job_dict['status'] in ('completed', 'failed',
+                                           'timed_out'):
+        return _make_error('job has already finished.', 409)
+    elif job_dict:
+        return _json(job_dict)
+    else:
+        return _make_error('job not found for job id.', 404)
+
+
+@routes.get('/jobs/{id}/plot')
+async def job_plot(request):
+    """Return a plot for a job by job id."""
+    job_id = request.match_info['id']
+    redis = request.app['redis']
+    plots = request.app['plots']
+
+    ref = await redis.hget(jobs.format_key(job_id), 'plot_ref')
+    ref = ref.decode() if ref not in (None, b'None') else None
+
+    headers = {
+        'Content-Type': 'image/png',
+        'Content-Disposition': f'attachment; filename={job_id}.png',
+        'Cache-Control': IMMUTABLE_CACHE_CONTROL
+    }
+
+    if ref and isinstance(plots, plot_store.LocalPlotStore):
+        headers['ETag'] = f'"{ref}"'
+
+        if _etag_matches(request, ref):
+            return web.Response(status=304, headers=headers)
+
+        path = plots.path(ref)
+
+        if os.path.exists(path):
+            # FileResponse sends the file with sendfile and answers
+            # range requests.
+            return web.FileResponse(path, headers=headers)
+    else:
+        if ref:
+            plot = await redis.get(plot_store.format_blob_key(ref))
+        else:
+            # Older jobs have their plot stored directly on Redis.
+            plot = await redis.get(jobs.format_plot_key(job_id))
+
+        if plot:
+            ref = ref or plot_store.content_ref(plot)
+            headers['ETag'] = f'"{ref}"'
+
+            if _etag_matches(request, ref):
+                return web.Response(status=304, headers=headers)
+
+            return web.Response(body=plot, headers=headers)
+
+    return _make_error('plot not found for job id.', 404)
+
+
+@routes.get('/jobs/{id}/export')
+async def job_export(request):
+    """Return the file made by an export job by job id."""
+    job_id = request.match_info['id']
+    redis = request.app['redis']
+    plots = request.app['plots']
+
+    job_hash = await redis.hgetall(jobs.format_key(job_id))
+    ref = job_hash.get(b'export_ref')
+
+    if ref in (None, b'None'):
+        return _make_error('export not found for job id.', 404)
+
+    ref = ref.decode()
+    output = jobs.convert_job_hash(job_hash)['output']
+    content_type, extension = export.FORMATS[output]
+    headers = {
+        'Content-Type': content_type,
+        'Content-Disposition': f'attachment; filename={job_id}{extension}',
+        'Cache-Control': IMMUTABLE_CACHE_CONTROL,
+        'ETag': f'"{ref}"'
+    }
+
+    if _etag_matches(request, ref):
+        return web.Response(status=304, headers=headers)
+
+    if isinstance(plots, plot_store.LocalPlotStore):
+        path = plots.path(ref)
+
+        if os.path.exists(path):
+            return web.FileResponse(path, headers=headers)
+    else:
+        data = await redis.get(plot_store.format_blob_key(ref))
+
+        if data:
+            return web.Response(body=data, headers=headers)
+
+    return _make_error('export not found for job id.', 404)
+
+
+@routes.get('/jobs/{id}/result')
+async def job_result(request):
+    """Return the statistics for a json output job by job id."""
+    key = jobs.format_result_key(request.match_info['id'])
+    result = await request.app['redis'].get(key)
+
+    if result:
+        return web.Response(body=result, content_type='application/json')
+    else:
+        return _make_error('result not found for job id.', 404)
+
+
+@routes.get('/jobs/{id}/trace')
+async def job_trace(request):
+    """Return the spans recorded while handling a job by job id."""
+    redis = request.app['redis']
+    job_dict = await _get_job(redis, request.match_info['id'])
+
+    if job_dict is None:
+        return _make_error('job not found for job id.', 404)
+    elif job_dict['trace_id'] is None:
+        return _make_error('trace not found for job id.', 404)
+
+    encoded_spans = await redis.lrange(
+        tracing.format_trace_key(job_dict['trace_id']), 0, -1
+    )
+
+    return _json({
+        'job_id': job_dict['id'],
+        'trace_id': job_dict['trace_id'],
+        'spans': tracing.decode_spans(encoded_spans)
+    })
+
+
+@routes.get('/dead-jobs')
+async def dead_jobs_index(request):
+    """Return the jobs which failed for good, most recent first."""
+    job_dicts = await _run_sync(jobs.get_dead_jobs, redis_pool.get_client())
+    return _json(job_dicts)
+
+
+@routes.post('/dead-jobs/{id}/replay')
+async def dead_job_replay(request):
+    """Queue a failed job again by job id."""
+    job_dict = await _run_sync(jobs.replay_job, redis_pool.get_client(),
+                               request.match_info['id'])
+
+    if job_dict:
+        return _json(job_dict)
+    else:
+        return _make_error('dead job not found for job id.', 404)
+
+
+@routes.get('/workers')
+async def workers_index(request):
+    """Return all live workers."""
+    worker_dicts = await _run_sync(registry.get_workers,
+                                   redis_pool.get_client())
+    return _json(worker_dicts)
+
+
+@routes.get('/workers/scaling')
+async def workers_scaling(request):
+    """Return the load on the workers and how many replicas it needs."""
+    signal = await _run_sync(
+        registry.scaling_signal, redis_pool.get_client(),
+        target_drain_seconds=float(os.environ.get('SCALING_TARGET_DRAIN',
+                                                  '60')),
+        headroom=float(os.environ.get('SCALING_HEADROOM', '1.2')),
+        min_replicas=int(os.environ.get('SCALING_MIN_REPLICAS', '1')),
+        max_replicas=int(os.environ.get('SCALING_MAX_REPLICAS', '20'))
+    )
+    return _json(signal)
+
+
+async def _get_job(redis, job_id):
+    job_hash = await redis.hgetall(jobs.format_key(job_id))
+
+    if job_hash:
+        return jobs.convert_job_hash(job_hash)
+    else:
+        return None
+
+
+async def _stream_json_list(request, items, headers=None):
+    """Send a JSON list a batch of items at a time.
+
+    Each write waits for the client to take the previous ones, so slow
+    clients only ever have a batch buffered for them. Any headers given
+    are sent along with the content type.
+    """
+    response = web.StreamResponse(
+        headers=dict(headers or {}, **{'Content-Type': 'application/json'})
+    )
+    await response.prepare(request)
+    await response.write(b'[')
+
+    for i in range(0, len(items), STREAM_BATCH_SIZE):
+        batch = ','.join(_dumps(item)
+                         for item in items[i:i + STREAM_BATCH_SIZE])
+        await response.write((',' + batch if i else batch).encode())
+
+    await response.write(b']')
+    await response.write_eof()
+
+    return response
+
+
+async def _schedule_warming(request):
+    """Queue the series' popular plots to be rendered again.
+
+    Like api._schedule_warming, the change isn't failed if Redis can't
+    be reached.
+    """
+    series = request.query.get('series') or csv_parser.DEFAULT_SERIES
+    keys, args = warm_cache.schedule_args(
+        series, await _run_sync(csv_parser.read_data_version, series)
+    )
+
+    try:
+        await request.app['redis'].eval(warm_cache.SCHEDULE_SCRIPT,
+                                        keys=keys, args=args)
+    except (aioredis.RedisError, OSError):
+        logger.exception('could not schedule warming series %s', series)
+
+
+async def _stream_csv(request, rows, headers=None):
+    """Send rows as CSV a batch at a time, like _stream_json_list."""
+    response = web.StreamResponse(
+        headers=dict(headers or {}, **{'Content-Type': 'text/csv'})
+    )
+    await response.prepare(request)
+
+    for batch in export.iter_csv(rows, STREAM_BATCH_SIZE):
+        await response.write(batch.encode())
+
+    await response.write_eof()
+
+    return response
+
+
+async def _save_spans(redis, trace_id, spans):
+    """Save encoded spans like tracing.Trace.save."""
+    trace_key = tracing.format_trace_key(trace_id)
+
+    pipe = redis.pipeline()
+
+    pipe.rpush(trace_key, *spans)
+    pipe.expire(trace_key, tracing.TRACE_TTL)
+
+    await pipe.execute()
+
+
+async def _run_sync(func, *args, **kwargs):
+    """Run a blocking function in the default thread pool."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, lambda: func(*args, **kwargs))
+
+
+def _parse_ints(*values):
+    """Convert values which aren't None to integers."""
+    return [int(value) if value is not None else None for value in values]
+
+
+def _parse_keys(keys):
+    """Convert comma separated keys, or a list of them, to integers."""
+    if isinstance(keys, str):
+        keys = [key for key in keys.split(',') if key]
+    elif not isinstance(keys, list):
+        raise ValueError('years and ids must be lists of integers.')
+
+    try:
+        return [int(key) for key in keys]
+    except (TypeError, ValueError):
+        raise ValueError('years and ids must be lists of integers.')
+
+
+def _etag_matches(request, ref):
+    return f'"{ref}"' in request.headers.get('If-None-Match', '')
+
+
+def _dumps(value):
+    # Matching the key order and spacing of Flask's jsonify.
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def _json(value, status=200):
+    return web.json_response(value, status=status, dumps=_dumps)
+
+
+# Format a simple JSON error message.
+def _make_error(message, status):
+    return _json({'status': 'Error', 'message': message}, status)
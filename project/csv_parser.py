@@ -1,40 +1,540 @@
 #!/usr/bin/env python3
 
+from collections import OrderedDict
+import contextlib
+import fcntl
 import sys
+import os
 import os.path
+import re
+import tempfile
+import threading
+
+import timing
 
 
 CSV_FILE = os.path.join(os.path.dirname(__file__), 'sunspots.csv')
 
+# The series CSV_FILE has, which is used when no series is given. Every
+# other series has its own CSV file in SERIES_DIR named after it.
+DEFAULT_SERIES = 'sunspots'
+SERIES_DIR = os.environ.get('SERIES_DIR') or \
+    os.path.join(os.path.dirname(__file__), 'series')
+
+# Megabytes of rows kept in memory across all series. The least recently
+# used series are dropped past this, and read in again when they're next
+# used.
+SERIES_CACHE_MB = float(os.environ.get('SERIES_CACHE_MB', '1024'))
+
+# Number of changes the change log can hold before it's merged into the
+# CSV file in the background (0 to never merge it).
+COMPACT_THRESHOLD = int(os.environ.get('COMPACT_THRESHOLD', '1000'))
+
+# Most years or ids that can be looked up at once.
+MAX_LOOKUP_KEYS = 10000
+
+# Rough bytes of memory each row takes, counting the parsed pair, the
+# index entry and the row dict.
+_ROW_BYTES = 400
+
+_SERIES_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+
+class SeriesNotFound(LookupError):
+    """Raised when reading a series that doesn't exist."""
+
+
+# The merged rows for each CSV file, by path, with the most recently
+# used last. Changes to the rows are only ever appended to a change log
+# next to the CSV file, so the file itself stays the same until the log
+# is compacted into it.
+_cache = OrderedDict()
+
+# Guards the cached datasets against threads in this process, while a
+# lock file guards the files against other processes.
+_lock = threading.Lock()
+
+# Paths which are being compacted by a thread in this process.
+_compacting = set()
+
+
+def read_data(series=None):
+    """Read in the CSV file and return a list of dictionaries.
+
+    The rows are kept in memory, and only the changes made since the
+    last read (possibly from another process) are read from disk. All
+    of the reading and writing functions take the series to use,
+    defaulting to DEFAULT_SERIES, and raise SeriesNotFound if it doesn't
+    exist.
+    """
+    return list(_read(_series_path(series),
+                      lambda dataset: dataset.get_rows()))
+
+
+def read_data_year(year, series=None):
+    """Return the row for a year, or None if there isn't one."""
+    return _read(_series_path(series),
+                 lambda dataset: dataset.get_rows_by_year().get(year))
+
+
+def read_data_years(years, series=None):
+    """Return the rows for several years in one go.
+
+    Returns the rows in the order of the years, without repeats, along
+    with the years which don't have a row.
+    """
+    _check_lookup_keys(years)
+
+    return _read(_series_path(series),
+                 lambda dataset: _lookup(years,
+                                         dataset.get_rows_by_year().get))
+
+
+def read_data_ids(ids, series=None):
+    """Return the rows for several ids in one go, like read_data_years."""
+    _check_lookup_keys(ids)
+
+    def read(dataset):
+        rows = dataset.get_rows()
+        return _lookup(ids, lambda id: rows[id] if 0 <= id < len(rows)
+                       else None)
+
+    return _read(_series_path(series), read)
+
+
+def read_data_version(series=None):
+    """Return the version of the data.
+
+    The version is a string which changes whenever the rows do, so it
+    can key caches of things worked out from them.
+    """
+    return _read(_series_path(series), lambda dataset: dataset.version())
+
+
+def read_versioned_data(series=None):
+    """Return the version of the data along with its rows."""
+    return _read(_series_path(series),
+                 lambda dataset: (dataset.version(),
+                                  list(dataset.get_rows())))
+
+
+def series_exists(series):
+    """Return whether there's data for a series."""
+    try:
+        _series_path(series)
+    except SeriesNotFound:
+        return False
+    else:
+        return True
+
+
+def preload():
+    """Parse the CSV file ahead of time so the first read is fast.
+
+    This is done before forking server processes so they share the
+    parsed rows instead of each parsing the file.
+    """
+    _read(CSV_FILE, lambda dataset: dataset.get_rows())
+
+
+def compact(series=None):
+    """Merge the change log into the CSV file.
+
+    The merged rows are written to a new file which replaces the CSV
+    file in one step, so readers see either the old file and its log or
+    the new file.
+    """
+    _compact(_series_path(series))
+
+
+def _check_lookup_keys(keys):
+    if len(keys) > MAX_LOOKUP_KEYS:
+        raise ValueError(f'at most {MAX_LOOKUP_KEYS} years or ids can be '
+                         'looked up at once')
+
+
+def _lookup(keys, find):
+    """Return the rows find gives for each key and the keys it misses."""
+    rows = []
+    missing = []
+
+    for key in OrderedDict.fromkeys(keys):
+        row = find(key)
+
+        if row is None:
+            missing.append(key)
+        else:
+            rows.append(row)
+
+    return rows, missing
+
+
+def _series_path(series, create=False):
+    """Return the CSV file for a series.
+
+    With create, the series is made if it doesn't exist yet, and a
+    ValueError is raised for an invalid name.
+    """
+    if series is None or series == DEFAULT_SERIES:
+        return CSV_FILE
+
+    if not _SERIES_PATTERN.fullmatch(series):
+        if create:
+            raise ValueError('series must be letters, numbers, _ or -')
+        else:
+            raise SeriesNotFound(series)
+
+    path = os.path.join(SERIES_DIR, f'{series}.csv')
+
+    if not os.path.exists(path):
+        if create:
+            os.makedirs(SERIES_DIR, exist_ok=True)
+            open(path, 'a').close()
+        else:
+            raise SeriesNotFound(series)
+
+    return path
+
+
+def _compact(path):
+    # Writers and readers catching up wait on the lock file until this
+    # is done, but readers in this process which are already caught up
+    # carry on with the rows in memory.
+    with _file_lock(path, fcntl.LOCK_EX):
+        with _lock:
+            dataset = _get_dataset(path)
+            dataset.refresh()
+
+            if dataset.log_entries == 0:
+                return
+
+            rows = dataset.get_rows()
+            lineage, changes = dataset.lineage, dataset.changes()
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for row in rows:
+                    f.write(f'{row["year"]},{row["spots"]}\n')
+
+                f.flush()
+                os.fsync(f.fileno())
+
+            # The rows are the same, so the new file carries on with the
+            # version they had. Replacing a file keeps its signature.
+            _write_version_file(path, _signature(tmp_path), lineage,
+                                changes)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        # If this doesn't happen the log is applied again on top of the
+        # rows it's already in, which leaves them the same.
+        open(_log_path(path), 'w').close()
+
+        # Nothing could have changed the rows while the lock file was
+        # held, so they match the new file without parsing it again.
+        with _lock:
+            dataset.adopt(rows)
+
+
+def _read(path, read):
+    """Call read with a path's dataset once it's caught up with disk."""
+    with _lock:
+        dataset = _get_dataset(path)
+
+        if dataset.is_current():
+            return read(dataset)
+
+    # Catching up is done holding the lock file so other processes can't
+    # change the files part way through. It's always taken before the
+    # thread lock, the same as when writing.
+    with _file_lock(path, fcntl.LOCK_SH):
+        with _lock:
+            dataset = _get_dataset(path)
+            dataset.refresh()
+            result = read(dataset)
+
+            _evict(path)
+
+            return result
+
+
+def _get_dataset(path):
+    """Return the dataset for a path, marking it as the latest used."""
+    dataset = _cache.get(path)
+
+    if dataset is None:
+        dataset = _cache[path] = _Dataset(path)
+    else:
+        _cache.move_to_end(path)
+
+    return dataset
+
 
-def read_data():
-    """Read in the CSV file and return a list of dictionaries."""
-    data = []
+def _evict(keep):
+    """Drop the least recently used datasets other than keep's.
 
-    # Parsing this by splitting a string and putting the data in
-    # dictionaries instead of using the built-in CSV library in
-    # Python.
-    with open(CSV_FILE, 'r') as f:
+    Datasets are dropped until the rest fit in SERIES_CACHE_MB.
+    """
+    limit = SERIES_CACHE_MB * 1024 * 1024
+    total = sum(dataset.approx_bytes() for dataset in _cache.values())
+
+    for path in list(_cache):
+        if total <= limit:
+            break
+
+        if path != keep and path not in _compacting:
+            total -= _cache.pop(path).approx_bytes()
+
+
+class _Dataset:
+    """The rows of a CSV file with its change log merged in.
+
+    Rows are kept by position as (year, spots) pairs, with None left in
+    place of deleted rows, along with an index of positions by year.
+    The rows with their ids are made from them when they're needed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.log_path = _log_path(path)
+        self.base_signature = None
+        self.lineage = None
+        self.base_changes = 0
+        self.log_offset = 0
+        self.log_entries = 0
+        self.entries = []
+        self.index = {}
+        self.rows = None
+        self.rows_by_year = None
+
+    def is_current(self):
+        """Return whether the files have changed since they were read."""
+        return _signature(self.path) == self.base_signature and \
+            _size(self.log_path) == self.log_offset
+
+    def refresh(self):
+        """Catch up with the files on disk.
+
+        The CSV file is only parsed again if it changed, and otherwise
+        just the new part of the change log is read. The caller holds
+        the lock file.
+        """
+        if not self.is_current():
+            self._load()
+
+    def adopt(self, rows):
+        """Take the rows as those of a newly compacted CSV file."""
+        self.entries = [(row['year'], row['spots']) for row in rows]
+        self.index = {entry[0]: i for i, entry in enumerate(self.entries)}
+        self.base_changes = self.changes()
+        self.base_signature = _signature(self.path)
+        self.log_offset = 0
+        self.log_entries = 0
+
+    def changes(self):
+        """Return how many changes the rows have had since the lineage."""
+        return self.base_changes + self.log_entries
+
+    def version(self):
+        """Return a string which changes whenever the rows do.
+
+        It's made of the lineage and the number of changes since, so it
+        stays the same when the log is compacted into the CSV file.
+        """
+        return f'{self.lineage}.{self.changes()}'
+
+    def approx_bytes(self):
+        """Return roughly how much memory the rows take."""
+        return len(self.entries) * _ROW_BYTES
+
+    def get_rows(self):
+        """Return the rows in order, with ids by position."""
+        if self.rows is None:
+            rows = []
+            rows_by_year = {}
+
+            for entry in self.entries:
+                if entry is not None:
+                    row = {'id': len(rows), 'year': entry[0],
+                           'spots': entry[1]}
+                    rows.append(row)
+                    rows_by_year[row['year']] = row
+
+            self.rows = rows
+            self.rows_by_year = rows_by_year
+
+        return self.rows
+
+    def get_rows_by_year(self):
+        """Return the rows by year."""
+        self.get_rows()
+        return self.rows_by_year
+
+    def write_change(self, change):
+        """Add a change to the log and apply it.
+
+        The caller holds the lock file exclusively.
+        """
+        with open(self.log_path, 'a') as f:
+            f.write(change + '\n')
+
+        self._load()
+
+    def _load(self):
+        signature = _signature(self.path)
+
+        # The log only shrinks when it's compacted into the CSV file.
+        if signature != self.base_signature or \
+                _size(self.log_path) < self.log_offset:
+            with timing.phase('csv-parse'):
+                self.entries = _parse_entries(self.path)
+
+            self.index = {entry[0]: i for i, entry in enumerate(self.entries)}
+            self.base_signature = signature
+            self.lineage, self.base_changes = _read_version_file(self.path,
+                                                                 signature)
+            self.log_offset = 0
+            self.log_entries = 0
+            self.rows = None
+
+        self._apply_log()
+
+    def _apply_log(self):
+        try:
+            f = open(self.log_path, 'rb')
+        except FileNotFoundError:
+            return
+
+        with f:
+            f.seek(self.log_offset)
+
+            for line in f:
+                # A change is only complete once its line is.
+                if not line.endswith(b'\n'):
+                    break
+
+                self.log_offset += len(line)
+                self.log_entries += 1
+                self._apply_change(line.decode().strip().split(','))
+
+    def _apply_change(self, change):
+        year = int(change[1])
+        i = self.index.get(year)
+
+        if change[0] == 'put':
+            entry = (year, int(change[2]))
+
+            if i is None:
+                self.index[year] = len(self.entries)
+                self.entries.append(entry)
+            else:
+                self.entries[i] = entry
+        elif change[0] == 'delete' and i is not None:
+            # Leaving a tombstone so the positions in the index still
+            # hold.
+            self.entries[i] = None
+            del self.index[year]
+
+        self.rows = None
+
+
+@contextlib.contextmanager
+def _file_lock(path, operation):
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f, operation)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _log_path(path):
+    return path + '.log'
+
+
+def _version_path(path):
+    return path + '.version'
+
+
+def _read_version_file(path, signature):
+    """Return the lineage and changes a CSV file's rows carry on from.
+
+    They're only carried on by the file a compaction wrote. A CSV file
+    replaced some other way starts a lineage of its own signature.
+    """
+    try:
+        with open(_version_path(path)) as f:
+            fields = f.read().split()
+    except FileNotFoundError:
+        fields = []
+
+    if len(fields) == 5 and tuple(map(int, fields[:3])) == signature:
+        return fields[3], int(fields[4])
+
+    return '.'.join(map(str, signature)), 0
+
+
+def _write_version_file(path, signature, lineage, changes):
+    # Written before the CSV file is replaced, so if that doesn't happen
+    # the signature doesn't match and the file is ignored.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(' '.join(map(str, signature + (lineage, changes))))
+            f.write('\n')
+
+        os.replace(tmp_path, _version_path(path))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _signature(path):
+    # The inode changes when the file is replaced by a compaction.
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _size(path):
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
+
+
+def _parse_entries(path):
+    entries = []
+
+    # Parsing this by splitting a string instead of using the built-in
+    # CSV library in Python.
+    with open(path, 'r') as f:
         raw_data = (line.split(',') for line in f)
 
-        # Add each item from the raw split data with an incrementing
-        # id number and with strings converted to numbers.
-        for i, row in enumerate(raw_data):
-            data.append({
-                'id': i, 'year': int(row[0]), 'spots': int(row[1])
-            })
+        # Add each item from the raw split data with strings converted
+        # to numbers.
+        for row in raw_data:
+            entries.append((int(row[0]), int(row[1])))
 
-    return data
+    return entries
 
 
-def read_data_range(start=None, end=None):
+def read_data_range(start=None, end=None, series=None):
     """Return data from a start to end point, inclusive.
 
     This uses a relatively naive approach of just going through the
     rows of data linearly.
     """
 
-    data = sorted(read_data(), key=lambda x: x['year'])
+    rows = read_data(series)
+
+    with timing.phase('sort'):
+        data = sorted(rows, key=lambda x: x['year'])
 
     # By default we use the whole range, the end index is not
     # inclusive.
@@ -60,12 +560,13 @@ def read_data_range(start=None, end=None):
                 end_index = i
                 break
 
-    return sorted(data[start_index:end_index], key=lambda x: x['id'])
+    with timing.phase('sort'):
+        return sorted(data[start_index:end_index], key=lambda x: x['id'])
 
 
-def read_data_offset(limit=None, offset=None):
+def read_data_offset(limit=None, offset=None, series=None):
     """Return data from an offset with a limit."""
-    data = read_data()
+    data = read_data(series)
 
     if offset is None:
         offset = 0
@@ -80,17 +581,80 @@ def read_data_offset(limit=None, offset=None):
         return data[offset:offset + limit]
 
 
-def append_data(year, spots):
+def append_data(year, spots, series=None):
     """Add new data to the CSV file.
 
-    Year must be unique.
+    Year must be unique. A series that doesn't exist yet is made.
     """
-    existing = read_data()
+    return _change_data(year, spots, series, must_be_new=True)
+
+
+def update_data(year, spots, series=None):
+    """Set the spots for a year, adding it if it's new.
+
+    A series that doesn't exist yet is made. Returns the row.
+    """
+    return _change_data(year, spots, series)
+
+
+def delete_data(year, series=None):
+    """Delete the row for a year.
+
+    Rows after it move up an id. Returns the deleted row, or None if
+    there's no row for the year.
+    """
+    path = _series_path(series)
+
+    with _file_lock(path, fcntl.LOCK_EX):
+        with _lock:
+            dataset = _get_dataset(path)
+            dataset.refresh()
+
+            row = dataset.get_rows_by_year().get(year)
+
+            if row is not None:
+                dataset.write_change(f'delete,{year}')
+
+            _check_compaction(dataset)
+
+    return row
+
+
+def _change_data(year, spots, series, must_be_new=False):
+    path = _series_path(series, create=True)
+
+    # The whole check and write happens under the lock so another
+    # process can't add the same year in between.
+    with _file_lock(path, fcntl.LOCK_EX):
+        with _lock:
+            dataset = _get_dataset(path)
+            dataset.refresh()
+
+            if must_be_new and year in dataset.index:
+                raise ValueError('year must be unique')
+
+            dataset.write_change(f'put,{year},{spots}')
+            row = dataset.get_rows_by_year()[year]
+
+            _check_compaction(dataset)
+
+    return row
+
+
+def _check_compaction(dataset):
+    """Start compacting in the background if the log is long enough."""
+    if 0 < COMPACT_THRESHOLD <= dataset.log_entries and \
+            dataset.path not in _compacting:
+        _compacting.add(dataset.path)
 
-    if year in (row['year'] for row in existing):
-        raise ValueError('year must be unique')
+        thread = threading.Thread(target=_compact_in_background,
+                                  args=(dataset.path,), daemon=True)
+        thread.start()
 
-    with open(CSV_FILE, 'a') as f:
-        f.write(f'{year},{spots}\n')
 
-    return {'id': len(existing), 'year': year, 'spots': spots}
+def _compact_in_background(path):
+    try:
+        _compact(path)
+    finally:
+        with _lock:
+            _compacting.discard(path)
@@ -0,0 +1,95 @@
+"""Exports of the sunspot data as files.
+
+The API sends rows as CSV a batch at a time, and export jobs write
+those lines into a gzipped CSV file or a Parquet file a chunk at a
+time, so neither side ever holds a whole export in memory at once.
+"""
+
+import gzip
+
+
+# Formats an export can be written in, by the job output that asks for
+# it, with the content type and file extension each one is sent with.
+FORMATS = {
+    'csv': ('application/gzip', '.csv.gz'),
+    'parquet': ('application/vnd.apache.parquet', '.parquet')
+}
+
+CSV_HEADER = 'id,year,spots\n'
+
+# Rows encoded at a time by the API, and written at a time by jobs.
+CSV_BATCH_SIZE = 1000
+CHUNK_ROWS = 10000
+
+
+def iter_csv(rows, batch_size=CSV_BATCH_SIZE):
+    """Yield the rows as CSV text a batch at a time, after a header."""
+    yield CSV_HEADER
+
+    for i in range(0, len(rows), batch_size):
+        yield ''.join(f'{row["id"]},{row["year"]},{row["spots"]}\n'
+                      for row in rows[i:i + batch_size])
+
+
+def write_export(lines, file, output):
+    """Write CSV lines to a binary file.
+
+    The lines are bytes without the header or newlines, like those from
+    iter_lines on a streamed response. The output is the format to
+    write, csv or parquet. Returns the number of rows written.
+    """
+    if output == 'csv':
+        return _write_csv(lines, file)
+    elif output == 'parquet':
+        return _write_parquet(lines, file)
+    else:
+        raise ValueError(f'no export format for output {output}')
+
+
+def _write_csv(lines, file):
+    count = 0
+
+    with gzip.GzipFile(fileobj=file, mode='wb') as f:
+        f.write(CSV_HEADER.encode())
+
+        for line in lines:
+            f.write(line + b'\n')
+            count += 1
+
+    return count
+
+
+def _write_parquet(lines, file):
+    # Only Parquet exports need pyarrow, so it's imported here.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([('id', pa.int64()), ('year', pa.int64()),
+                        ('spots', pa.int64())])
+    count = 0
+
+    with pq.ParquetWriter(file, schema, compression='snappy') as writer:
+        for chunk in _chunks(lines, CHUNK_ROWS):
+            columns = list(zip(*(map(int, line.split(b','))
+                                 for line in chunk)))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(column, pa.int64()) for column in columns],
+                schema=schema
+            ))
+            count += len(chunk)
+
+    return count
+
+
+def _chunks(items, size):
+    chunk = []
+
+    for item in items:
+        chunk.append(item)
+
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
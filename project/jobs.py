@@ -7,24 +7,153 @@ worker).
 """
 
 from datetime import datetime
+import json
+import time
 import uuid
 
-def create_job(redis_client, start=None, end=None, limit=None, offset=None,
-               job_type='line'):
+import msgpack
+
+import registry
+import tracing
+
+
+# The outputs each job type can make, with the one it makes by default
+# first: a PNG plot, the numbers behind the plot as JSON, or an export
+# file of the data.
+JOB_OUTPUTS = {
+    'line': ('plot',),
+    'fun_facts': ('plot',),
+    'histogram': ('plot', 'json'),
+    'box_plot': ('plot', 'json'),
+    'moving_average': ('json',),
+    'smoothing': ('json',),
+    'cycles': ('json',),
+    'export': ('csv', 'parquet')
+}
+
+# Statuses of jobs which won't be worked on any more.
+FINISHED_STATUSES = ('completed', 'failed', 'cancelled', 'timed_out')
+
+# Channel the id of a job is published on whenever its status changes.
+UPDATES_CHANNEL = 'job-updates'
+
+# Seconds a cancellation flag is kept for a job a worker is running.
+CANCEL_TTL = 24 * 60 * 60
+
+# Hash field holding the msgpack encoded job a job was saved with, as
+# the format version followed by the value of each key in order. Jobs
+# saved before it have a plain string field for each key instead. Keys
+# changed since either are in msgpack encoded fields of their own, which
+# are read over the top of the job dict.
+RECORD_FIELD = 'record'
+RECORD_VERSION = 1
+UPDATE_PREFIX = 'updated.'
+
+_JOB_KEYS = ('id', 'status', 'start', 'end', 'limit', 'offset', 'created_at',
+             'last_updated', 'has_plot', 'job_type', 'output', 'attempts',
+             'error', 'trace_id', 'series')
+
+# The job dict keys of the update fields, by the names redis returns,
+# and the fields of jobs saved before records.
+_UPDATE_FIELDS = {
+    (UPDATE_PREFIX + key).encode(): key for key in _JOB_KEYS
+}
+_PLAIN_FIELDS = {key.encode() for key in _JOB_KEYS}
+
+# Moves the jobs in the delayed-jobs sorted set whose retry time has
+# passed onto the new-jobs queue in one atomic step. The earliest jobs
+# are checked one at a time, which fakeredis's scripts can also run.
+_PROMOTE_SCRIPT = """
+local promoted = 0
+for _, job_id in ipairs(redis.call('ZRANGE', KEYS[1], 0,
+                                   tonumber(ARGV[2]) - 1)) do
+    if tonumber(redis.call('ZSCORE', KEYS[1], job_id)) >
+            tonumber(ARGV[1]) then
+        break
+    end
+    redis.call('ZREM', KEYS[1], job_id)
+    redis.call('LPUSH', KEYS[2], job_id)
+    promoted = promoted + 1
+end
+return promoted
+"""
+
+
+def create_job(redis_client, **params):
     """Create a job on Redis with optional data query params.
 
+    The params are the same as for build_job. Returns the job dict.
+    """
+    job_dict = build_job(**params)
+    job_id = job_dict['id']
+    trace = tracing.Trace(job_dict['trace_id'], 'api')
+
+    with trace.span('submit'):
+        _save_job_redis(redis_client, job_id, job_dict)
+        _queue_job_redis(redis_client, job_id)
+        registry.record_arrival(redis_client)
+
+    trace.save(redis_client)
+
+    return job_dict
+
+
+def create_cached_job(redis_client, plot_ref, **params):
+    """Create a job which is already completed with a stored plot.
+
+    This is for queries whose plot was rendered ahead of time, so the
+    job is never queued. The params are the same as for build_job.
     Returns the job dict.
     """
+    job_dict = build_job(**params)
+    job_dict.update(status='completed', has_plot=True)
+    trace = tracing.Trace(job_dict['trace_id'], 'api')
+
+    with trace.span('submit', cached=True):
+        _save_job_redis(redis_client, job_dict['id'], job_dict,
+                        plot_ref=plot_ref)
+
+    trace.save(redis_client)
+
+    return job_dict
+
+
+def build_job(start=None, end=None, limit=None, offset=None, job_type='line',
+              output='plot', series=None):
+    """Return the job dict for a new job without saving it.
+
+    The output is one of JOB_OUTPUTS for the job type. The series is
+    the data series to use, with None for the default one. The job gets
+    a new trace id.
+    """
     job_id = _generate_id()
     time_str = _get_iso_time()
 
-    job_dict = _job_dict(job_id, 'submitted', start, end, limit, offset,
-                         time_str, time_str, False, job_type)
+    return _job_dict(job_id, 'submitted', start, end, limit, offset,
+                     time_str, time_str, False, job_type, output, 0, None,
+                     tracing.new_trace_id(), series)
 
-    _save_job_redis(redis_client, job_id, job_dict)
-    _queue_job_redis(redis_client, job_id)
 
-    return job_dict
+def check_output(job_type, output=None):
+    """Return the output a new job makes.
+
+    A ValueError is raised if the job type doesn't exist or can't make
+    the output. Without an output the job type's default is used.
+    """
+    if job_type not in JOB_OUTPUTS:
+        raise ValueError(f'job_type must be {", ".join(JOB_OUTPUTS)}, or '
+                         'not given (defaulting to line)')
+
+    outputs = JOB_OUTPUTS[job_type]
+
+    if output is None:
+        return outputs[0]
+    elif output not in outputs:
+        raise ValueError(f'output for {job_type} jobs must be '
+                         f'{", ".join(outputs)}, or not given (defaulting '
+                         f'to {outputs[0]})')
+    else:
+        return output
 
 
 def get_all_jobs(redis_client):
@@ -43,7 +172,7 @@ def get_all_jobs(redis_client):
 
     job_hashes = pipe.execute()
 
-    return [_convert_job_hash(job_hash) for job_hash in job_hashes]
+    return [convert_job_hash(job_hash) for job_hash in job_hashes]
 
 
 def get_job(redis_client, job_id):
@@ -51,30 +180,211 @@ def get_job(redis_client, job_id):
 
     Returns None if the job doesn't exist.
     """
-    key = _format_key(job_id)
+    key = format_key(job_id)
     job_hash = redis_client.hgetall(key)
 
     if job_hash:
-        return _convert_job_hash(job_hash)
+        return convert_job_hash(job_hash)
     else:
         return None
 
 
 def get_plot(redis_client, job_id):
-    """Get a plot by its associated job id.
+    """Get a plot stored directly on Redis by its associated job id.
 
-    Returns None if the plot doesn't exist.
+    Only jobs finished before plots were moved to a plot store have
+    these. Returns None if the plot doesn't exist.
     """
-    key = _format_plot_key(job_id)
+    key = format_plot_key(job_id)
     return redis_client.get(key)
 
 
-def get_new_job(redis_client):
+def get_plot_ref(redis_client, job_id):
+    """Get the plot store reference for a job's plot.
+
+    Returns None if the job doesn't have one.
+    """
+    return _get_ref(redis_client, job_id, 'plot_ref')
+
+
+def get_export_ref(redis_client, job_id):
+    """Get the plot store reference for an export job's file.
+
+    Returns None if the job doesn't have one.
+    """
+    return _get_ref(redis_client, job_id, 'export_ref')
+
+
+def get_result(redis_client, job_id):
+    """Get the JSON encoded result of a json output job by its id.
+
+    Returns None if the result doesn't exist.
+    """
+    key = format_result_key(job_id)
+    return redis_client.get(key)
+
+
+def get_dead_jobs(redis_client):
+    """Get all jobs in the dead-letter list, most recent first."""
+    job_ids = redis_client.lrange('dead-jobs', 0, -1)
+
+    pipe = redis_client.pipeline()
+
+    for job_id in job_ids:
+        pipe.hgetall(format_key(job_id.decode()))
+
+    job_hashes = pipe.execute()
+
+    return [convert_job_hash(job_hash) for job_hash in job_hashes
+            if job_hash]
+
+
+def get_new_job(redis_client, timeout=0, worker_id=None):
     """Return the next new job id.
 
-    This function will block until it is returned.
+    This function will block until it is returned, or until the
+    timeout in seconds passes, in which case None is returned. A
+    timeout of 0 blocks forever. With a worker id, the job is moved
+    onto that worker's claimed list in the same step, so it can be
+    queued again if the worker stops before it's done.
+    """
+    if worker_id is None:
+        item = redis_client.brpop('new-jobs', timeout=timeout)
+        job_id = item[1] if item is not None else None
+    else:
+        job_id = redis_client.brpoplpush('new-jobs',
+                                         _format_claimed_key(worker_id),
+                                         timeout=timeout)
+
+    return job_id.decode() if job_id is not None else None
+
+
+def release_job(redis_client, worker_id, job_id):
+    """Take a job a worker is done with off its claimed list."""
+    redis_client.lrem(_format_claimed_key(worker_id), 0, job_id)
+
+
+def requeue_claimed_jobs(redis_client, worker_id):
+    """Queue the jobs a worker claimed but didn't finish again.
+
+    The claimed list is taken in one step, so only one caller queues
+    its jobs even if several try at once, and anything the worker
+    claims from then on goes on a new list. Jobs that finished or are
+    waiting to be retried were only left on it because the worker
+    stopped before releasing them, so they're dropped. Returns the ids
+    queued.
     """
-    return redis_client.brpop('new-jobs')[1].decode()
+    key = _format_claimed_key(worker_id)
+
+    pipe = redis_client.pipeline()
+
+    pipe.lrange(key, 0, -1)
+    pipe.delete(key)
+
+    job_ids = [job_id.decode() for job_id in pipe.execute()[0]]
+    requeued = []
+
+    for job_id in job_ids:
+        job_dict = get_job(redis_client, job_id)
+
+        if job_dict and job_dict['status'] in ('submitted', 'processing'):
+            _update_job_redis(redis_client, job_id, status='submitted')
+            requeued.append(job_id)
+
+    # They go to the front of the queue since they've already waited
+    # their turn. The list is newest first, so the oldest is next.
+    if requeued:
+        redis_client.rpush('new-jobs', *requeued)
+
+    return requeued
+
+
+def get_claiming_workers(redis_client):
+    """Return the ids of the workers with claimed jobs."""
+    prefix = _format_claimed_key('')
+
+    return [key.decode()[len(prefix):]
+            for key in redis_client.scan_iter(match=prefix + '*')]
+
+
+def promote_delayed_jobs(redis_client, batch_size=100):
+    """Queue delayed jobs whose retry time has come.
+
+    Returns the number of jobs queued.
+    """
+    return redis_client.eval(_PROMOTE_SCRIPT, 2, 'delayed-jobs', 'new-jobs',
+                             time.time(), batch_size)
+
+
+def retry_job(redis_client, job_id, attempts, delay, error):
+    """Record a failed attempt and queue the job again after a delay."""
+    pipe = redis_client.pipeline()
+
+    _update_fields(pipe, job_id, status='retrying', attempts=attempts,
+                   error=error, last_updated=_get_iso_time())
+    pipe.zadd('delayed-jobs', time.time() + delay, job_id)
+    pipe.publish(UPDATES_CHANNEL, job_id)
+
+    pipe.execute()
+
+
+def fail_job(redis_client, job_id, attempts, error):
+    """Mark a job as failed for good and add it to the dead-letter list."""
+    _finish_job_redis(redis_client, job_id, {
+        'status': 'failed',
+        'attempts': attempts,
+        'error': error,
+        'last_updated': _get_iso_time()
+    }, dead_letter=True)
+
+
+def replay_job(redis_client, job_id):
+    """Move a job from the dead-letter list back onto the queue.
+
+    The attempts and error are reset so it gets all its retries again.
+    Returns the job dict, or None if the job isn't in the dead-letter
+    list.
+    """
+    if not redis_client.lrem('dead-jobs', 0, job_id):
+        return None
+
+    _update_job_redis(redis_client, job_id, status='submitted', attempts=0,
+                      error=None)
+    _queue_job_redis(redis_client, job_id)
+
+    return get_job(redis_client, job_id)
+
+
+def cancel_job(redis_client, job_id):
+    """Cancel a job which hasn't finished yet.
+
+    Queued and delayed jobs are taken off their queue and cancelled
+    right away. Jobs a worker is running are flagged for cancellation,
+    and the worker stops them the next time it checks. Returns the job
+    dict, or None if the job doesn't exist.
+    """
+    job_dict = get_job(redis_client, job_id)
+
+    if job_dict is None or job_dict['status'] in FINISHED_STATUSES:
+        return job_dict
+
+    pipe = redis_client.pipeline()
+
+    pipe.lrem('new-jobs', 0, job_id)
+    pipe.zrem('delayed-jobs', job_id)
+
+    if any(pipe.execute()):
+        _update_job_redis(redis_client, job_id, status='cancelled')
+    else:
+        # A worker has already claimed the job.
+        redis_client.set(_format_cancel_key(job_id), 1, ex=CANCEL_TTL)
+
+    return get_job(redis_client, job_id)
+
+
+def is_cancelled(redis_client, job_id):
+    """Return whether a job has been flagged for cancellation."""
+    return bool(redis_client.exists(_format_cancel_key(job_id)))
 
 
 def update_status(redis_client, job_id, status):
@@ -82,13 +392,47 @@ def update_status(redis_client, job_id, status):
     _update_job_redis(redis_client, job_id, status=status)
 
 
-def update_plot(redis_client, job_id, plot):
+def update_plot(redis_client, job_id, plot, plot_store):
     """Add a plot to an existing job.
 
-    The plot is stored as a binary separate from the job hash.
+    The plot is saved in the plot store, and only its reference is
+    kept on the job hash.
+    """
+    ref = plot_store.put(plot)
+    _update_job_redis(redis_client, job_id, has_plot=True, plot_ref=ref)
+
+
+def update_export(redis_client, job_id, file, plot_store):
+    """Add the file of an export job to an existing job.
+
+    The file is copied into the plot store, alongside the plots.
     """
-    _save_plot_redis(redis_client, job_id, plot=plot)
-    _update_job_redis(redis_client, job_id, has_plot=True)
+    ref = plot_store.put_file(file)
+    _update_job_redis(redis_client, job_id, export_ref=ref)
+
+
+def update_result(redis_client, job_id, result):
+    """Add the result of a json output job to an existing job.
+
+    The result is stored as compact JSON separate from the job hash.
+    """
+    key = format_result_key(job_id)
+    redis_client.set(key, json.dumps(result, separators=(',', ':')))
+
+
+def encode_job(job_dict, **fields):
+    """Return the hash fields to save a new job with.
+
+    The job dict is kept whole in the record field. Any other fields,
+    like plot_ref, are stored as plain strings.
+    """
+    record = [RECORD_VERSION]
+    record.extend(job_dict[key] for key in _JOB_KEYS)
+
+    job_hash = {RECORD_FIELD: msgpack.packb(record, use_bin_type=True)}
+    job_hash.update((name, str(value)) for name, value in fields.items())
+
+    return job_hash
 
 
 def _get_iso_time():
@@ -102,7 +446,8 @@ def _generate_id():
 
 
 def _job_dict(job_id, status, start, end, limit, offset, created_at,
-              last_updated, has_plot, job_type):
+              last_updated, has_plot, job_type, output, attempts, error,
+              trace_id, series):
     """Returns a dictionary representing a job."""
     return {
         'id': job_id,
@@ -114,48 +459,143 @@ def _job_dict(job_id, status, start, end, limit, offset, created_at,
         'created_at': created_at,
         'last_updated': last_updated,
         'has_plot': has_plot,
-        'job_type': job_type
+        'job_type': job_type,
+        'output': output,
+        'attempts': attempts,
+        'error': error,
+        'trace_id': trace_id,
+        'series': series
     }
 
 
-def _format_key(job_id):
+def format_key(job_id):
     """Format a job id for redis."""
     return f'job.{job_id}'
 
 
-def _format_plot_key(job_id):
+def format_plot_key(job_id):
     """Format a plot key from a job id."""
     return f'plot.{job_id}'
 
 
-def _save_job_redis(redis_client, job_id, job_dict):
+def format_result_key(job_id):
+    """Format a result key from a job id."""
+    return f'result.{job_id}'
+
+
+def _format_cancel_key(job_id):
+    """Format a cancellation flag key from a job id."""
+    return f'cancel.{job_id}'
+
+
+def _format_claimed_key(worker_id):
+    """Format the key of the jobs a worker has claimed."""
+    return f'claimed-jobs.{worker_id}'
+
+
+def _get_ref(redis_client, job_id, field):
+    ref = redis_client.hget(format_key(job_id), field)
+
+    if ref is None or ref == b'None':
+        return None
+    else:
+        return ref.decode()
+
+
+def _save_job_redis(redis_client, job_id, job_dict, **fields):
     """Save a job with a redis client.
 
     This also adds the key to the jobs-key set so it can be looked
     up with all other jobs.
     """
-    key = _format_key(job_id)
+    key = format_key(job_id)
 
     pipe = redis_client.pipeline()
 
     pipe.sadd('job-keys', key)
-    pipe.hmset(key, job_dict)
+    pipe.hmset(key, encode_job(job_dict, **fields))
 
     pipe.execute()
 
 
-def _save_plot_redis(redis_client, job_id, plot):
-    """Save a plot separate from a job."""
-    key = _format_plot_key(job_id)
-    redis_client.set(key, plot)
-
-
 def _update_job_redis(redis_client, job_id, **kwargs):
-    """Update a job dict on Redis."""
-    key = _format_key(job_id)
+    """Update a job dict on Redis.
+
+    Status changes are also published so anything waiting on the job
+    finds out.
+    """
     kwargs.setdefault('last_updated', _get_iso_time())
 
-    redis_client.hmset(key, kwargs)
+    if kwargs.get('status') in FINISHED_STATUSES:
+        _finish_job_redis(redis_client, job_id, kwargs)
+        return
+
+    pipe = redis_client.pipeline()
+
+    _update_fields(pipe, job_id, **kwargs)
+
+    if 'status' in kwargs:
+        pipe.publish(UPDATES_CHANNEL, job_id)
+
+    pipe.execute()
+
+
+def _finish_job_redis(redis_client, job_id, fields, dead_letter=False):
+    """Update a job with the fields that finish it.
+
+    Finished jobs are read far more often than they change, so all the
+    updates to the job are folded back into its record, which also
+    moves jobs saved before records over to them. The job can be added
+    to the dead-letter list in the same transaction.
+    """
+    key = format_key(job_id)
+
+    def finish(pipe):
+        job_hash = pipe.hgetall(key)
+        pipe.multi()
+
+        if job_hash:
+            job_dict = convert_job_hash(job_hash)
+            job_dict.update((name, value) for name, value in fields.items()
+                            if name in _JOB_KEYS)
+            stale = [field for field in job_hash
+                     if field in _UPDATE_FIELDS or field in _PLAIN_FIELDS]
+
+            if stale:
+                pipe.hdel(key, *stale)
+
+            pipe.hmset(key, encode_job(job_dict, **{
+                name: value for name, value in fields.items()
+                if name not in _JOB_KEYS
+            }))
+        else:
+            _update_fields(pipe, job_id, **fields)
+
+        if dead_letter:
+            pipe.lpush('dead-jobs', job_id)
+
+        pipe.publish(UPDATES_CHANNEL, job_id)
+
+    redis_client.transaction(finish, key)
+
+
+def _update_fields(pipe, job_id, **fields):
+    """Add setting fields of a job to a pipeline.
+
+    Keys of the job dict go in their update fields, so they're the same
+    for jobs in either format. Other fields, like plot_ref, are plain
+    strings.
+    """
+    job_hash = {}
+
+    for name, value in fields.items():
+        if name in _JOB_KEYS:
+            packed = msgpack.packb(value, use_bin_type=True)
+            job_hash[UPDATE_PREFIX + name] = packed
+        else:
+            job_hash[name] = str(value)
+
+    pipe.hmset(format_key(job_id), job_hash)
 
 
 def _queue_job_redis(redis_client, key):
@@ -163,12 +603,41 @@ def _queue_job_redis(redis_client, key):
     redis_client.lpush('new-jobs', key)
 
 
-def _convert_job_hash(job_hash):
+def convert_job_hash(job_hash):
     """Convert a job hash to a job dict."""
-    _redis_string = lambda value: value.decode() if value != b'None' else None
-    _redis_number = lambda value: int(value) if value != b'None' else None
-    _redis_boolean = lambda value: value == b'True'
+    record = job_hash.get(b'record')
+
+    if record is not None:
+        job_dict = _convert_record(msgpack.unpackb(record, raw=False))
+    else:
+        job_dict = _convert_plain_hash(job_hash)
+
+    # Finished jobs have had their updates folded into the record, so
+    # they're only looked for when there are other fields.
+    if len(job_hash) > 1:
+        for field, value in job_hash.items():
+            key = _UPDATE_FIELDS.get(field)
+
+            if key is not None:
+                job_dict[key] = msgpack.unpackb(value, raw=False)
+
+    return job_dict
 
+
+def _convert_record(record):
+    """Convert an unpacked record to a job dict by its format version."""
+    if isinstance(record, dict):
+        # Records were packed job dicts before they had a version.
+        return record
+    elif record[0] == RECORD_VERSION:
+        return dict(zip(_JOB_KEYS, record[1:]))
+    else:
+        raise ValueError(f'job record version {record[0]} is newer than '
+                         f'this service reads')
+
+
+def _convert_plain_hash(job_hash):
+    """Convert a job hash saved before records to a job dict."""
     return _job_dict(
         _redis_string(job_hash[b'id']),
         _redis_string(job_hash[b'status']),
@@ -179,5 +648,23 @@ def _convert_job_hash(job_hash):
         _redis_string(job_hash[b'created_at']),
         _redis_string(job_hash[b'last_updated']),
         _redis_boolean(job_hash[b'has_plot']),
-        _redis_string(job_hash[b'job_type'])
+        _redis_string(job_hash[b'job_type']),
+        # Jobs made before these fields existed don't have them.
+        _redis_string(job_hash.get(b'output', b'plot')),
+        _redis_number(job_hash.get(b'attempts', b'0')),
+        _redis_string(job_hash.get(b'error', b'None')),
+        _redis_string(job_hash.get(b'trace_id', b'None')),
+        _redis_string(job_hash.get(b'series', b'None'))
     )
+
+
+def _redis_string(value):
+    return value.decode() if value != b'None' else None
+
+
+def _redis_number(value):
+    return int(value) if value != b'None' else None
+
+
+def _redis_boolean(value):
+    return value == b'True'
@@ -0,0 +1,150 @@
+"""Stores for the plot files made by jobs.
+
+Plots are content addressed: each one is saved under the SHA-256 hash
+of its bytes, and a job only keeps that hash as a reference. Since a
+reference always points at the same bytes it doubles as a strong ETag,
+and identical plots are only stored once.
+"""
+
+import hashlib
+import io
+import os
+import re
+import tempfile
+
+
+_REF_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+# Bytes copied at a time when storing a file.
+CHUNK_SIZE = 1024 * 1024
+
+
+def from_env(redis_client):
+    """Return the plot store configured by the environment.
+
+    Plots are kept on local disk under PLOT_STORE_DIR when it's set,
+    and otherwise in Redis with the given client.
+    """
+    root = os.environ.get('PLOT_STORE_DIR')
+
+    if root:
+        return LocalPlotStore(root)
+    else:
+        return RedisPlotStore(redis_client)
+
+
+def content_ref(data):
+    """Return the reference a plot is stored under."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class LocalPlotStore:
+    """Keeps plots as files in a directory, sharded by hash prefix."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def put(self, data):
+        """Save a plot if it isn't stored yet and return its reference."""
+        ref = content_ref(data)
+        path = self.path(ref)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # Writing to a temporary file first so readers never see a
+            # partially written plot.
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+        return ref
+
+    def put_file(self, file):
+        """Save a file a chunk at a time and return its reference.
+
+        This is for large files like exports, which are hashed as they
+        are copied instead of being read into memory.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root)
+        digest = hashlib.sha256()
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+
+            ref = digest.hexdigest()
+            path = self.path(ref)
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        return ref
+
+    def open(self, ref):
+        """Open a stored plot for reading.
+
+        Returns None if the plot doesn't exist.
+        """
+        try:
+            return open(self.path(ref), 'rb')
+        except FileNotFoundError:
+            return None
+
+    def path(self, ref):
+        """Return the file path of a plot reference."""
+        if not _REF_PATTERN.match(ref):
+            raise ValueError(f'invalid plot reference {ref}')
+
+        return os.path.join(self.root, ref[:2], ref)
+
+
+class RedisPlotStore:
+    """Keeps plots as Redis strings keyed by their hash."""
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+
+    def put(self, data):
+        """Save a plot and return its reference."""
+        ref = content_ref(data)
+        self.redis_client.set(format_blob_key(ref), data)
+
+        return ref
+
+    def put_file(self, file):
+        """Save a file and return its reference.
+
+        Redis only takes whole values, so the file is read into memory.
+        """
+        return self.put(file.read())
+
+    def open(self, ref):
+        """Open a stored plot for reading.
+
+        Returns None if the plot doesn't exist.
+        """
+        data = self.redis_client.get(format_blob_key(ref))
+
+        if data is None:
+            return None
+        else:
+            return io.BytesIO(data)
+
+
+def format_blob_key(ref):
+    """Format a plot reference for redis."""
+    return f'blob.{ref}'
@@ -0,0 +1,131 @@
+"""Sampled profiling of API requests, dumped to files for later analysis.
+
+Requests can be profiled with cProfile, which records every function
+call, or with a stack sampler, which looks at the request's stack every
+few milliseconds and is cheap enough to leave on for a share of real
+traffic. cProfile output can be read with pstats or snakeviz, and the
+stack samples are written in the folded format flamegraph tools take.
+"""
+
+import cProfile
+from collections import Counter
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+
+# Directory the profiles are written to, which also turns profiling
+# on, the percentage of requests to profile, and how those requests are
+# profiled (cprofile or stack).
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '')
+PROFILE_SAMPLE_PERCENT = float(os.environ.get('PROFILE_SAMPLE_PERCENT', '0'))
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'cprofile')
+
+# Seconds between samples of the stack.
+STACK_SAMPLE_INTERVAL = 0.005
+
+MODES = ('cprofile', 'stack')
+
+
+def choose_mode(requested=None):
+    """Return how to profile a request, or None to not profile it.
+
+    A request can ask for a mode itself, and otherwise a sample of
+    requests are profiled. Nothing is profiled unless PROFILE_DIR is
+    set.
+    """
+    if not PROFILE_DIR:
+        return None
+    elif requested in MODES:
+        return requested
+    elif random.random() * 100 < PROFILE_SAMPLE_PERCENT:
+        return PROFILE_MODE
+    else:
+        return None
+
+
+def start(mode):
+    """Start profiling the current thread and return the profiler."""
+    if mode == 'cprofile':
+        profiler = _CallProfiler()
+    else:
+        profiler = _StackSampler(threading.get_ident())
+
+    profiler.start()
+
+    return profiler
+
+
+def stop(profiler, label):
+    """Stop a profiler and write its profile to PROFILE_DIR.
+
+    The label, like the request's method and route, goes in the file
+    name. Returns the path of the profile.
+    """
+    profiler.stop()
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+
+    timestamp = time.strftime('%Y%m%dT%H%M%S')
+    filename = (f'{timestamp}-{label}-{uuid.uuid4().hex[:8]}'
+                f'{profiler.extension}')
+    path = os.path.join(PROFILE_DIR, filename)
+
+    profiler.dump(path)
+
+    return path
+
+
+class _CallProfiler:
+    extension = '.prof'
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    def dump(self, path):
+        self._profile.dump_stats(path)
+
+
+class _StackSampler:
+    extension = '.folded'
+
+    def __init__(self, thread_id):
+        self._thread_id = thread_id
+        self._stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+    def _sample(self):
+        while not self._stopped.wait(STACK_SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self._thread_id)
+            names = []
+
+            while frame is not None:
+                code = frame.f_code
+                names.append(f'{os.path.basename(code.co_filename)}:'
+                             f'{code.co_name}')
+                frame = frame.f_back
+
+            if names:
+                self._stacks[';'.join(reversed(names))] += 1
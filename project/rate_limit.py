@@ -0,0 +1,159 @@
+"""Per-client rate limits and load shedding with token buckets on Redis.
+
+Each client gets a bucket per route class which refills at a steady
+rate up to a burst size, and every request takes a token from it. The
+refill, the take and, for routes which queue jobs, the check of the
+queue depth happen in one script call so they're atomic across every
+API process.
+
+The Flask API calls check with its redis client. The async server
+runs the same script through its own client, using script_args and
+parse_result around the call.
+"""
+
+from collections import namedtuple
+import os
+import time
+
+
+# Limits per route class, written like jobs=0.5:10,default=20:100 where
+# the first number is the tokens added per second and the second is the
+# most a bucket can hold. Route classes that aren't listed aren't
+# limited, and they're all left unlimited unless it's set, since behind
+# a proxy every client shares the proxy's address and bucket.
+RATE_LIMITS = {
+    route_class: tuple(float(n) for n in limit.split(':'))
+    for route_class, limit in (
+        item.split('=') for item in
+        os.environ.get('RATE_LIMITS', '').split(',')
+        if item
+    )
+}
+
+# Depth of the new jobs queue at which requests that add to it are
+# turned away (0 to never turn them away), and the seconds those
+# clients are told to wait before trying again.
+SHED_QUEUE_DEPTH = int(os.environ.get('SHED_QUEUE_DEPTH', '10000'))
+SHED_RETRY_AFTER = int(os.environ.get('SHED_RETRY_AFTER', '30'))
+
+# Takes tokens from a bucket after refilling it for the time since it
+# was last used, or only checks the queue when the rate is 0. Returns
+# whether the request is allowed (-1 when it was shed because of the
+# queue), the whole tokens left, and the seconds until a token is
+# available and until the bucket is full again.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local shed_depth = tonumber(ARGV[4])
+
+if shed_depth > 0 and redis.call('LLEN', KEYS[2]) >= shed_depth then
+    return {-1, 0, 0, 0}
+end
+
+if rate <= 0 then
+    return {1, 0, 0, 0}
+end
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+
+local allowed = 0
+local retry_after = 0
+
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = math.ceil((1 - tokens) / rate)
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tokens)
+redis.call('HSET', KEYS[1], 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+
+return {allowed, math.floor(tokens), retry_after,
+        math.ceil((burst - tokens) / rate)}
+"""
+
+# What a request is allowed to do. Shed requests weren't counted
+# against the client's limit.
+Decision = namedtuple(
+    'Decision', ['allowed', 'shed', 'limit', 'remaining', 'retry_after',
+                 'reset']
+)
+
+
+def check(redis_client, client, route_class, shed=False):
+    """Take a token for a client's request to a class of routes.
+
+    With shed, the request is turned away when the new jobs queue is
+    too deep. Returns None if the request isn't checked.
+    """
+    if not is_checked(route_class, shed):
+        return None
+
+    keys, args = script_args(client, route_class, shed)
+    result = redis_client.eval(TOKEN_BUCKET_SCRIPT, len(keys), *keys, *args)
+
+    return parse_result(result, route_class)
+
+
+def is_checked(route_class, shed=False):
+    """Return whether requests to a class of routes are checked at all.
+
+    Unlimited routes are still checked when they can be shed.
+    """
+    return route_class in RATE_LIMITS or (shed and SHED_QUEUE_DEPTH > 0)
+
+
+def script_args(client, route_class, shed=False):
+    """Return the keys and args to run the token bucket script with."""
+    rate, burst = RATE_LIMITS.get(route_class, (0, 0))
+    shed_depth = SHED_QUEUE_DEPTH if shed else 0
+
+    keys = [format_bucket_key(client, route_class), 'new-jobs']
+    args = [rate, burst, time.time(), shed_depth]
+
+    return keys, args
+
+
+def parse_result(result, route_class):
+    """Turn the token bucket script's result into a Decision.
+
+    Returns None for requests to unlimited routes that weren't shed.
+    """
+    allowed, remaining, retry_after, reset = (int(n) for n in result)
+    _, burst = RATE_LIMITS.get(route_class, (0, 0))
+
+    if allowed == -1:
+        return Decision(False, True, int(burst), None, SHED_RETRY_AFTER,
+                        None)
+    elif route_class not in RATE_LIMITS:
+        return None
+    else:
+        return Decision(allowed == 1, False, int(burst), remaining,
+                        retry_after, reset)
+
+
+def get_headers(decision):
+    """Return the response headers describing a decision."""
+    headers = {}
+
+    if not decision.shed:
+        headers['X-RateLimit-Limit'] = str(decision.limit)
+        headers['X-RateLimit-Remaining'] = str(decision.remaining)
+        headers['X-RateLimit-Reset'] = str(decision.reset)
+
+    if not decision.allowed:
+        headers['Retry-After'] = str(decision.retry_after)
+
+    return headers
+
+
+def format_bucket_key(client, route_class):
+    """Format a client's bucket for a route class for redis."""
+    return f'rate.{route_class}.{client}'
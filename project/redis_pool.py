@@ -0,0 +1,86 @@
+"""Per-process Redis clients backed by a bounded connection pool.
+
+Connections can't be shared between forked processes, so each process
+lazily makes its own client the first time it asks for one. Threads in
+the same process share its pool, waiting for a free connection when
+all of them are in use.
+
+The API and the worker both make their clients here, so they share the
+pool size, timeouts and reply parser settings.
+"""
+
+import os
+import threading
+
+import redis
+
+import timing
+
+
+# Most connections a process keeps open, and how many seconds a thread
+# waits for one of them before giving up.
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', '50'))
+REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', '5'))
+
+# Seconds to wait for a connection to be made and for the reply to a
+# command, which has to be longer than any command blocks for.
+REDIS_CONNECT_TIMEOUT = float(os.environ.get('REDIS_CONNECT_TIMEOUT', '5'))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', '30'))
+
+# Whether replies are parsed with hiredis when it's installed, which is
+# much faster than the pure Python parser for large replies.
+REDIS_HIREDIS = os.environ.get('REDIS_HIREDIS', '1') == '1'
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+
+def get_client():
+    """Return this process's redis client, making it if needed."""
+    global _client, _client_pid
+
+    with _lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = create_client(connection_class=_TimedConnection)
+            _client_pid = os.getpid()
+
+        return _client
+
+
+def create_client(connection_class=redis.Connection):
+    """Return a new redis client with its own connection pool.
+
+    Pools notice when they're used from a forked process and make new
+    connections there, so a client can be made before forking.
+    """
+    if REDIS_HIREDIS and redis.connection.HIREDIS_AVAILABLE:
+        parser_class = redis.connection.HiredisParser
+    else:
+        parser_class = redis.connection.PythonParser
+
+    pool = redis.BlockingConnectionPool(
+        host=os.environ['REDIS_HOST'],
+        port=os.environ['REDIS_PORT'],
+        db=os.environ['REDIS_DB'],
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        parser_class=parser_class,
+        connection_class=connection_class
+    )
+
+    return redis.StrictRedis(connection_pool=pool)
+
+
+class _TimedConnection(redis.Connection):
+    """A connection which counts its time against the current request."""
+
+    def send_packed_command(self, *args, **kwargs):
+        with timing.phase('redis'):
+            return super().send_packed_command(*args, **kwargs)
+
+    def read_response(self, *args, **kwargs):
+        with timing.phase('redis'):
+            return super().read_response(*args, **kwargs)
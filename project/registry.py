@@ -0,0 +1,254 @@
+"""Functions for tracking workers and how many of them are needed.
+
+Each worker process keeps a hash on Redis with its current jobs and
+throughput counters, kept alive by heartbeats. A worker's hash expires
+soon after its heartbeats stop, so only live workers are ever listed.
+
+A worker container (a replica) can run several forked worker
+processes, which share its host name, so the scaling signal counts
+replicas by host name rather than processes.
+"""
+
+from datetime import datetime
+import json
+import math
+import os
+import socket
+import time
+
+
+# Seconds between heartbeats, and how long a worker is kept without
+# one before it's considered gone.
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TTL = 3 * HEARTBEAT_INTERVAL
+
+# Job arrivals are counted per minute, and the arrival rate is averaged
+# over this many of the latest minutes.
+ARRIVAL_WINDOW_MINUTES = 5
+ARRIVALS_TTL = (ARRIVAL_WINDOW_MINUTES + 1) * 60
+
+
+def make_worker_id():
+    """Return an id for this worker process that's unique in the swarm."""
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def get_worker_host(worker_id):
+    """Return the host name of the container a worker process runs in."""
+    return worker_id.rsplit('-', 1)[0]
+
+
+def register_worker(redis_client, worker_id, concurrency):
+    """Add a worker to the registry with its counters at zero."""
+    key = _format_key(worker_id)
+    time_str = datetime.utcnow().isoformat()
+
+    pipe = redis_client.pipeline()
+
+    pipe.sadd('workers', worker_id)
+    pipe.hmset(key, {
+        'id': worker_id,
+        'concurrency': concurrency,
+        'started_at': time_str,
+        'last_heartbeat': time_str,
+        'current_jobs': '[]',
+        'jobs_completed': 0,
+        'jobs_failed': 0,
+        'job_seconds': 0
+    })
+    pipe.expire(key, HEARTBEAT_TTL)
+
+    pipe.execute()
+
+
+def heartbeat(redis_client, worker_id):
+    """Mark a worker as still alive.
+
+    Returns False if the worker had already expired, in which case it
+    has to register again.
+    """
+    key = _format_key(worker_id)
+
+    pipe = redis_client.pipeline()
+
+    pipe.expire(key, HEARTBEAT_TTL)
+    pipe.hset(key, 'last_heartbeat', datetime.utcnow().isoformat())
+
+    alive, _ = pipe.execute()
+
+    return bool(alive)
+
+
+def update_current_jobs(redis_client, worker_id, job_ids):
+    """Set the ids of the jobs a worker is running."""
+    key = _format_key(worker_id)
+
+    pipe = redis_client.pipeline()
+
+    pipe.hset(key, 'current_jobs', json.dumps(sorted(job_ids)))
+    pipe.expire(key, HEARTBEAT_TTL)
+
+    pipe.execute()
+
+
+def record_job(redis_client, worker_id, succeeded, seconds):
+    """Count a job a worker finished and how long it took."""
+    key = _format_key(worker_id)
+
+    pipe = redis_client.pipeline()
+
+    pipe.hincrby(key, 'jobs_completed' if succeeded else 'jobs_failed', 1)
+    pipe.hincrbyfloat(key, 'job_seconds', seconds)
+    pipe.expire(key, HEARTBEAT_TTL)
+
+    pipe.execute()
+
+
+def unregister_worker(redis_client, worker_id):
+    """Remove a worker from the registry."""
+    pipe = redis_client.pipeline()
+
+    pipe.srem('workers', worker_id)
+    pipe.delete(_format_key(worker_id))
+
+    pipe.execute()
+
+
+def get_workers(redis_client):
+    """Get all live workers.
+
+    Workers whose hash has expired are dropped from the registry.
+    """
+    worker_ids = redis_client.smembers('workers')
+
+    pipe = redis_client.pipeline()
+
+    for worker_id in worker_ids:
+        pipe.hgetall(_format_key(worker_id.decode()))
+
+    worker_hashes = pipe.execute()
+    gone = [worker_id for worker_id, worker_hash
+            in zip(worker_ids, worker_hashes) if not worker_hash]
+
+    if gone:
+        redis_client.srem('workers', *gone)
+
+    return [_convert_worker_hash(worker_hash)
+            for worker_hash in worker_hashes if worker_hash]
+
+
+def record_arrival(redis_client):
+    """Count a new job towards the arrival rate."""
+    key = current_arrivals_key()
+
+    pipe = redis_client.pipeline()
+
+    pipe.incr(key)
+    pipe.expire(key, ARRIVALS_TTL)
+
+    pipe.execute()
+
+
+def current_arrivals_key():
+    """Return the key new jobs are counted under this minute."""
+    return _format_arrivals_key(int(time.time() // 60))
+
+
+def get_arrival_rate(redis_client):
+    """Return the average number of new jobs per second lately.
+
+    The current minute isn't finished yet, so it's left out.
+    """
+    minute = int(time.time() // 60)
+    keys = [_format_arrivals_key(minute - i)
+            for i in range(1, ARRIVAL_WINDOW_MINUTES + 1)]
+
+    counts = redis_client.mget(keys)
+
+    return sum(int(count) for count in counts if count) / \
+        (ARRIVAL_WINDOW_MINUTES * 60)
+
+
+def scaling_signal(redis_client, target_drain_seconds=60, headroom=1.2,
+                   min_replicas=1, max_replicas=20):
+    """Work out how many worker replicas the current load needs.
+
+    Keeping up with new jobs takes about arrival rate x mean job time
+    job slots (Little's law), and clearing the backlog within the
+    target drain time takes queue depth x mean job time / target drain
+    time more. The total, with some headroom, is divided by the mean
+    job slots of a replica, counting all its worker processes, to get
+    a number of replicas.
+    """
+    workers = get_workers(redis_client)
+    queue_depth = redis_client.llen('new-jobs')
+    arrival_rate = get_arrival_rate(redis_client)
+
+    completed = sum(worker['jobs_completed'] + worker['jobs_failed']
+                    for worker in workers)
+    job_seconds = sum(worker['job_seconds'] for worker in workers)
+    mean_job_seconds = job_seconds / completed if completed else None
+
+    # Forked worker processes in the same container share its host.
+    replicas = {get_worker_host(worker['id']) for worker in workers
+                if worker['id']}
+
+    if workers:
+        concurrency = sum(worker['concurrency'] for worker in workers) / \
+            max(len(replicas), 1)
+    else:
+        concurrency = 1
+
+    if mean_job_seconds is None:
+        # Without any finished jobs to go on, keep what's running unless
+        # there's work waiting and nothing to do it.
+        desired = max(len(replicas), 1 if queue_depth else 0)
+    else:
+        slots = (arrival_rate * mean_job_seconds +
+                 queue_depth * mean_job_seconds / target_drain_seconds)
+        desired = math.ceil(slots * headroom / concurrency)
+
+    return {
+        'live_workers': len(workers),
+        'live_replicas': len(replicas),
+        'busy_workers': sum(1 for worker in workers
+                            if worker['current_jobs']),
+        'queue_depth': queue_depth,
+        'arrival_rate': arrival_rate,
+        'mean_job_seconds': mean_job_seconds,
+        'desired_replicas': min(max(desired, min_replicas), max_replicas)
+    }
+
+
+def _format_key(worker_id):
+    """Format a worker id for redis."""
+    return f'worker.{worker_id}'
+
+
+def _format_arrivals_key(minute):
+    """Format a key for the arrival count in a minute since the epoch."""
+    return f'arrivals.{minute}'
+
+
+def _decode(value):
+    """Decode a redis string which might be missing."""
+    return value.decode() if value is not None else None
+
+
+def _convert_worker_hash(worker_hash):
+    """Convert a worker hash to a worker dict.
+
+    Counters written just as a worker expired can leave a partial hash
+    behind, so missing fields get defaults.
+    """
+    return {
+        'id': _decode(worker_hash.get(b'id')),
+        'concurrency': int(worker_hash.get(b'concurrency', 1)),
+        'started_at': _decode(worker_hash.get(b'started_at')),
+        'last_heartbeat': _decode(worker_hash.get(b'last_heartbeat')),
+        'current_jobs': json.loads(worker_hash.get(b'current_jobs', b'[]')
+                                   .decode()),
+        'jobs_completed': int(worker_hash.get(b'jobs_completed', 0)),
+        'jobs_failed': int(worker_hash.get(b'jobs_failed', 0)),
+        'job_seconds': float(worker_hash.get(b'job_seconds', 0))
+    }
@@ -0,0 +1,253 @@
+"""Rendering job plots with matplotlib's object-oriented API.
+
+Plots are drawn straight onto Agg canvases instead of through pyplot,
+so rendering doesn't share any global state and can happen on several
+threads at once. Each thread keeps a figure template per job type with
+the axes, titles and labels already built, and only the data artists
+are swapped out between jobs.
+"""
+
+import io
+import os
+import random
+import threading
+
+import matplotlib
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+
+TXT_FILE = os.path.join(os.path.dirname(__file__), 'fun_facts.txt')
+
+JOB_TYPES = ('line', 'fun_facts', 'histogram', 'box_plot')
+
+# Possible units of conversion for # of sunspots.
+UNITS = [{'Name': 'bakers dozens', 'Units': 1 / 13},
+         {'Name': 'dozens', 'Units': 1 / 12},
+         {'Name': 'scores', 'Units': 1 / 20},
+         {'Name': 'grosses', 'Units': 1 / 144},
+         {'Name': 'googols', 'Units': 10 ** (-100)}]
+
+# Box plots are laid out sideways, which vert=False did before
+# matplotlib 3.10 deprecated it for orientation.
+if tuple(map(int, matplotlib.__version__.split('.')[:2])) >= (3, 10):
+    _HORIZONTAL_BOX_PLOT = {'orientation': 'horizontal'}
+else:
+    _HORIZONTAL_BOX_PLOT = {'vert': False}
+
+# Templates are kept per thread so figures are never shared.
+_local = threading.local()
+
+_fun_facts = None
+
+
+def render_plot(data, job_type):
+    """Render a plot of the data rows and return it as PNG bytes."""
+    return get_template(job_type).render(data)
+
+
+def get_template(job_type):
+    """Return this thread's figure template for a job type."""
+    templates = getattr(_local, 'templates', None)
+
+    if templates is None:
+        templates = _local.templates = {}
+
+    if job_type not in templates:
+        templates[job_type] = _TEMPLATE_CLASSES[job_type]()
+
+    return templates[job_type]
+
+
+def discard_template(job_type):
+    """Throw away this thread's template for a job type.
+
+    A fresh one is built for the next plot, which is needed when a
+    render was interrupted and left the figure in an unknown state.
+    """
+    getattr(_local, 'templates', {}).pop(job_type, None)
+
+
+def warm_up():
+    """Build every template and render a throwaway plot with each.
+
+    This loads the fonts and the backend so the first real job doesn't
+    pay for it.
+    """
+    load_fun_facts()
+
+    data = [{'id': 0, 'year': 0, 'spots': 0},
+            {'id': 1, 'year': 1, 'spots': 1}]
+
+    for job_type in JOB_TYPES:
+        render_plot(data, job_type)
+
+
+def load_fun_facts():
+    """Return all fun facts, reading them from the file only once."""
+    global _fun_facts
+
+    if _fun_facts is None:
+        fun_data = []
+
+        # The first four lines are the sources and a blank line.
+        with open(TXT_FILE, 'r') as f:
+            for i, line in enumerate(f):
+                if i > 3:
+                    fun_data.append(line)
+
+        _fun_facts = fun_data
+
+    return _fun_facts
+
+
+def read_fun_data():
+    """Return a random fun fact."""
+    return random.choice(load_fun_facts())
+
+
+class _Template:
+    """A figure with its fixed decorations that plots can be swapped on."""
+
+    title = None
+    xlabel = None
+    ylabel = None
+
+    def __init__(self):
+        self.figure = Figure()
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot(111)
+
+        self.axes.set_title(self.title)
+        self.axes.set_xlabel(self.xlabel)
+
+        if self.ylabel is not None:
+            self.axes.set_ylabel(self.ylabel)
+
+        # Artists (or containers of them) added for the current plot
+        # which are removed before the next one is drawn.
+        self._artists = []
+
+    def render(self, data):
+        """Draw the data rows on the figure and return the PNG bytes."""
+        self._draw(data)
+
+        file = io.BytesIO()
+        self.canvas.print_png(file)
+
+        return file.getvalue()
+
+    def _draw(self, data):
+        raise NotImplementedError
+
+    def _replace_artists(self, artists):
+        for artist in self._artists:
+            artist.remove()
+
+        self._artists = list(artists)
+
+
+class _LineTemplate(_Template):
+
+    title = 'Line Graph of Sunspots'
+    xlabel = 'Year'
+    ylabel = 'Number of Spots'
+
+    def __init__(self):
+        super().__init__()
+        self.line, = self.axes.plot([], [], color='red')
+
+    def _draw(self, data):
+        self.line.set_data([row['year'] for row in data],
+                           [row['spots'] for row in data])
+        self.axes.relim()
+        self.axes.autoscale_view()
+
+
+class _FunTemplate(_Template):
+
+    title = 'Fun Graph of Sunspots'
+    xlabel = 'Year'
+    ylabel = 'Number of Spots'
+
+    def __init__(self):
+        super().__init__()
+        self.line, = self.axes.plot([], [])
+        self.axes.grid(True)
+
+        # Define properties of box surrounding fun fact.
+        bbox_props = dict(boxstyle='round,pad=0.3', fc='cyan',
+                          ec='b', lw=2, alpha=0.5)
+        self.text = self.axes.text(0, 0, '', bbox=bbox_props, wrap=True)
+
+    def _draw(self, data):
+        spots = [row['spots'] for row in data]
+        year = [row['year'] for row in data]
+
+        unit = random.choice(UNITS)
+
+        # Create the fun fact string.
+        fun_fact = ('Did you know?\n\n' +
+                    read_fun_data() +
+                    '\n\n'
+                    'The maximum number of spots during this time period'
+                    'was equal to  ' +
+                    str(max(spots) * unit['Units']) +
+                    ' ' +
+                    unit['Name'] + '.')
+
+        self.line.set_data(year, spots)
+        self.axes.axis([min(year), max(year), min(spots), max(spots)])
+
+        self.text.set_text(fun_fact)
+        self.text.set_position((year[0], max(spots) * 0.6))
+
+
+class _HistogramTemplate(_Template):
+
+    title = 'Histogram of Sunspots'
+    xlabel = 'Number of Spots in a Year'
+    ylabel = 'Frequency'
+
+    def _draw(self, data):
+        spots = [row['spots'] for row in data]
+
+        # The bars are rebuilt each time since the bins change, so the
+        # old ones are removed before the limits are recalculated.
+        self._replace_artists([])
+        self.axes.relim()
+
+        # Removing the bar container takes its patches with it, and
+        # takes it off the axes' containers.
+        _, _, bars = self.axes.hist(spots, bins=15, color='red')
+        self._replace_artists([bars])
+
+        self.axes.relim()
+        self.axes.autoscale_view()
+
+
+class _BoxPlotTemplate(_Template):
+
+    title = 'Box Plot of Sunspots'
+    xlabel = 'Number of Sunspots in One Year'
+
+    def _draw(self, data):
+        spots = [row['spots'] for row in data]
+
+        self._replace_artists([])
+        self.axes.relim()
+
+        parts = self.axes.boxplot(spots, **_HORIZONTAL_BOX_PLOT)
+        self._replace_artists(artist for artists in parts.values()
+                              for artist in artists)
+
+        self.axes.relim()
+        self.axes.autoscale_view()
+
+
+_TEMPLATE_CLASSES = {
+    'line': _LineTemplate,
+    'fun_facts': _FunTemplate,
+    'histogram': _HistogramTemplate,
+    'box_plot': _BoxPlotTemplate
+}
@@ -0,0 +1,70 @@
+"""Summary statistics behind the histogram and box plot jobs.
+
+These are computed with NumPy so jobs which only want the numbers
+don't need to render a plot.
+"""
+
+import numpy as np
+
+
+HISTOGRAM_BINS = 15
+
+# How far the box plot whiskers reach past the quartiles, as a multiple
+# of the interquartile range (the same as matplotlib's default).
+WHISKER_RANGE = 1.5
+
+
+def compute_stats(data, job_type):
+    """Return the statistics for a job type over the data rows."""
+    spots = np.fromiter((row['spots'] for row in data), dtype=np.int64,
+                        count=len(data))
+
+    if job_type == 'histogram':
+        return histogram_stats(spots)
+    elif job_type == 'box_plot':
+        return box_plot_stats(spots)
+    else:
+        raise ValueError(f'no statistics for job type {job_type}')
+
+
+def histogram_stats(spots, bins=HISTOGRAM_BINS):
+    """Return the bin counts and edges of a histogram of the spots."""
+    counts, edges = np.histogram(spots, bins=bins)
+
+    return {
+        'count': int(len(spots)),
+        'counts': counts.tolist(),
+        'edges': edges.tolist()
+    }
+
+
+def box_plot_stats(spots, whis=WHISKER_RANGE):
+    """Return the quartiles, whiskers and outliers of the spots.
+
+    The whiskers end at the most extreme values within whis times the
+    interquartile range from the quartiles, and anything past them is
+    an outlier.
+    """
+    spots = np.asarray(spots)
+
+    if len(spots) == 0:
+        raise ValueError('statistics need at least one row of data')
+
+    q1, median, q3 = np.percentile(spots, [25, 50, 75])
+    iqr = q3 - q1
+
+    inside = (spots >= q1 - whis * iqr) & (spots <= q3 + whis * iqr)
+    outliers = np.sort(spots[~inside])
+
+    return {
+        'count': int(len(spots)),
+        'mean': float(spots.mean()),
+        'min': int(spots.min()),
+        'max': int(spots.max()),
+        'q1': float(q1),
+        'median': float(median),
+        'q3': float(q3),
+        'whisker_low': int(spots[inside].min()),
+        'whisker_high': int(spots[inside].max()),
+        'outliers': outliers.tolist()
+    }
@@ -0,0 +1,79 @@
+"""Timing of the phases each API request spends its time in.
+
+A timer is started for the request a thread is handling, and code along
+the way marks phases like parsing the CSV file or talking to Redis with
+the phase context manager. Phases outside of a timed request cost next
+to nothing, so the rest of the code doesn't need to know whether timing
+is turned on.
+"""
+
+from collections import OrderedDict
+import contextlib
+import threading
+import time
+
+
+_local = threading.local()
+
+
+class RequestTimer:
+    """The total time spent in each phase of one request."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = OrderedDict()
+
+    def add(self, name, seconds):
+        """Count time spent in a phase."""
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def total_ms(self):
+        """Return the milliseconds since the request started."""
+        return (time.perf_counter() - self.start) * 1000
+
+    def server_timing(self):
+        """Return the phases and total time as a Server-Timing value."""
+        metrics = [f'{name};dur={seconds * 1000:.2f}'
+                   for name, seconds in self.phases.items()]
+        metrics.append(f'total;dur={self.total_ms():.2f}')
+
+        return ', '.join(metrics)
+
+    def describe(self):
+        """Return the phases in a readable form for logging."""
+        return ' '.join(f'{name}={seconds * 1000:.1f}ms'
+                        for name, seconds in self.phases.items()) or '-'
+
+
+def start_request():
+    """Start timing the request this thread is handling."""
+    _local.timer = RequestTimer()
+    return _local.timer
+
+
+def finish_request():
+    """Stop timing this thread's request and return its timer.
+
+    Returns None if no request was being timed.
+    """
+    timer = getattr(_local, 'timer', None)
+    _local.timer = None
+
+    return timer
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Count the time spent in the block against a phase of the request."""
+    timer = getattr(_local, 'timer', None)
+
+    if timer is None:
+        yield
+        return
+
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - start)
@@ -0,0 +1,133 @@
+"""Traces of where the time goes for each job.
+
+Every job gets a trace id when it's submitted. Each part of handling
+the job records timestamped spans under that id: the API saving and
+queueing it, the wait in the queue, and the worker fetching data,
+rendering and storing the plot. The worker sends the trace id to the
+API in a header when it fetches data, so the API's side of that request
+is recorded too.
+
+Spans are kept in a Redis list per trace, which expires TRACE_TTL
+after its last span is added.
+"""
+
+import contextlib
+from datetime import datetime
+import json
+import re
+import time
+import uuid
+
+
+# Header the trace id is sent in between services.
+TRACE_HEADER = 'X-Trace-Id'
+
+# Seconds a trace is kept after its last span.
+TRACE_TTL = 7 * 24 * 60 * 60
+
+_TRACE_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+def new_trace_id():
+    """Return a new random trace id."""
+    return uuid.uuid4().hex
+
+
+def is_trace_id(value):
+    """Return whether a value, like a header from a client, is a trace id."""
+    return bool(value and _TRACE_ID_PATTERN.match(value))
+
+
+class Trace:
+    """Spans for a trace, collected so they can be saved in one go."""
+
+    def __init__(self, trace_id, service):
+        self.trace_id = trace_id
+        self.service = service
+        self.spans = []
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        """Record the block as a span.
+
+        The attrs dict is yielded so details can be added to the span
+        from inside the block. Exceptions are noted on the span.
+        """
+        start = time.time()
+
+        try:
+            yield attrs
+        except Exception as e:
+            attrs['error'] = type(e).__name__
+            raise
+        finally:
+            self.add_span(name, start, time.time(), **attrs)
+
+    def add_span(self, name, start, end, **attrs):
+        """Record a span with Unix timestamps for its start and end."""
+        self.spans.append(encode_span(name, self.service, start, end,
+                                      **attrs))
+
+    def save(self, redis_client):
+        """Save the collected spans, if there are any and a trace id."""
+        if self.trace_id and self.spans:
+            key = format_trace_key(self.trace_id)
+
+            pipe = redis_client.pipeline()
+
+            pipe.rpush(key, *self.spans)
+            pipe.expire(key, TRACE_TTL)
+
+            pipe.execute()
+
+        self.spans = []
+
+
+def encode_span(name, service, start, end, **attrs):
+    """Encode a span the way it's stored."""
+    span = dict(attrs, name=name, service=service, start=start, end=end)
+    return json.dumps(span, separators=(',', ':'))
+
+
+def get_spans(redis_client, trace_id):
+    """Return the spans of a trace in the order they started.
+
+    Each span has its start as an ISO 8601 time, the milliseconds from
+    the start of the first span, and its duration in milliseconds.
+    """
+    return decode_spans(redis_client.lrange(format_trace_key(trace_id), 0,
+                                            -1))
+
+
+def decode_spans(encoded_spans):
+    """Decode stored spans in the form get_spans returns them."""
+    spans = [json.loads(span.decode()) for span in encoded_spans]
+    spans.sort(key=lambda span: span['start'])
+
+    if spans:
+        trace_start = spans[0]['start']
+
+    for span in spans:
+        start = span['start']
+        end = span.pop('end')
+
+        span['start'] = datetime.utcfromtimestamp(start).isoformat()
+        span['offset_ms'] = round((start - trace_start) * 1000, 3)
+        span['duration_ms'] = round((end - start) * 1000, 3)
+
+    return spans
+
+
+def iso_to_timestamp(iso_time):
+    """Convert a UTC ISO 8601 time, like a job's, to a Unix timestamp."""
+    # isoformat leaves out the microseconds when they're zero.
+    time_format = '%Y-%m-%dT%H:%M:%S.%f' if '.' in iso_time else \
+        '%Y-%m-%dT%H:%M:%S'
+    parsed = datetime.strptime(iso_time, time_format)
+
+    return (parsed - datetime(1970, 1, 1)).total_seconds()
+
+
+def format_trace_key(trace_id):
+    """Format a trace id for redis."""
+    return f'trace.{trace_id}'
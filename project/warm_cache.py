@@ -0,0 +1,188 @@
+"""A cache of plots for popular queries, rendered ahead of time.
+
+Whenever the data of a series changes, the API queues the series to be
+warmed. An idle worker then fetches the series once, renders a plot for
+each of the WARM_QUERIES from it, and swaps the whole set in at once.
+New jobs for one of those queries are created already completed with
+the cached plot, as long as it was rendered from the current version of
+the data.
+
+The async API schedules warming through its own client, running
+SCHEDULE_SCRIPT with the keys and args from schedule_args.
+"""
+
+import json
+import os
+
+
+# Queries to keep plots of, written like line,histogram:50 for a job
+# type over all the data or over the last so many years of it.
+WARM_QUERIES = os.environ.get(
+    'WARM_QUERIES', 'line,histogram,box_plot,line:50,histogram:50,box_plot:50'
+)
+
+# Header the API sends the version of the data it returned in.
+VERSION_HEADER = 'X-Data-Version'
+
+# Series waiting to be warmed, and how long a series is left marked as
+# queued in case the worker warming it dies.
+WARM_QUEUE = 'warm-series'
+PENDING_TTL = 10 * 60
+
+# Records the latest version of a series' data, and queues the series
+# to be warmed unless it's already waiting.
+SCHEDULE_SCRIPT = """
+redis.call('SET', KEYS[1], ARGV[1])
+if redis.call('SETNX', KEYS[2], 1) == 1 then
+    redis.call('EXPIRE', KEYS[2], tonumber(ARGV[3]))
+    redis.call('LPUSH', KEYS[3], ARGV[2])
+end
+"""
+
+# Replaces all of a series' cached plots with new ones, but only if
+# they were rendered from the latest version of the data.
+_REPLACE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[2])
+for i = 2, #ARGV, 2 do
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+end
+return 1
+"""
+
+
+def parse_queries(value=WARM_QUERIES):
+    """Return the job type and number of last years (or None) of each query.
+
+    A ValueError is raised for a query that can't be parsed.
+    """
+    queries = []
+
+    for item in value.split(','):
+        if item:
+            job_type, _, years = item.partition(':')
+            queries.append((job_type, int(years) if years else None))
+
+    return queries
+
+
+def schedule(redis_client, series, version):
+    """Queue a series to be warmed after its data changed."""
+    keys, args = schedule_args(series, version)
+    redis_client.eval(SCHEDULE_SCRIPT, len(keys), *keys, *args)
+
+
+def schedule_args(series, version):
+    """Return the keys and args for SCHEDULE_SCRIPT."""
+    keys = [_format_version_key(series), _format_pending_key(series),
+            WARM_QUEUE]
+    args = [version, series, PENDING_TTL]
+
+    return keys, args
+
+
+def get_task(redis_client):
+    """Return the next series to warm, or None if there isn't one.
+
+    The series is no longer marked as queued, so any change to it from
+    here on queues it again.
+    """
+    series = redis_client.rpop(WARM_QUEUE)
+
+    if series is None:
+        return None
+
+    series = series.decode()
+    redis_client.delete(_format_pending_key(series))
+
+    return series
+
+
+def resolve_queries(data, queries=None):
+    """Return the job params and data rows of each query over a series.
+
+    The params are those a job for the same rows would be created with,
+    so the last years of the data are a range starting that many years
+    before the latest one. There are no queries over a series without
+    any rows.
+    """
+    if queries is None:
+        queries = parse_queries()
+
+    if not data:
+        return []
+
+    latest = max(row['year'] for row in data)
+    resolved = []
+
+    for job_type, years in queries:
+        params = {'job_type': job_type, 'start': None, 'end': None,
+                  'limit': None, 'offset': None}
+        rows = data
+
+        if years is not None:
+            params['start'] = latest - years + 1
+            rows = [row for row in data if row['year'] >= params['start']]
+
+        resolved.append((params, rows))
+
+    return resolved
+
+
+def replace(redis_client, series, version, plots):
+    """Swap in the plots rendered for a series from a version of its data.
+
+    The plots are (params, plot reference) pairs. Returns whether they
+    were swapped in, which they aren't if the data has changed since.
+    """
+    args = [version]
+
+    for params, ref in plots:
+        args.append(format_query_key(**params))
+        args.append(json.dumps({'ref': ref, 'version': version}))
+
+    return bool(redis_client.eval(_REPLACE_SCRIPT, 2,
+                                  _format_version_key(series),
+                                  format_warm_key(series), *args))
+
+
+def lookup(redis_client, series, version, **params):
+    """Return the reference of the cached plot for a new job's params.
+
+    The params are the job type and the data query params. Returns None
+    unless there's a plot rendered from this version of the data.
+    """
+    entry = redis_client.hget(format_warm_key(series),
+                              format_query_key(**params))
+
+    return parse_entry(entry, version)
+
+
+def parse_entry(entry, version):
+    """Return the plot reference of a cache entry if it's for a version."""
+    if entry is None:
+        return None
+
+    entry = json.loads(entry.decode())
+
+    return entry['ref'] if entry['version'] == version else None
+
+
+def format_query_key(job_type, start, end, limit, offset):
+    """Format the params of a query for its field in the cache."""
+    return f'{job_type}:{start}:{end}:{limit}:{offset}'
+
+
+def format_warm_key(series):
+    """Format a series' plot cache for redis."""
+    return f'warm.{series}'
+
+
+def _format_version_key(series):
+    return f'warm-version.{series}'
+
+
+def _format_pending_key(series):
+    return f'warm-pending.{series}'
@@ -1,151 +1,628 @@
+import contextlib
 import io
+import logging
+import multiprocessing
 import os
-import random
+import queue
+import signal
+import tempfile
+import threading
+import time
+import traceback
 
-import matplotlib.pyplot as plt
 import redis
 import requests
 
+import analysis
+import export
 import jobs
+import plot_store
+import redis_pool
+import registry
+import render
+import stats
+import tracing
+import warm_cache
 
 
-redis_client = redis.StrictRedis(host=os.environ['REDIS_HOST'],
-                                 port=os.environ['REDIS_PORT'],
-                                 db=os.environ['REDIS_DB'])
+redis_client = redis_pool.create_client()
+
+plots = plot_store.from_env(redis_client)
 
 API_BASE = f"http://{os.environ['API_HOST']}:{os.environ['API_PORT']}"
-TXT_FILE = os.path.join(os.path.dirname(__file__), 'fun_facts.txt')
 
+# Number of plots rendered at once by this worker, and how many extra
+# jobs can be claimed ahead of time while those are rendering.
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', '1'))
+WORKER_PREFETCH = int(os.environ.get('WORKER_PREFETCH', '1'))
+
+# Seconds to wait before replacing a forked worker that exited.
+RESPAWN_DELAY = 1
+
+# How many times a job is tried before it goes to the dead-letter
+# list, and the delay before the first retry in seconds, which doubles
+# with each attempt up to the maximum delay.
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '5'))
+JOB_RETRY_DELAY = float(os.environ.get('JOB_RETRY_DELAY', '1'))
+JOB_MAX_RETRY_DELAY = float(os.environ.get('JOB_MAX_RETRY_DELAY', '300'))
+
+# Seconds to wait for a new job before checking for delayed jobs again.
+POLL_INTERVAL = 1
+
+# Seconds a job can run before it's stopped and marked timed_out. The
+# default can be overridden per job type with JOB_TIMEOUTS, written
+# like line=30,fun_facts=60, over the defaults here. Exports of a large
+# series take longer than plots.
+JOB_TIMEOUT = float(os.environ.get('JOB_TIMEOUT', '60'))
+JOB_TIMEOUTS = {'export': 600.0}
+JOB_TIMEOUTS.update(
+    (job_type, float(seconds))
+    for job_type, seconds in (
+        item.split('=') for item in
+        os.environ.get('JOB_TIMEOUTS', '').split(',') if item
+    )
+)
+
+# Seconds between checks for the time limit and cancellation while a
+# plot is rendering.
+GUARD_INTERVAL = 0.25
+
+logger = logging.getLogger(__name__)
+
+# This worker's id in the registry, and the jobs it's running.
+worker_id = None
+_current_jobs = set()
+_current_jobs_lock = threading.Lock()
+
+# Set once the worker is stopping, so job loops don't claim more jobs.
+_stopping = threading.Event()
+
+
+class JobTimeout(Exception):
+    """Raised when a job runs past its time limit."""
+
+
+class JobCancelled(Exception):
+    """Raised when a job was cancelled while it was running."""
 
-def start_worker():
+
+def start_worker(boot_time=None):
     """Handle new job ids as they come in.
 
     Note that this function will block while it is still listening to
-    new job ids.
+    new job ids. The boot time is a time.monotonic() value from when
+    the process started, used to report how long startup took.
     """
+    global worker_id
+
+    pool = None
+
+    if WORKER_CONCURRENCY > 1:
+        # Warming up matplotlib before forking so every pool process
+        # starts with the fonts and backend already loaded, and forking
+        # before any threads are started.
+        render.warm_up()
+        pool = multiprocessing.Pool(WORKER_CONCURRENCY)
+
+    worker_id = registry.make_worker_id()
+    registry.register_worker(redis_client, worker_id, WORKER_CONCURRENCY)
+    _requeue_orphaned_jobs()
+
+    # Stopping goes through the finally below, which puts back the jobs
+    # this worker has claimed.
+    signal.signal(signal.SIGTERM, _stop_worker)
+
+    heartbeat_thread = threading.Thread(target=_heartbeat_loop, daemon=True)
+    heartbeat_thread.start()
+
+    if boot_time is not None:
+        logger.info('worker %s ready for its first job %.3fs after boot',
+                    worker_id, time.monotonic() - boot_time)
+
+    try:
+        if pool is not None:
+            _run_pool_worker(pool, WORKER_CONCURRENCY + WORKER_PREFETCH)
+        else:
+            _job_loop(_render_job)
+    finally:
+        _stopping.set()
+        _requeue_claimed_jobs(worker_id)
+        registry.unregister_worker(redis_client, worker_id)
+
+
+def _stop_worker(signum, frame):
+    raise SystemExit(0)
+
+
+def _requeue_orphaned_jobs():
+    """Queue the jobs claimed by workers that are gone again.
+
+    Workers that crashed or were killed never put their claimed jobs
+    back, including a worker that ran with this one's id before it.
+    """
+    live_ids = {worker_dict['id']
+                for worker_dict in registry.get_workers(redis_client)}
+
+    for claiming_id in jobs.get_claiming_workers(redis_client):
+        if claiming_id == worker_id or claiming_id not in live_ids:
+            _requeue_claimed_jobs(claiming_id)
+
+
+def _requeue_claimed_jobs(claiming_id):
+    requeued = jobs.requeue_claimed_jobs(redis_client, claiming_id)
+
+    if requeued:
+        logger.warning('queued %d jobs claimed by worker %s again',
+                       len(requeued), claiming_id)
+
+
+def _run_pool_worker(pool, num_threads):
+    """Handle jobs concurrently, rendering them in a process pool.
+
+    Each job loop thread owns at most one claimed job at a time, so
+    there are never more than concurrency + prefetch jobs claimed by
+    this worker. The extra threads fetch the data for the next jobs
+    while the pool is busy rendering.
+    """
+    errors = queue.Queue()
+
+    def create_plot(*args):
+        return pool.apply(_render_job, args)
+
+    for _ in range(num_threads):
+        thread = threading.Thread(target=_job_thread,
+                                  args=(create_plot, errors), daemon=True)
+        thread.start()
+
+    # Stop on the first error just like the single job loop would.
+    try:
+        raise errors.get()
+    finally:
+        pool.terminate()
+
+
+def start_fork_server(num_children, boot_time=None):
+    """Preload the renderer once and fork ready to go workers.
+
+    The parent imports matplotlib, reads the fun facts and warms every
+    figure template before forking, so each child shares all of that
+    copy-on-write and starts taking jobs right away. Children that exit
+    are replaced, and stopping the parent stops all of them.
+    """
+    warm_start = time.monotonic()
+    render.warm_up()
+
+    logger.info('renderer preloaded in %.3fs', time.monotonic() - warm_start)
+
+    children = set()
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(num_children):
+        children.add(_fork_worker(boot_time))
+
     while True:
-        job_id = jobs.get_new_job(redis_client)
-        _handle_job_id(job_id)
+        pid, status = os.wait()
 
+        if pid in children:
+            children.remove(pid)
+            logger.warning('worker %d exited with status %d, replacing it',
+                           pid, status)
+
+            time.sleep(RESPAWN_DELAY)
+            children.add(_fork_worker(time.monotonic()))
 
-def _handle_job_id(job_id):
-    jobs.update_status(redis_client, job_id, 'processing')
 
+def _fork_worker(boot_time):
+    pid = os.fork()
+
+    if pid:
+        return pid
+
+    # Only the parent should handle stopping everything.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    try:
+        start_worker(boot_time)
+    except SystemExit:
+        # Stopped with SIGTERM, after putting back its claimed jobs.
+        os._exit(0)
+    except BaseException:
+        traceback.print_exc()
+        os._exit(1)
+    else:
+        os._exit(0)
+
+
+def _job_thread(create_plot, errors):
+    try:
+        _job_loop(create_plot)
+    except Exception as e:
+        errors.put(e)
+
+
+def _job_loop(create_plot):
+    while not _stopping.is_set():
+        jobs.promote_delayed_jobs(redis_client)
+        job_id = jobs.get_new_job(redis_client, timeout=POLL_INTERVAL,
+                                  worker_id=worker_id)
+
+        if job_id is not None:
+            _run_job(job_id, create_plot)
+        else:
+            # Popular plots are only warmed while there are no jobs
+            # waiting.
+            series = warm_cache.get_task(redis_client)
+
+            if series is not None:
+                _warm_series(series, create_plot)
+
+
+def _heartbeat_loop():
+    while True:
+        time.sleep(registry.HEARTBEAT_INTERVAL)
+
+        try:
+            if not registry.heartbeat(redis_client, worker_id):
+                logger.warning('worker %s expired, registering again',
+                               worker_id)
+                registry.register_worker(redis_client, worker_id,
+                                         WORKER_CONCURRENCY)
+                _update_current_jobs()
+        except redis.RedisError:
+            logger.exception('heartbeat for worker %s failed', worker_id)
+
+
+def _update_current_jobs(add=None, remove=None):
+    with _current_jobs_lock:
+        if add is not None:
+            _current_jobs.add(add)
+        if remove is not None:
+            _current_jobs.discard(remove)
+
+        registry.update_current_jobs(redis_client, worker_id, _current_jobs)
+
+
+def _warm_series(series, create_plot):
+    """Render the popular plots of a series and swap them into the cache.
+
+    The plots are all rendered from one fetch of the data, and are only
+    swapped in if the data hasn't changed since. If it has, the change
+    has already queued the series to be warmed again.
+    """
+    start = time.monotonic()
+    deadline = start + JOB_TIMEOUT
+
+    try:
+        response = _request_data({'series': series, 'trace_id': None},
+                                 deadline)
+        version = response.headers[warm_cache.VERSION_HEADER]
+        data = response.json()
+        plots_by_query = []
+
+        for params, rows in warm_cache.resolve_queries(data):
+            plot = create_plot(None, deadline, rows, params['job_type'])
+            plots_by_query.append((params, plots.put(plot)))
+
+        replaced = warm_cache.replace(redis_client, series, version,
+                                      plots_by_query)
+    except Exception:
+        # A failed warm up only means jobs are rendered as usual.
+        logger.exception('warming series %s failed', series)
+        return
+
+    if replaced:
+        logger.info('warmed %d plots of series %s in %.3fs',
+                    len(plots_by_query), series, time.monotonic() - start)
+    else:
+        logger.info('series %s changed while it was warmed', series)
+
+
+def _run_job(job_id, create_plot):
+    """Handle a job, counting it in the registry once it's done.
+
+    The spans of the attempt are saved to the job's trace together at
+    the end. The job is left claimed if the worker stops part way
+    through, so it's queued again. The job has already been claimed,
+    so Redis errors in the bookkeeping around it are only logged.
+    """
+    start = time.monotonic()
+    trace = tracing.Trace(None, 'worker')
+    succeeded = False
+    attempted = False
+
+    try:
+        _update_current_jobs(add=job_id)
+    except redis.RedisError:
+        logger.exception('could not list job %s as running', job_id)
+
+    try:
+        with trace.span('attempt', worker=worker_id) as attrs:
+            succeeded = _attempt_job(job_id, create_plot, trace)
+            attrs['succeeded'] = succeeded
+
+        attempted = True
+    finally:
+        try:
+            if attempted:
+                jobs.release_job(redis_client, worker_id, job_id)
+
+            _update_current_jobs(remove=job_id)
+            registry.record_job(redis_client, worker_id, succeeded,
+                                time.monotonic() - start)
+            trace.save(redis_client)
+        except redis.RedisError:
+            logger.exception('could not record the stats of job %s', job_id)
+
+
+def _attempt_job(job_id, create_plot, trace):
+    """Handle a job, recording the error if it fails.
+
+    Transient errors like the API being unreachable are retried with
+    exponential backoff until the job runs out of attempts, and any
+    other error fails the job for good. Jobs which run out of time or
+    are cancelled are just marked as such. Returns whether the job
+    completed.
+    """
+    try:
+        _handle_job_id(job_id, create_plot, trace)
+    except JobTimeout:
+        logger.warning('job %s timed out', job_id)
+        _until_recorded(job_id, jobs.update_status, redis_client, job_id,
+                        'timed_out')
+    except JobCancelled:
+        logger.info('job %s was cancelled', job_id)
+        _until_recorded(job_id, jobs.update_status, redis_client, job_id,
+                        'cancelled')
+    except Exception as e:
+        _until_recorded(job_id, _record_failure, job_id, e)
+    else:
+        return True
+
+    return False
+
+
+def _record_failure(job_id, e):
+    """Retry a job after an error, or fail it for good."""
     job_dict = jobs.get_job(redis_client, job_id)
-    data = _get_data(job_dict)
 
-    plot = _create_plot(data, job_dict['job_type'])
-    jobs.update_plot(redis_client, job_id, plot)
+    if job_dict is None:
+        logger.error('job %s failed and no longer exists', job_id,
+                     exc_info=e)
+        return
+
+    attempts = job_dict['attempts'] + 1
+    error = f'{type(e).__name__}: {e}'
+
+    if _is_transient(e) and attempts < JOB_MAX_ATTEMPTS:
+        delay = min(JOB_RETRY_DELAY * 2 ** (attempts - 1),
+                    JOB_MAX_RETRY_DELAY)
+
+        logger.warning('job %s failed on attempt %d, retrying in %.1fs: %s',
+                       job_id, attempts, delay, error)
+        jobs.retry_job(redis_client, job_id, attempts, delay, error)
+    else:
+        logger.error('job %s failed on attempt %d', job_id, attempts,
+                     exc_info=e)
+        jobs.fail_job(redis_client, job_id, attempts, error)
+
+
+def _until_recorded(job_id, func, *args):
+    """Call a function recording a job's outcome until Redis takes it.
+
+    The job's error may have been Redis going away, in which case the
+    outcome can't be recorded either. Nothing else would pick the job
+    up again while it's left processing, so this keeps trying with
+    backoff until the job is retried, failed or marked finished.
+    """
+    delay = JOB_RETRY_DELAY
+
+    while True:
+        try:
+            return func(*args)
+        except redis.RedisError:
+            logger.exception('could not record the outcome of job %s, '
+                             'trying again in %.1fs', job_id, delay)
+            time.sleep(delay)
+            delay = min(delay * 2, JOB_MAX_RETRY_DELAY)
+
+
+def _is_transient(error):
+    """Return whether an error might go away if the job is tried again."""
+    if isinstance(error, requests.HTTPError):
+        # Only server errors could be fixed by trying again.
+        return error.response.status_code >= 500
+    else:
+        return isinstance(error, (requests.ConnectionError, requests.Timeout,
+                                  redis.ConnectionError, redis.TimeoutError))
+
+
+def _handle_job_id(job_id, create_plot, trace):
+    claimed_at = time.time()
+    job_dict = jobs.get_job(redis_client, job_id)
+    job_type = job_dict['job_type']
+
+    # The job was last updated when it was queued, either when it was
+    # submitted or when a retry was scheduled.
+    trace.trace_id = job_dict['trace_id']
+    queued_at = tracing.iso_to_timestamp(job_dict['last_updated'])
+    trace.add_span('queue', queued_at, claimed_at)
+
+    _check_cancelled(job_id)
+    jobs.update_status(redis_client, job_id, 'processing')
+
+    deadline = time.monotonic() + JOB_TIMEOUTS.get(job_type, JOB_TIMEOUT)
+
+    try:
+        _process_job(job_dict, deadline, create_plot, trace)
+    except (JobTimeout, JobCancelled):
+        raise
+    except Exception:
+        # Requests to the API only get the time the job has left, so an
+        # error once it's run out is the job timing out, not something
+        # to retry.
+        _check_deadline(deadline)
+        raise
 
     jobs.update_status(redis_client, job_id, 'completed')
 
 
-def _get_data(job_dict):
-    fields = ('start', 'end', 'limit', 'offset')
-    params = {field: job_dict.get(field) for field in fields
-              if job_dict.get(field) is not None}
-    return requests.get(f'{API_BASE}/spots', params=params).json()
+def _process_job(job_dict, deadline, create_plot, trace):
+    job_id = job_dict['id']
+    job_type = job_dict['job_type']
+
+    if job_type == 'export':
+        _export_job(job_dict, deadline, trace)
+        return
 
-def _create_plot(data, job_type):
-    # line, histogram, box_plot, fun_facts
+    with trace.span('fetch') as attrs:
+        data = _get_data(job_dict, deadline)
+        attrs['rows'] = len(data)
 
-    if job_type == 'line':
-        _create_line_graph(data)
-    elif job_type == 'fun_facts':
-        _create_fun_graph(data)
-    elif job_type == 'histogram':
-        _create_histogram(data)
-    elif job_type == 'box_plot':
-        _create_box_plot(data)
-    
-    file = io.BytesIO()
-    plt.savefig(file)
+    _check_deadline(deadline)
+    _check_cancelled(job_id)
 
-    plt.close()
+    if job_dict['output'] == 'json':
+        # Only the numbers are wanted so nothing is rendered.
+        with trace.span('stats', job_type=job_type):
+            if job_type in analysis.JOB_TYPES:
+                result = analysis.compute_analysis(data, job_type)
+            else:
+                result = stats.compute_stats(data, job_type)
 
-    return file.getvalue()
+        with trace.span('store'):
+            jobs.update_result(redis_client, job_id, result)
+    else:
+        with trace.span('render', job_type=job_type):
+            plot = create_plot(job_id, deadline, data, job_type)
 
+        with trace.span('store', bytes=len(plot)):
+            jobs.update_plot(redis_client, job_id, plot, plots)
 
-def _create_line_graph(data):
-    """Create a line graph for given range."""
 
-    spots = [row['spots'] for row in data]
-    year = [row['year'] for row in data]
+def _export_job(job_dict, deadline, trace):
+    """Write the job's rows to an export file in the plot store.
 
-    plt.plot(year, spots, color='red')
-    plt.title('Line Graph of Sunspots')
-    plt.xlabel('Year')
-    plt.ylabel('Number of Spots')
+    The rows are streamed from the API as CSV and written a chunk at a
+    time to a temporary file, so only a chunk is ever in memory.
+    """
+    job_id = job_dict['id']
+    output = job_dict['output']
 
+    with tempfile.TemporaryFile() as file:
+        with trace.span('export', output=output) as attrs:
+            response = _request_data(job_dict, deadline, stream=True,
+                                     format='csv')
 
-def _create_fun_graph(data):
-    """Create a line graph with sunspot fun facts."""
+            with response:
+                lines = _check_lines(response.iter_lines(), job_id, deadline)
+                attrs['rows'] = export.write_export(lines, file, output)
 
-    # Possible units of conversion for # of sunspots.
-    units = [{'Name': 'bakers dozens', 'Units':  1 / 13},
-             {'Name': 'dozens', 'Units': 1 / 12},
-             {'Name': 'scores', 'Units': 1 / 20},
-             {'Name': 'grosses', 'Units': 1 / 144},
-             {'Name': 'googols', 'Units': 10 ** (-100)}]
+        file.flush()
+        size = file.seek(0, io.SEEK_END)
+        file.seek(0)
 
-    random_unit = random.randint(0, 4)
-    spots = [row['spots'] for row in data]
-    year = [row['year'] for row in data]
+        with trace.span('store', bytes=size):
+            jobs.update_export(redis_client, job_id, file, plots)
+
+        jobs.update_result(redis_client, job_id,
+                           {'rows': attrs['rows'], 'bytes': size,
+                            'format': output})
+
+
+def _check_lines(lines, job_id, deadline):
+    """Pass on the data lines, checking on the job between chunks."""
+    for i, line in enumerate(lines):
+        if i % export.CHUNK_ROWS == 0:
+            _check_deadline(deadline)
+            _check_cancelled(job_id)
+
+        # The first line is the header.
+        if i and line:
+            yield line
+
+
+def _render_job(job_id, deadline, data, job_type):
+    """Render a job's plot, stopping if it's cancelled or runs too long.
+
+    This has to run on the main thread of its process since the checks
+    are made from a timer signal. Plots rendered for the warm cache
+    aren't jobs, so they have a job id of None.
+    """
+    try:
+        with _job_guard(job_id, deadline):
+            return render.render_plot(data, job_type)
+    except (JobTimeout, JobCancelled):
+        # The render was stopped part way through, so the template may
+        # have leftover artists on it.
+        render.discard_template(job_type)
+        raise
+
+
+@contextlib.contextmanager
+def _job_guard(job_id, deadline):
+    """Interrupt the block if the job is past its deadline or cancelled.
+
+    Without a job id only the deadline is checked.
+    """
+    def check(signum, frame):
+        _check_deadline(deadline)
 
-    # Create the fun fact string.
-    fun_fact = ('Did you know?\n\n' +
-                 read_fun_data() +
-                 '\n\n'
-                'The maximum number of spots during this time period' 
-                'was equal to  ' +
-                 str(max(spots) * units[random_unit]['Units']) + 
-                 ' ' + 
-                 units[random_unit]['Name'] + '.')
+        if job_id is not None:
+            _check_cancelled(job_id)
 
-    plt.plot(year, spots)
-    plt.grid(b=True)
-    plt.title('Fun Graph of Sunspots')
-    plt.xlabel('Year')
-    plt.ylabel('Number of Spots')
-    plt.axis([min(year), max(year), min(spots), max(spots)])
+    previous = signal.signal(signal.SIGALRM, check)
+    signal.setitimer(signal.ITIMER_REAL, GUARD_INTERVAL, GUARD_INTERVAL)
 
-    # Define properties of box surrounding fun fact.
-    bbox_props = dict(boxstyle="round,pad=0.3", fc="cyan", 
-                      ec="b", lw=2, alpha=0.5)
-    plt.text(year[0], max(spots) * 0.6, fun_fact, bbox=bbox_props, wrap=True)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
 
 
-def _create_histogram(data):
-    """Create a histogram for given range."""
+def _check_deadline(deadline):
+    if time.monotonic() > deadline:
+        raise JobTimeout('job ran past its time limit')
 
-    spots = [row['spots'] for row in data]
 
-    plt.hist(spots, bins=15, color='red')
-    plt.title('Histogram of Sunspots')
-    plt.xlabel('Number of Spots in a Year')
-    plt.ylabel('Frequency')
+def _check_cancelled(job_id):
+    if jobs.is_cancelled(redis_client, job_id):
+        raise JobCancelled('job was cancelled')
 
 
-def _create_box_plot(data):
-    """Create a box plot for given range."""
+def _get_data(job_dict, deadline):
+    return _request_data(job_dict, deadline).json()
 
-    spots = [row['spots'] for row in data]
 
-    plt.boxplot(spots, vert=False)
-    plt.title('Box Plot of Sunspots')
-    plt.xlabel('Number of Sunspots in One Year')
+def _request_data(job_dict, deadline, stream=False, **params):
+    # Any params given, like the format, are sent along with the job's.
+    fields = ('start', 'end', 'limit', 'offset', 'series')
+    params.update((field, job_dict[field]) for field in fields
+                  if job_dict.get(field) is not None)
 
+    # Not waiting on the API for longer than the job has left.
+    timeout = max(deadline - time.monotonic(), 0.001)
 
-def read_fun_data():
-    """Return a random fun fact from file."""
+    # Passing the trace along so the API records its side of the request.
+    headers = {}
 
-    fun_data = []
+    if job_dict['trace_id']:
+        headers[tracing.TRACE_HEADER] = job_dict['trace_id']
 
-    # Read all fun facts.
-    with open(TXT_FILE, 'r') as f:
-        for i, line in enumerate(f):
-            if i > 3:
-                fun_data.append(line)
+    response = requests.get(f'{API_BASE}/spots', params=params,
+                            headers=headers, timeout=timeout, stream=stream)
+    response.raise_for_status()
 
-    # Return a random fun fact each time.
-    return fun_data[random.randint(0, 13)]
+    return response
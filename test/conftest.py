@@ -0,0 +1,27 @@
+import os
+
+import pytest
+
+
+# The API and worker modules read where Redis and the API are when
+# they're imported. Tests give them fakeredis instead, so these are
+# never connected to.
+for name, value in (('REDIS_HOST', 'localhost'), ('REDIS_PORT', '6379'),
+                    ('REDIS_DB', '0'), ('API_HOST', 'localhost'),
+                    ('API_PORT', '5000')):
+    os.environ.setdefault(name, value)
+
+
+@pytest.fixture
+def redis_client():
+    """Return an empty fakeredis client.
+
+    Every fakeredis client shares the same data, so it's cleared for
+    each test.
+    """
+    fakeredis = pytest.importorskip('fakeredis')
+
+    client = fakeredis.FakeStrictRedis()
+    client.flushall()
+
+    return client
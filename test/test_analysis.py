@@ -0,0 +1,135 @@
+from collections import OrderedDict
+import os.path
+import shutil
+import sys
+
+import numpy as np
+import pytest
+
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
+
+
+import analysis
+import csv_parser
+
+
+@pytest.fixture
+def csv_file(tmp_path, monkeypatch):
+    # Changing a copy of the data so the real file is left alone.
+    path = str(tmp_path / 'sunspots.csv')
+    shutil.copyfile(csv_parser.CSV_FILE, path)
+
+    monkeypatch.setattr(csv_parser, 'CSV_FILE', path)
+    monkeypatch.setattr(csv_parser, 'COMPACT_THRESHOLD', 0)
+
+    return path
+
+
+def test_moving_average():
+    averages = analysis.moving_average([1, 2, 3, 4, 5], 3)
+
+    # The first points don't have enough before them.
+    assert np.isnan(averages[:2]).all()
+    assert averages[2:].tolist() == [2, 3, 4]
+
+
+def test_moving_average_short_data():
+    assert np.isnan(analysis.moving_average([1, 2], 3)).all()
+
+
+def test_smooth_tapers_the_ends():
+    smoothed = analysis.smooth([0, 0, 4, 0, 0], 3)
+
+    # The centre counts twice as much as the points either side.
+    assert smoothed[1:4].tolist() == [1, 2, 1]
+    assert np.isnan(smoothed[[0, -1]]).all()
+
+
+def test_find_peaks_keeps_the_highest_apart():
+    values = [0, 5, 0, 3, 0, 0, 0, 4, 0]
+
+    # The peak at 3 is too close to the higher one at 1.
+    assert analysis.find_peaks(values, 3).tolist() == [1, 7]
+    assert analysis.find_peaks(values, 1).tolist() == [1, 3, 7]
+
+
+def test_cycles_finds_the_period():
+    years = np.arange(1700, 1900)
+    spots = np.round(50 + 50 * np.sin(2 * np.pi * years / 10)).astype(int)
+
+    result = analysis.cycles(years, spots)
+
+    assert result['period'] == 10
+    assert result['mean_period'] == 10
+    assert len(result['maxima']) == 20
+
+
+def test_cycles_too_few_points():
+    assert analysis.cycles([1, 2, 3], [1, 2, 3]) is None
+
+
+def test_analyze_range(csv_file):
+    result = analysis.analyze(start=1800, end=1809, window=5)
+
+    assert result['years'] == list(range(1800, 1810))
+    assert result['moving_average']['window'] == 5
+    assert result['moving_average']['values'][:4] == [None] * 4
+    assert result['smoothing']['values'] == [None] * 10
+
+
+def test_analyze_memoized_until_the_data_changes(csv_file):
+    result = analysis.analyze(window=5)
+
+    assert analysis.analyze(window=5) is result
+    assert analysis.analyze(window=7) is not result
+
+    csv_parser.update_data(1770, 999)
+    changed = analysis.analyze(window=5)
+
+    assert changed is not result
+    assert changed['spots'][0] == 999
+
+
+def test_analyze_invalid_windows_throw(csv_file):
+    # A ValueError is thrown for windows which can't be used.
+    with pytest.raises(ValueError):
+        analysis.analyze(window=0)
+
+    with pytest.raises(ValueError):
+        analysis.analyze(smoothing=12)
+
+    # Nor can they be larger than the most allowed.
+    with pytest.raises(ValueError):
+        analysis.analyze(window=analysis.MAX_WINDOW + 1)
+
+    with pytest.raises(ValueError):
+        analysis.analyze(smoothing=10 ** 9 + 1)
+
+
+def test_compute_analysis(csv_file):
+    data = csv_parser.read_data()
+    result = analysis.compute_analysis(data, 'cycles')
+
+    assert set(result) == {'years', 'cycles'}
+    assert result['cycles'] == analysis.analyze()['cycles']
+
+
+def test_analyze_cache_bounded_by_size(csv_file, monkeypatch):
+    count = len(csv_parser.read_data())
+
+    # Room for the columns and one result, but not a second result.
+    monkeypatch.setattr(analysis, '_cache', OrderedDict())
+    monkeypatch.setattr(analysis, 'ANALYSIS_CACHE_MB',
+                        count * 200 / 1024 / 1024)
+
+    first = analysis.analyze(window=5)
+    second = analysis.analyze(window=7)
+
+    assert list(analysis._cache) == [
+        ('columns', csv_parser.DEFAULT_SERIES),
+        ('result', csv_parser.DEFAULT_SERIES,
+         csv_parser.read_data_version(), None, None, 7, 13)
+    ]
+    assert analysis.analyze(window=7) is second
+    assert analysis.analyze(window=5) is not first
@@ -0,0 +1,120 @@
+import os.path
+import sys
+
+import pytest
+
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
+
+
+import api
+import jobs
+import plot_store
+
+
+# Stored files are sent with their reference as the ETag.
+_ETAG = f'"{plot_store.content_ref(b"plot")}"'
+
+
+@pytest.fixture
+def client(redis_client, monkeypatch):
+    monkeypatch.setattr(api, 'redis_client', redis_client)
+    monkeypatch.setattr(api, 'plots', plot_store.RedisPlotStore(redis_client))
+
+    return api.app.test_client()
+
+
+@pytest.fixture(params=['redis', 'local'])
+def plots(request, client, redis_client, tmp_path, monkeypatch):
+    if request.param == 'local':
+        plots = plot_store.LocalPlotStore(str(tmp_path))
+    else:
+        plots = plot_store.RedisPlotStore(redis_client)
+
+    monkeypatch.setattr(api, 'plots', plots)
+
+    return plots
+
+
+def _plot_job(redis_client, plots):
+    job_id = jobs.create_job(redis_client)['id']
+    jobs.update_plot(redis_client, job_id, b'plot', plots)
+
+    return job_id
+
+
+def test_cancel_queued_job(client, redis_client):
+    job_id = jobs.create_job(redis_client)['id']
+
+    res = client.delete(f'/jobs/{job_id}')
+
+    assert res.status_code == 200
+    assert res.get_json()['status'] == 'cancelled'
+    assert redis_client.llen('new-jobs') == 0
+
+
+def test_cancel_finished_job(client, redis_client):
+    job_id = jobs.create_job(redis_client)['id']
+    jobs.update_status(redis_client, job_id, 'completed')
+
+    res = client.delete(f'/jobs/{job_id}')
+
+    assert res.status_code == 409
+    assert jobs.get_job(redis_client, job_id)['status'] == 'completed'
+
+
+def test_cancel_missing_job(client):
+    assert client.delete('/jobs/missing').status_code == 404
+
+
+def test_job_plot(client, plots, redis_client):
+    job_id = _plot_job(redis_client, plots)
+
+    res = client.get(f'/jobs/{job_id}/plot')
+
+    assert res.status_code == 200
+    assert res.data == b'plot'
+    assert res.mimetype == 'image/png'
+    assert res.headers['ETag'] == _ETAG
+    assert res.headers['Cache-Control'] == api.IMMUTABLE_CACHE_CONTROL
+    assert res.headers['Accept-Ranges'] == 'bytes'
+    assert f'filename={job_id}.png' in res.headers['Content-Disposition']
+
+
+def test_job_plot_not_modified(client, plots, redis_client):
+    job_id = _plot_job(redis_client, plots)
+    etag = client.get(f'/jobs/{job_id}/plot').headers['ETag']
+
+    res = client.get(f'/jobs/{job_id}/plot',
+                     headers={'If-None-Match': etag})
+
+    assert res.status_code == 304
+    assert res.data == b''
+
+
+def test_job_plot_range(client, plots, redis_client):
+    job_id = _plot_job(redis_client, plots)
+
+    res = client.get(f'/jobs/{job_id}/plot', headers={'Range': 'bytes=1-2'})
+
+    assert res.status_code == 206
+    assert res.data == b'lo'
+    assert res.headers['Content-Range'] == 'bytes 1-2/4'
+
+
+def test_job_plot_stored_on_redis(client, redis_client):
+    # Like a job finished before plots were moved to a plot store.
+    job_id = jobs.create_job(redis_client)['id']
+    redis_client.set(jobs.format_plot_key(job_id), b'plot')
+
+    res = client.get(f'/jobs/{job_id}/plot')
+
+    assert res.status_code == 200
+    assert res.data == b'plot'
+    assert res.headers['ETag'] == _ETAG
+
+
+def test_job_plot_not_found(client, redis_client):
+    job_id = jobs.create_job(redis_client)['id']
+
+    assert client.get(f'/jobs/{job_id}/plot').status_code == 404
@@ -0,0 +1,259 @@
+import asyncio
+import json
+import os.path
+import sys
+
+import pytest
+
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
+
+
+test_utils = pytest.importorskip('aiohttp.test_utils')
+pytest.importorskip('aioredis')
+
+
+import async_api
+import csv_parser
+import jobs
+import plot_store
+import redis_pool
+
+
+class _AsyncRedis:
+    """Makes the aioredis calls of the routes on a fakeredis client."""
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+
+    def __getattr__(self, name):
+        method = getattr(self.redis_client, name)
+
+        async def call(*args):
+            return method(*args)
+
+        return call
+
+    async def eval(self, script, keys=(), args=()):
+        return self.redis_client.eval(script, len(keys), *keys, *args)
+
+    def pipeline(self):
+        return _AsyncPipeline(self.redis_client)
+
+
+class _AsyncPipeline:
+    """Runs each call of an aioredis pipeline right away."""
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+
+    def __getattr__(self, name):
+        method = getattr(self.redis_client, name)
+
+        def call(*args):
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(method(*args))
+
+            return future
+
+        return call
+
+    async def execute(self):
+        pass
+
+
+class _Client:
+    """Sends requests to the async API from synchronous tests."""
+
+    def __init__(self, app):
+        self.loop = asyncio.new_event_loop()
+        self.client = self.loop.run_until_complete(self._start(app))
+
+    async def _start(self, app):
+        client = test_utils.TestClient(test_utils.TestServer(app))
+        await client.start_server()
+
+        return client
+
+    @property
+    def app(self):
+        return self.client.server.app
+
+    def request(self, method, path, **kwargs):
+        """Return the response and its body."""
+        async def send():
+            response = await self.client.request(method, path, **kwargs)
+            return response, await response.read()
+
+        return self.loop.run_until_complete(send())
+
+    def close(self):
+        self.loop.run_until_complete(self.client.close())
+        self.loop.close()
+
+
+@pytest.fixture
+def plot_store_dir(monkeypatch):
+    # Plots are kept in Redis unless a test sets this first.
+    monkeypatch.delenv('PLOT_STORE_DIR', raising=False)
+
+
+@pytest.fixture
+def client(plot_store_dir, redis_client, monkeypatch):
+    async def start_redis(app):
+        app['redis'] = _AsyncRedis(redis_client)
+        app['plots'] = plot_store.from_env(redis_client)
+        app['waiters'] = async_api._JobWaiters()
+
+    async def stop_redis(app):
+        pass
+
+    monkeypatch.setattr(redis_pool, 'get_client', lambda: redis_client)
+    monkeypatch.setattr(async_api, '_start_redis', start_redis)
+    monkeypatch.setattr(async_api, '_stop_redis', stop_redis)
+
+    client = _Client(async_api.make_app())
+
+    yield client
+
+    client.close()
+
+
+@pytest.fixture
+def local_plot_store_dir(plot_store_dir, tmp_path, monkeypatch):
+    monkeypatch.setenv('PLOT_STORE_DIR', str(tmp_path))
+
+
+def test_spots_index(client):
+    response, body = client.request('GET', '/spots')
+
+    assert response.status == 200
+    assert json.loads(body) == csv_parser.read_data()
+
+    # The version is sent for workers to tell what plots are from.
+    assert response.headers['X-Data-Version'] == \
+        csv_parser.read_data_version()
+
+
+def test_spots_index_range_and_offset(client):
+    _, body = client.request('GET', '/spots?start=1800&end=1809')
+
+    assert json.loads(body) == csv_parser.read_data_range(start=1800,
+                                                          end=1809)
+
+    _, body = client.request('GET', '/spots?limit=5&offset=10')
+
+    assert json.loads(body) == csv_parser.read_data_offset(limit=5,
+                                                           offset=10)
+
+
+def test_spots_index_invalid(client):
+    for query in ('start=last', 'limit=-1', 'start=1800&limit=5',
+                  'format=xml'):
+        response, _ = client.request('GET', f'/spots?{query}')
+
+        assert response.status == 400
+
+
+def test_spots_lookup(client):
+    response, body = client.request('POST', '/spots/lookup',
+                                    json={'years': [1800, 3000]})
+
+    assert response.status == 200
+    assert json.loads(body) == {
+        'rows': [csv_parser.read_data_year(1800)],
+        'missing': [3000]
+    }
+
+
+def test_spots_by_id_and_year(client):
+    _, body = client.request('GET', '/spots/30')
+
+    assert json.loads(body) == csv_parser.read_data_year(1800)
+
+    _, body = client.request('GET', '/spots/year/1800')
+
+    assert json.loads(body)['id'] == 30
+
+    response, _ = client.request('GET', '/spots/year/3000')
+
+    assert response.status == 404
+
+    response, _ = client.request('GET', '/spots/year/last')
+
+    assert response.status == 400
+
+
+def test_spots_series_not_found(client):
+    response, _ = client.request('GET', '/spots?series=missing')
+
+    assert response.status == 404
+
+
+def test_jobs_create(client, redis_client):
+    response, body = client.request('POST', '/jobs',
+                                    json={'start': 1800, 'end': 1850})
+    job_dict = json.loads(body)
+
+    assert response.status == 200
+    assert job_dict['status'] == 'submitted'
+    assert job_dict['start'] == 1800
+    assert jobs.get_job(redis_client, job_dict['id']) == job_dict
+    assert redis_client.lrange('new-jobs', 0, -1) == \
+        [job_dict['id'].encode()]
+
+    _, body = client.request('GET', f'/jobs/{job_dict["id"]}')
+
+    assert json.loads(body) == job_dict
+
+
+def test_jobs_create_invalid(client, redis_client):
+    for body in ({'start': 'first'}, {'start': 1800, 'limit': 5},
+                 {'job_type': 'pie'}, {'series': ['a']},
+                 {'series': 'missing'}):
+        response, _ = client.request('POST', '/jobs', json=body)
+
+        assert response.status == 400
+
+    assert redis_client.llen('new-jobs') == 0
+
+
+def test_job_not_found(client):
+    for path in ('/jobs/missing', '/jobs/missing/plot',
+                 '/jobs/missing/result', '/jobs/missing/trace'):
+        response, _ = client.request('GET', path)
+
+        assert response.status == 404
+
+
+def test_job_plot(client, redis_client):
+    ref = client.app['plots'].put(b'plot')
+    job_id = jobs.create_cached_job(redis_client, ref)['id']
+
+    response, body = client.request('GET', f'/jobs/{job_id}/plot')
+
+    assert response.status == 200
+    assert body == b'plot'
+    assert response.headers['ETag'] == f'"{ref}"'
+    assert 'immutable' in response.headers['Cache-Control']
+
+    response, _ = client.request('GET', f'/jobs/{job_id}/plot',
+                                 headers={'If-None-Match': f'"{ref}"'})
+
+    assert response.status == 304
+
+
+def test_job_plot_local_store(local_plot_store_dir, client, redis_client):
+    ref = client.app['plots'].put(b'plot')
+    job_id = jobs.create_cached_job(redis_client, ref)['id']
+
+    response, body = client.request('GET', f'/jobs/{job_id}/plot',
+                                    headers={'Range': 'bytes=1-2'})
+
+    assert response.status == 206
+    assert body == b'lo'
+
+    response, _ = client.request('GET', f'/jobs/{job_id}/plot',
+                                 headers={'If-None-Match': f'"{ref}"'})
+
+    assert response.status == 304
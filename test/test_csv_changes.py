@@ -0,0 +1,161 @@
+import os.path
+import shutil
+import sys
+
+import pytest
+
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
+
+
+import csv_parser
+
+
+@pytest.fixture
+def csv_file(tmp_path, monkeypatch):
+    # Changing a copy of the data so the real file is left alone.
+    path = str(tmp_path / 'sunspots.csv')
+    shutil.copyfile(csv_parser.CSV_FILE, path)
+
+    monkeypatch.setattr(csv_parser, 'CSV_FILE', path)
+    monkeypatch.setattr(csv_parser, 'COMPACT_THRESHOLD', 0)
+
+    return path
+
+
+def test_update_data_existing_year(csv_file):
+    row = csv_parser.update_data(1770, 999)
+
+    assert row == {'id': 0, 'year': 1770, 'spots': 999}
+    assert csv_parser.read_data()[0] == row
+
+
+def test_update_data_new_year(csv_file):
+    count = len(csv_parser.read_data())
+    row = csv_parser.update_data(3000, 5)
+
+    assert row == {'id': count, 'year': 3000, 'spots': 5}
+
+
+def test_delete_data(csv_file):
+    data = csv_parser.read_data()
+    row = csv_parser.delete_data(1770)
+
+    assert row == data[0]
+    assert csv_parser.read_data_year(1770) is None
+
+    # The rows after it move up an id.
+    assert csv_parser.read_data()[0] == dict(data[1], id=0)
+    assert csv_parser.delete_data(1770) is None
+
+
+def test_append_data_deleted_year(csv_file):
+    csv_parser.delete_data(1770)
+    row = csv_parser.append_data(1770, 1)
+
+    assert row['year'] == 1770
+    assert row['id'] == len(csv_parser.read_data()) - 1
+
+    with pytest.raises(ValueError):
+        csv_parser.append_data(1770, 1)
+
+
+def test_changes_seen_by_fresh_reader(csv_file):
+    csv_parser.update_data(1770, 999)
+    csv_parser.delete_data(1771)
+    data = csv_parser.read_data()
+
+    # Like another process reading the files for the first time.
+    csv_parser._cache.clear()
+
+    assert csv_parser.read_data() == data
+
+
+def test_compact(csv_file):
+    csv_parser.update_data(1770, 999)
+    csv_parser.delete_data(1771)
+    data = csv_parser.read_data()
+
+    csv_parser.compact()
+
+    assert os.path.getsize(csv_file + '.log') == 0
+    assert csv_parser.read_data() == data
+
+    with open(csv_file) as f:
+        assert f.readline() == '1770,999\n'
+
+    csv_parser._cache.clear()
+
+    assert csv_parser.read_data() == data
+
+
+def test_series_not_found(csv_file):
+    with pytest.raises(csv_parser.SeriesNotFound):
+        csv_parser.read_data('missing')
+
+    with pytest.raises(csv_parser.SeriesNotFound):
+        csv_parser.read_data('../sunspots')
+
+    assert not csv_parser.series_exists('missing')
+    assert csv_parser.series_exists(None)
+    assert csv_parser.series_exists(csv_parser.DEFAULT_SERIES)
+
+
+def test_series_are_separate(csv_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(csv_parser, 'SERIES_DIR', str(tmp_path / 'series'))
+
+    row = csv_parser.append_data(2000, 10, series='kanzelhohe')
+
+    assert row == {'id': 0, 'year': 2000, 'spots': 10}
+    assert csv_parser.read_data('kanzelhohe') == [row]
+    assert csv_parser.read_data_year(2000) is None
+
+    with pytest.raises(ValueError):
+        csv_parser.append_data(2000, 10, series='not a name')
+
+    # A trailing newline doesn't make a name valid.
+    with pytest.raises(ValueError):
+        csv_parser.append_data(2000, 10, series='kanzelhohe\n')
+
+
+def test_series_evicted(csv_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(csv_parser, 'SERIES_DIR', str(tmp_path / 'series'))
+    monkeypatch.setattr(csv_parser, 'SERIES_CACHE_MB', 0)
+
+    csv_parser.append_data(2000, 10, series='a')
+    csv_parser.append_data(2000, 20, series='b')
+    csv_parser._cache.clear()
+
+    # Only the series read last is kept with no memory to spare.
+    assert csv_parser.read_data_year(2000, series='a')['spots'] == 10
+    assert csv_parser.read_data_year(2000, series='b')['spots'] == 20
+    assert list(csv_parser._cache) == [str(tmp_path / 'series' / 'b.csv')]
+
+
+def test_compact_keeps_version(csv_file):
+    csv_parser.update_data(1770, 999)
+    version = csv_parser.read_data_version()
+
+    csv_parser.compact()
+
+    assert csv_parser.read_data_version() == version
+
+    # Like another process reading the compacted files for the first time.
+    csv_parser._cache.clear()
+
+    assert csv_parser.read_data_version() == version
+
+    csv_parser.delete_data(1771)
+
+    assert csv_parser.read_data_version() != version
+
+
+def test_replaced_file_changes_version(csv_file):
+    csv_parser.update_data(1770, 999)
+    csv_parser.compact()
+    version = csv_parser.read_data_version()
+
+    shutil.copyfile(csv_parser.CSV_FILE, csv_file + '.new')
+    os.replace(csv_file + '.new', csv_file)
+
+    assert csv_parser.read_data_version() != version
@@ -204,3 +204,25 @@ def test_read_data_offset_negative_offset_throws():
     # A ValueError is thrown when using a negative offset.
     with pytest.raises(ValueError):
         csv_parser.read_data_offset(1, -10)
+
+
+def test_read_data_years():
+    rows, missing = csv_parser.read_data_years([1790, 1770, 3000, 1790])
+
+    # Rows come back in the order asked for, without repeats.
+    assert [row['year'] for row in rows] == [1790, 1770]
+    assert rows[1]['id'] == 0
+    assert missing == [3000]
+
+
+def test_read_data_ids():
+    rows, missing = csv_parser.read_data_ids([5, -1, 0, 100])
+
+    assert [row['id'] for row in rows] == [5, 0]
+    assert missing == [-1, 100]
+
+
+def test_read_data_years_too_many_throws():
+    # A ValueError is thrown when looking up too many years at once.
+    with pytest.raises(ValueError):
+        csv_parser.read_data_years(range(csv_parser.MAX_LOOKUP_KEYS + 1))
@@ -0,0 +1,80 @@
+import gzip
+import io
+import os.path
+import sys
+
+import pytest
+
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
+
+
+import csv_parser
+import export
+import plot_store
+
+
+def _export_lines(rows):
+    # The lines a worker gets from streaming the CSV, without the header.
+    text = ''.join(export.iter_csv(rows, batch_size=7))
+    return [line.encode() for line in text.splitlines()[1:]]
+
+
+def test_iter_csv():
+    rows = csv_parser.read_data()
+    batches = list(export.iter_csv(rows, batch_size=30))
+
+    # The header comes first and the rows are split into batches.
+    assert batches[0] == export.CSV_HEADER
+    assert len(batches) == 1 + 4
+    assert batches[1].startswith('0,1770,101\n')
+    assert ''.join(batches).count('\n') == len(rows) + 1
+
+
+def test_write_export_csv():
+    rows = csv_parser.read_data()
+    file = io.BytesIO()
+
+    count = export.write_export(_export_lines(rows), file, 'csv')
+    text = gzip.decompress(file.getvalue()).decode()
+
+    assert count == len(rows)
+    assert text == ''.join(export.iter_csv(rows))
+
+
+def test_write_export_parquet(monkeypatch):
+    pq = pytest.importorskip('pyarrow.parquet')
+
+    # Writing several chunks.
+    monkeypatch.setattr(export, 'CHUNK_ROWS', 30)
+
+    rows = csv_parser.read_data()
+    file = io.BytesIO()
+
+    count = export.write_export(_export_lines(rows), file, 'parquet')
+    file.seek(0)
+    table = pq.read_table(file)
+
+    assert count == len(rows)
+    assert table.column_names == ['id', 'year', 'spots']
+    assert table.to_pylist() == rows
+
+
+def test_write_export_invalid_output_throws():
+    # A ValueError is thrown for outputs which aren't export formats.
+    with pytest.raises(ValueError):
+        export.write_export([], io.BytesIO(), 'plot')
+
+
+def test_local_plot_store_put_file(tmp_path, monkeypatch):
+    # Copying in several chunks.
+    monkeypatch.setattr(plot_store, 'CHUNK_SIZE', 10)
+
+    store = plot_store.LocalPlotStore(str(tmp_path))
+    data = b'year,spots\n' * 20
+
+    ref = store.put_file(io.BytesIO(data))
+
+    assert ref == plot_store.content_ref(data)
+    assert store.open(ref).read() == data
+    assert store.put_file(io.BytesIO(data)) == ref
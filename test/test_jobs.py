@@ -0,0 +1,169 @@
+import os.path
+import sys
+
+import msgpack
+import pytest
+
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
+
+
+import jobs
+
+
+def _save_plain_job(redis_client, **params):
+    # Saving a job the way it was before records.
+    job_dict = jobs.build_job(**params)
+    key = jobs.format_key(job_dict['id'])
+
+    redis_client.sadd('job-keys', key)
+    redis_client.hmset(key, job_dict)
+
+    return job_dict
+
+
+def test_create_job_saves_a_record(redis_client):
+    job_dict = jobs.create_job(redis_client, start=1800, job_type='histogram',
+                               output='json')
+    job_hash = redis_client.hgetall(jobs.format_key(job_dict['id']))
+
+    assert list(job_hash) == [b'record']
+    assert jobs.get_job(redis_client, job_dict['id']) == job_dict
+
+
+def test_records_are_read_by_version():
+    job_dict = jobs.build_job(start=1800)
+    record = msgpack.unpackb(jobs.encode_job(job_dict)[jobs.RECORD_FIELD],
+                             raw=False)
+
+    assert record[0] == jobs.RECORD_VERSION
+
+    # Records from before they had a version are whole job dicts.
+    unversioned = {b'record': msgpack.packb(job_dict, use_bin_type=True)}
+    newer = {b'record': msgpack.packb([jobs.RECORD_VERSION + 1],
+                                      use_bin_type=True)}
+
+    assert jobs.convert_job_hash(unversioned) == job_dict
+
+    with pytest.raises(ValueError):
+        jobs.convert_job_hash(newer)
+
+
+def test_updates_are_read_over_the_record(redis_client):
+    job_id = jobs.create_job(redis_client)['id']
+
+    jobs.update_status(redis_client, job_id, 'processing')
+    jobs.retry_job(redis_client, job_id, 2, 1, 'RuntimeError: boom')
+
+    job_dict = jobs.get_job(redis_client, job_id)
+
+    assert job_dict['status'] == 'retrying'
+    assert job_dict['attempts'] == 2
+    assert job_dict['error'] == 'RuntimeError: boom'
+
+
+def test_finishing_folds_updates_into_the_record(redis_client):
+    job_id = jobs.create_job(redis_client)['id']
+
+    jobs.update_status(redis_client, job_id, 'processing')
+    redis_client.hset(jobs.format_key(job_id), 'plot_ref', 'abc')
+    jobs._update_job_redis(redis_client, job_id, has_plot=True)
+    jobs.update_status(redis_client, job_id, 'completed')
+
+    job_hash = redis_client.hgetall(jobs.format_key(job_id))
+    job_dict = jobs.get_job(redis_client, job_id)
+
+    # Fields outside the job dict are kept as they were.
+    assert set(job_hash) == {b'record', b'plot_ref'}
+    assert job_dict['status'] == 'completed'
+    assert job_dict['has_plot']
+    assert jobs.get_plot_ref(redis_client, job_id) == 'abc'
+
+
+def test_create_cached_job(redis_client):
+    job_dict = jobs.create_cached_job(redis_client, 'abc', job_type='line')
+
+    assert jobs.get_job(redis_client, job_dict['id'])['status'] == 'completed'
+    assert jobs.get_plot_ref(redis_client, job_dict['id']) == 'abc'
+    assert redis_client.llen('new-jobs') == 0
+
+
+def test_plain_jobs_are_read_and_updated(redis_client):
+    job_dict = _save_plain_job(redis_client, limit=5)
+    job_id = job_dict['id']
+
+    assert jobs.get_job(redis_client, job_id) == job_dict
+    assert jobs.get_all_jobs(redis_client) == [job_dict]
+
+    jobs.update_status(redis_client, job_id, 'processing')
+
+    assert jobs.get_job(redis_client, job_id)['status'] == 'processing'
+
+
+def test_failing_moves_plain_jobs_to_records(redis_client):
+    job_id = _save_plain_job(redis_client)['id']
+
+    jobs.fail_job(redis_client, job_id, 5, 'RuntimeError: boom')
+
+    job_hash = redis_client.hgetall(jobs.format_key(job_id))
+    dead_jobs = jobs.get_dead_jobs(redis_client)
+
+    assert list(job_hash) == [b'record']
+    assert [job_dict['id'] for job_dict in dead_jobs] == [job_id]
+    assert dead_jobs[0]['status'] == 'failed'
+    assert dead_jobs[0]['attempts'] == 5
+    assert dead_jobs[0]['limit'] is None
+
+
+def test_claimed_jobs_are_queued_again(redis_client):
+    job_ids = [jobs.create_job(redis_client)['id'] for _ in range(3)]
+
+    claimed = [jobs.get_new_job(redis_client, worker_id='worker-1')
+               for _ in range(3)]
+
+    assert claimed == job_ids
+    assert redis_client.llen('new-jobs') == 0
+
+    # Released and finished jobs aren't queued again.
+    jobs.update_status(redis_client, job_ids[0], 'completed')
+    jobs.release_job(redis_client, 'worker-1', job_ids[1])
+    jobs.update_status(redis_client, job_ids[2], 'processing')
+
+    assert jobs.get_claiming_workers(redis_client) == ['worker-1']
+    assert jobs.requeue_claimed_jobs(redis_client, 'worker-1') == \
+        [job_ids[2]]
+    assert jobs.get_claiming_workers(redis_client) == []
+    assert jobs.get_job(redis_client, job_ids[2])['status'] == 'submitted'
+    assert jobs.get_new_job(redis_client) == job_ids[2]
+
+
+def test_requeued_jobs_are_next(redis_client):
+    first, second, third = (jobs.create_job(redis_client)['id']
+                            for _ in range(3))
+
+    jobs.get_new_job(redis_client, worker_id='worker-1')
+    jobs.get_new_job(redis_client, worker_id='worker-1')
+    jobs.requeue_claimed_jobs(redis_client, 'worker-1')
+
+    # They keep their order ahead of the jobs that were still waiting.
+    assert [jobs.get_new_job(redis_client) for _ in range(3)] == \
+        [first, second, third]
+
+
+def test_cancel_queued_job(redis_client):
+    job_id = jobs.create_job(redis_client)['id']
+    other_id = jobs.create_job(redis_client)['id']
+
+    assert jobs.cancel_job(redis_client, job_id)['status'] == 'cancelled'
+    assert not jobs.is_cancelled(redis_client, job_id)
+
+    # Only the other job is left for a worker to take.
+    assert redis_client.lrange('new-jobs', 0, -1) == [other_id.encode()]
+
+
+def test_cancel_finished_job(redis_client):
+    job_id = jobs.create_job(redis_client)['id']
+    jobs.update_status(redis_client, job_id, 'completed')
+
+    assert jobs.cancel_job(redis_client, job_id)['status'] == 'completed'
+    assert not jobs.is_cancelled(redis_client, job_id)
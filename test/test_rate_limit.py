@@ -0,0 +1,123 @@
+import os.path
+import sys
+
+import pytest
+
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
+
+
+import rate_limit
+
+
+@pytest.fixture(autouse=True)
+def rate_limits(monkeypatch):
+    # The limits are off unless they're set.
+    monkeypatch.setattr(rate_limit, 'RATE_LIMITS',
+                        {'jobs': (0.5, 10), 'default': (20, 100)})
+
+
+def test_parse_result_allowed():
+    decision = rate_limit.parse_result([1, 9, 0, 2], 'jobs')
+
+    assert decision.allowed
+    assert not decision.shed
+    assert decision.limit == 10
+    assert decision.remaining == 9
+
+    headers = rate_limit.get_headers(decision)
+
+    assert headers['X-RateLimit-Remaining'] == '9'
+    assert headers['X-RateLimit-Reset'] == '2'
+    assert 'Retry-After' not in headers
+
+
+def test_parse_result_limited():
+    decision = rate_limit.parse_result([0, 0, 2, 20], 'jobs')
+
+    assert not decision.allowed
+    assert not decision.shed
+    assert rate_limit.get_headers(decision)['Retry-After'] == '2'
+
+
+def test_parse_result_shed():
+    decision = rate_limit.parse_result([-1, 0, 0, 0], 'jobs')
+
+    assert not decision.allowed
+    assert decision.shed
+
+    # Shed requests don't use up the client's limit, so only the time to
+    # wait is sent.
+    headers = rate_limit.get_headers(decision)
+
+    assert headers == {'Retry-After': str(rate_limit.SHED_RETRY_AFTER)}
+
+
+def test_script_args_shed_depth():
+    _, args = rate_limit.script_args('127.0.0.1', 'default')
+    assert args[3] == 0
+
+    keys, args = rate_limit.script_args('127.0.0.1', 'jobs', shed=True)
+    assert keys == ['rate.jobs.127.0.0.1', 'new-jobs']
+    assert args[3] == rate_limit.SHED_QUEUE_DEPTH
+
+
+def test_check_unlimited(monkeypatch):
+    monkeypatch.setattr(rate_limit, 'RATE_LIMITS', {})
+
+    assert not rate_limit.is_checked('default')
+    assert rate_limit.check(None, '127.0.0.1', 'default') is None
+
+    # New jobs are still shed while the queue is too deep.
+    assert rate_limit.is_checked('jobs', shed=True)
+
+
+def test_check_takes_tokens(redis_client, monkeypatch):
+    monkeypatch.setattr(rate_limit, 'RATE_LIMITS', {'jobs': (0.5, 3)})
+    monkeypatch.setattr(rate_limit.time, 'time', lambda: 1000.0)
+
+    decisions = [rate_limit.check(redis_client, '127.0.0.1', 'jobs')
+                 for _ in range(4)]
+
+    assert [decision.allowed for decision in decisions] == \
+        [True, True, True, False]
+    assert [decision.remaining for decision in decisions] == [2, 1, 0, 0]
+    assert decisions[-1].retry_after == 2
+    assert decisions[-1].reset == 6
+
+    # Other clients have their own buckets.
+    assert rate_limit.check(redis_client, '127.0.0.2', 'jobs').allowed
+
+    # The bucket refills over time.
+    monkeypatch.setattr(rate_limit.time, 'time', lambda: 1002.0)
+
+    decision = rate_limit.check(redis_client, '127.0.0.1', 'jobs')
+
+    assert decision.allowed
+    assert decision.remaining == 0
+
+
+def test_check_sheds_deep_queue(redis_client, monkeypatch):
+    monkeypatch.setattr(rate_limit, 'SHED_QUEUE_DEPTH', 2)
+    redis_client.rpush('new-jobs', 'a', 'b')
+
+    decision = rate_limit.check(redis_client, '127.0.0.1', 'jobs', shed=True)
+
+    assert decision.shed
+    assert not decision.allowed
+
+    # Shed requests don't take a token.
+    assert not redis_client.exists(
+        rate_limit.format_bucket_key('127.0.0.1', 'jobs')
+    )
+
+    # Unlimited routes are only turned away while the queue is deep.
+    monkeypatch.setattr(rate_limit, 'RATE_LIMITS', {})
+
+    assert rate_limit.check(redis_client, '127.0.0.1', 'jobs',
+                            shed=True).shed
+
+    redis_client.lpop('new-jobs')
+
+    assert rate_limit.check(redis_client, '127.0.0.1', 'jobs',
+                            shed=True) is None
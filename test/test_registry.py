@@ -0,0 +1,38 @@
+import os.path
+import sys
+
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
+
+
+import registry
+
+
+def test_get_worker_host():
+    assert registry.get_worker_host('3f1c2a9b7d10-17') == '3f1c2a9b7d10'
+
+
+def test_scaling_signal_counts_replicas(redis_client):
+    # Two containers running three forked worker processes each.
+    for host in ('a1b2', 'c3d4'):
+        for pid in range(3):
+            registry.register_worker(redis_client, f'{host}-{pid}', 2)
+
+    signal = registry.scaling_signal(redis_client)
+
+    assert signal['live_workers'] == 6
+    assert signal['live_replicas'] == 2
+    assert signal['desired_replicas'] == 2
+
+
+def test_scaling_signal_divides_by_replica_slots(redis_client):
+    for pid in range(4):
+        worker_id = f'a1b2-{pid}'
+        registry.register_worker(redis_client, worker_id, 1)
+        registry.record_job(redis_client, worker_id, True, 10)
+
+    redis_client.lpush('new-jobs', *range(48))
+
+    # 48 jobs x 10s / 60s drain = 8 slots, x 1.2 headroom, over the 4
+    # slots of the one replica.
+    assert registry.scaling_signal(redis_client)['desired_replicas'] == 3
@@ -0,0 +1,37 @@
+import os.path
+import sys
+
+import pytest
+
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
+
+
+pytest.importorskip('matplotlib')
+
+
+import render
+
+
+DATA = [{'id': i, 'year': 1770 + i, 'spots': i * 7 % 50} for i in range(30)]
+
+
+@pytest.mark.parametrize('job_type', render.JOB_TYPES)
+def test_render_plot(job_type):
+    plot = render.render_plot(DATA, job_type)
+
+    assert plot.startswith(b'\x89PNG')
+
+
+@pytest.mark.parametrize('job_type', ['histogram', 'box_plot'])
+def test_reused_template_keeps_one_plot(job_type):
+    render.discard_template(job_type)
+    template = render.get_template(job_type)
+
+    for _ in range(5):
+        template.render(DATA)
+
+    # Only the last plot's artists are left on the axes.
+    assert len(template.axes.containers) <= 1
+    assert len(template.axes.patches) <= 15
+    assert len(template.axes.lines) <= 7
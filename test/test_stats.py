@@ -0,0 +1,61 @@
+import os.path
+import sys
+
+import pytest
+
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
+
+
+import csv_parser
+import stats
+
+
+def test_histogram_stats_counts():
+    data = csv_parser.read_data()
+    result = stats.compute_stats(data, 'histogram')
+
+    # Every row should land in one of the 15 bins.
+    assert len(result['counts']) == 15
+    assert len(result['edges']) == 16
+    assert sum(result['counts']) == 100
+
+
+def test_histogram_stats_edges():
+    data = csv_parser.read_data()
+    result = stats.compute_stats(data, 'histogram')
+    spots = [row['spots'] for row in data]
+
+    # The edges should cover the whole range of the data.
+    assert result['edges'][0] == min(spots)
+    assert result['edges'][-1] == max(spots)
+
+
+def test_box_plot_stats_quartiles():
+    result = stats.box_plot_stats([1, 2, 3, 4, 5])
+
+    assert result['q1'] == 2
+    assert result['median'] == 3
+    assert result['q3'] == 4
+    assert result['outliers'] == []
+
+
+def test_box_plot_stats_outliers():
+    result = stats.box_plot_stats([1, 2, 3, 4, 5, 100])
+
+    # The outlier shouldn't be reached by the upper whisker.
+    assert result['outliers'] == [100]
+    assert result['whisker_low'] == 1
+    assert result['whisker_high'] == 5
+
+
+def test_box_plot_stats_empty_throws():
+    # A ValueError is thrown when there's no data.
+    with pytest.raises(ValueError):
+        stats.box_plot_stats([])
+
+
+def test_compute_stats_invalid_job_type_throws():
+    # A ValueError is thrown for job types without statistics.
+    with pytest.raises(ValueError):
+        stats.compute_stats([], 'line')
@@ -0,0 +1,42 @@
+import os.path
+import sys
+
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
+
+
+import csv_parser
+import timing
+
+
+def test_phases_outside_request():
+    # Marking phases without a timed request shouldn't do anything.
+    with timing.phase('sort'):
+        pass
+
+    assert timing.finish_request() is None
+
+
+def test_read_data_range_phases():
+    timing.start_request()
+    csv_parser._cache.clear()
+    csv_parser.read_data_range(start=1800, end=1850)
+    timer = timing.finish_request()
+
+    assert list(timer.phases) == ['csv-parse', 'sort']
+
+    server_timing = timer.server_timing()
+
+    assert server_timing.startswith('csv-parse;dur=')
+    assert ', sort;dur=' in server_timing
+    assert ', total;dur=' in server_timing
+
+
+def test_cached_read_skips_parse():
+    csv_parser.read_data()
+
+    timing.start_request()
+    csv_parser.read_data()
+    timer = timing.finish_request()
+
+    assert 'csv-parse' not in timer.phases
@@ -0,0 +1,50 @@
+import json
+import os.path
+import sys
+
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
+
+
+import tracing
+
+
+def test_iso_to_timestamp():
+    assert tracing.iso_to_timestamp('1970-01-01T00:01:00') == 60
+    assert tracing.iso_to_timestamp('1970-01-01T00:01:00.500000') == 60.5
+
+
+def test_trace_id():
+    assert tracing.is_trace_id(tracing.new_trace_id())
+    assert not tracing.is_trace_id(None)
+    assert not tracing.is_trace_id('not-a-trace-id')
+
+
+def test_decode_spans_order():
+    encoded = [
+        tracing.encode_span('fetch', 'worker', 101.5, 101.75, rows=10),
+        tracing.encode_span('submit', 'api', 100, 100.25)
+    ]
+    spans = tracing.decode_spans(span.encode() for span in encoded)
+
+    assert [span['name'] for span in spans] == ['submit', 'fetch']
+    assert spans[0]['start'] == '1970-01-01T00:01:40'
+    assert spans[1]['offset_ms'] == 1500
+    assert spans[1]['duration_ms'] == 250
+    assert spans[1]['rows'] == 10
+    assert 'end' not in spans[1]
+
+
+def test_span_records_errors():
+    trace = tracing.Trace(tracing.new_trace_id(), 'worker')
+
+    try:
+        with trace.span('render'):
+            raise ValueError
+    except ValueError:
+        pass
+
+    span = json.loads(trace.spans[0])
+
+    assert span['name'] == 'render'
+    assert span['error'] == 'ValueError'
@@ -0,0 +1,105 @@
+import json
+import os.path
+import sys
+
+import pytest
+
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
+
+
+import csv_parser
+import warm_cache
+
+
+def test_parse_queries():
+    queries = warm_cache.parse_queries('line,histogram:50,,box_plot:10')
+
+    assert queries == [('line', None), ('histogram', 50), ('box_plot', 10)]
+
+
+def test_parse_queries_invalid_years_throws():
+    # A ValueError is thrown when the years aren't a number.
+    with pytest.raises(ValueError):
+        warm_cache.parse_queries('line:last')
+
+
+def test_resolve_queries_matches_jobs():
+    data = csv_parser.read_data()
+    resolved = warm_cache.resolve_queries(data, [('line', None),
+                                                 ('histogram', 10)])
+
+    (all_params, all_rows), (last_params, last_rows) = resolved
+
+    assert all_params == {'job_type': 'line', 'start': None, 'end': None,
+                          'limit': None, 'offset': None}
+    assert all_rows == data
+
+    # The last years are the same rows a job for the range would get.
+    assert last_params['start'] == 1860
+    assert last_rows == csv_parser.read_data_range(start=1860)
+
+
+def test_resolve_queries_no_data():
+    assert warm_cache.resolve_queries([], [('line', None)]) == []
+
+
+def test_schedule_args():
+    keys, args = warm_cache.schedule_args('sunspots', 'v1')
+
+    assert keys == ['warm-version.sunspots', 'warm-pending.sunspots',
+                    warm_cache.WARM_QUEUE]
+    assert args == ['v1', 'sunspots', warm_cache.PENDING_TTL]
+
+
+def test_parse_entry_only_for_version():
+    entry = json.dumps({'ref': 'abc', 'version': 'v1'}).encode()
+
+    assert warm_cache.parse_entry(entry, 'v1') == 'abc'
+
+    # Plots rendered from older data aren't used.
+    assert warm_cache.parse_entry(entry, 'v2') is None
+    assert warm_cache.parse_entry(None, 'v1') is None
+
+
+def test_format_query_key():
+    key = warm_cache.format_query_key(job_type='line', start=1819, end=None,
+                                      limit=None, offset=None)
+
+    assert key == 'line:1819:None:None:None'
+
+
+def test_schedule_queues_once(redis_client):
+    warm_cache.schedule(redis_client, 'sunspots', 'v1')
+    warm_cache.schedule(redis_client, 'sunspots', 'v2')
+
+    # The series is only queued once while it waits, with the latest
+    # version kept.
+    assert redis_client.llen(warm_cache.WARM_QUEUE) == 1
+    assert warm_cache.get_task(redis_client) == 'sunspots'
+    assert warm_cache.get_task(redis_client) is None
+
+    # Once it's taken, changes queue it again.
+    warm_cache.schedule(redis_client, 'sunspots', 'v3')
+
+    assert warm_cache.get_task(redis_client) == 'sunspots'
+
+
+def test_replace_only_latest_version(redis_client):
+    params = {'job_type': 'line', 'start': None, 'end': None,
+              'limit': None, 'offset': None}
+
+    warm_cache.schedule(redis_client, 'sunspots', 'v2')
+
+    # Plots rendered from older data aren't swapped in.
+    assert not warm_cache.replace(redis_client, 'sunspots', 'v1',
+                                  [(params, 'old')])
+    assert warm_cache.lookup(redis_client, 'sunspots', 'v2', **params) is None
+
+    assert warm_cache.replace(redis_client, 'sunspots', 'v2',
+                              [(params, 'abc')])
+    assert warm_cache.lookup(redis_client, 'sunspots', 'v2', **params) == 'abc'
+
+    # Each swap replaces every plot of the series.
+    assert warm_cache.replace(redis_client, 'sunspots', 'v2', [])
+    assert warm_cache.lookup(redis_client, 'sunspots', 'v2', **params) is None
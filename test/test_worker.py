@@ -0,0 +1,297 @@
+import multiprocessing.dummy
+import os
+import os.path
+import signal
+import sys
+import threading
+import time
+
+import pytest
+import redis
+import requests
+
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../project'))
+
+
+import jobs
+import plot_store
+import registry
+import render
+import warm_cache
+import worker
+
+
+ROWS = [{'id': 0, 'year': 1800, 'spots': 10},
+        {'id': 1, 'year': 1801, 'spots': 20}]
+
+
+class _Response:
+    """The parts of a requests response the worker reads for data."""
+
+    def json(self):
+        return ROWS
+
+
+class _Drained(Exception):
+    """Raised by a job loop once every job has been taken."""
+
+
+@pytest.fixture
+def worker_redis(redis_client, monkeypatch):
+    # The data is fetched from the API, which isn't running.
+    monkeypatch.setattr(worker, 'redis_client', redis_client)
+    monkeypatch.setattr(worker, 'plots',
+                        plot_store.RedisPlotStore(redis_client))
+    monkeypatch.setattr(worker, 'worker_id', 'worker-1')
+    monkeypatch.setattr(worker, '_stopping', threading.Event())
+    monkeypatch.setattr(worker, '_request_data', lambda *args, **kwargs:
+                        _Response())
+
+    return redis_client
+
+
+def _stop_when_drained(monkeypatch, stop):
+    # Job loops look for a series to warm once the queue is empty.
+    monkeypatch.setattr(warm_cache, 'get_task', lambda redis_client: stop())
+
+
+def test_job_loop_releases_jobs(worker_redis, monkeypatch):
+    job_ids = [jobs.create_job(worker_redis)['id'] for _ in range(3)]
+    _stop_when_drained(monkeypatch, worker._stopping.set)
+
+    worker._job_loop(lambda *args: b'plot')
+
+    for job_id in job_ids:
+        assert jobs.get_job(worker_redis, job_id)['status'] == 'completed'
+        assert jobs.get_plot_ref(worker_redis, job_id) == \
+            plot_store.content_ref(b'plot')
+
+    assert jobs.get_claiming_workers(worker_redis) == []
+
+
+def test_pool_worker_prefetches(worker_redis, monkeypatch):
+    job_ids = [jobs.create_job(worker_redis)['id'] for _ in range(8)]
+    claimed = []
+
+    def render_job(job_id, deadline, data, job_type):
+        claimed.append(worker_redis.llen('claimed-jobs.worker-1'))
+        return b'plot'
+
+    def stop():
+        # Threads still rendering their last job are let finish it, and
+        # the rest stop claiming jobs.
+        if all(jobs.get_job(worker_redis, job_id)['status'] == 'completed'
+               for job_id in job_ids):
+            worker._stopping.set()
+            raise _Drained()
+
+    monkeypatch.setattr(worker, '_render_job', render_job)
+    _stop_when_drained(monkeypatch, stop)
+
+    threads = set(threading.enumerate())
+
+    # Two render slots and one job prefetched for them.
+    with pytest.raises(_Drained):
+        worker._run_pool_worker(multiprocessing.dummy.Pool(2), 3)
+
+    # Waiting for the other job loops to stop so they don't take the
+    # jobs of later tests.
+    for thread in set(threading.enumerate()) - threads:
+        thread.join(5)
+
+    for job_id in job_ids:
+        assert jobs.get_job(worker_redis, job_id)['status'] == 'completed'
+
+    assert 1 <= max(claimed) <= 3
+
+
+def test_stopped_worker_requeues_claimed_jobs(worker_redis, monkeypatch):
+    job_ids = [jobs.create_job(worker_redis)['id'] for _ in range(3)]
+
+    def job_loop(create_plot):
+        # Claiming two jobs and being stopped part way through them.
+        for _ in range(2):
+            job_id = jobs.get_new_job(worker_redis, worker_id=worker.worker_id)
+            jobs.update_status(worker_redis, job_id, 'processing')
+
+        os.kill(os.getpid(), signal.SIGTERM)
+        threading.Event().wait(5)
+
+    monkeypatch.setattr(worker, '_job_loop', job_loop)
+    monkeypatch.setattr(registry, 'make_worker_id', lambda: 'worker-1')
+    monkeypatch.setattr(worker, '_heartbeat_loop', lambda: None)
+
+    previous = signal.getsignal(signal.SIGTERM)
+
+    try:
+        with pytest.raises(SystemExit):
+            worker.start_worker()
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+    assert [jobs.get_new_job(worker_redis) for _ in range(3)] == job_ids
+    assert jobs.get_job(worker_redis, job_ids[0])['status'] == 'submitted'
+    assert registry.get_workers(worker_redis) == []
+
+
+def test_start_worker_requeues_orphaned_jobs(worker_redis, monkeypatch):
+    job_id = jobs.create_job(worker_redis)['id']
+    jobs.get_new_job(worker_redis, worker_id='gone-1')
+    claims = []
+
+    def job_loop(create_plot):
+        claims.append(jobs.get_new_job(worker_redis, timeout=1))
+        raise _Drained()
+
+    monkeypatch.setattr(worker, '_job_loop', job_loop)
+    monkeypatch.setattr(registry, 'make_worker_id', lambda: 'worker-1')
+    monkeypatch.setattr(worker, '_heartbeat_loop', lambda: None)
+
+    previous = signal.getsignal(signal.SIGTERM)
+
+    try:
+        with pytest.raises(_Drained):
+            worker.start_worker()
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+    assert claims == [job_id]
+
+
+def test_run_job_survives_registry_errors(worker_redis, monkeypatch):
+    job_id = jobs.create_job(worker_redis)['id']
+    jobs.get_new_job(worker_redis, worker_id=worker.worker_id)
+
+    def update_current_jobs(*args):
+        raise redis.ConnectionError('registry is down')
+
+    monkeypatch.setattr(registry, 'update_current_jobs', update_current_jobs)
+
+    worker._run_job(job_id, lambda *args: b'plot')
+
+    assert jobs.get_job(worker_redis, job_id)['status'] == 'completed'
+
+
+def _fail_with(error):
+    def create_plot(*args):
+        raise error
+
+    return create_plot
+
+
+def _run_next_job(create_plot):
+    job_id = jobs.get_new_job(worker.redis_client, worker_id=worker.worker_id)
+    worker._run_job(job_id, create_plot)
+
+    return job_id
+
+
+def test_transient_failure_is_retried_with_backoff(worker_redis,
+                                                   monkeypatch):
+    monkeypatch.setattr(worker, 'JOB_RETRY_DELAY', 10)
+    job_id = jobs.create_job(worker_redis)['id']
+    create_plot = _fail_with(requests.ConnectionError('api is down'))
+
+    _run_next_job(create_plot)
+
+    job_dict = jobs.get_job(worker_redis, job_id)
+    assert job_dict['status'] == 'retrying'
+    assert job_dict['attempts'] == 1
+    assert job_dict['error'] == 'ConnectionError: api is down'
+    assert worker_redis.llen('new-jobs') == 0
+    assert worker_redis.zscore('delayed-jobs', job_id) == \
+        pytest.approx(time.time() + 10, abs=1)
+
+    # Nothing is queued until the retry time has come.
+    assert jobs.promote_delayed_jobs(worker_redis) == 0
+
+    now = time.time()
+
+    with monkeypatch.context() as m:
+        m.setattr(time, 'time', lambda: now + 11)
+
+        assert jobs.promote_delayed_jobs(worker_redis) == 1
+
+    # The delay doubles with each attempt.
+    _run_next_job(create_plot)
+
+    assert jobs.get_job(worker_redis, job_id)['attempts'] == 2
+    assert worker_redis.zscore('delayed-jobs', job_id) == \
+        pytest.approx(time.time() + 20, abs=1)
+
+
+def test_permanent_failure_is_dead_lettered(worker_redis):
+    job_id = jobs.create_job(worker_redis)['id']
+
+    _run_next_job(_fail_with(ValueError('bad data')))
+
+    job_dict = jobs.get_job(worker_redis, job_id)
+    assert job_dict['status'] == 'failed'
+    assert job_dict['attempts'] == 1
+    assert job_dict['error'] == 'ValueError: bad data'
+    assert worker_redis.zcard('delayed-jobs') == 0
+    assert [job['id'] for job in jobs.get_dead_jobs(worker_redis)] == \
+        [job_id]
+
+
+def test_replayed_job_runs_again(worker_redis):
+    job_id = jobs.create_job(worker_redis)['id']
+    _run_next_job(_fail_with(ValueError('bad data')))
+
+    job_dict = jobs.replay_job(worker_redis, job_id)
+
+    assert job_dict['status'] == 'submitted'
+    assert job_dict['attempts'] == 0
+    assert job_dict['error'] is None
+    assert jobs.get_dead_jobs(worker_redis) == []
+
+    assert _run_next_job(lambda *args: b'plot') == job_id
+    assert jobs.get_job(worker_redis, job_id)['status'] == 'completed'
+
+
+def _render_until_stopped(monkeypatch, before=lambda: None):
+    # Rendering takes far longer than the job has unless the guard stops
+    # it.
+    def render_plot(data, job_type):
+        before()
+        time.sleep(5)
+
+    monkeypatch.setattr(worker, 'GUARD_INTERVAL', 0.01)
+    monkeypatch.setattr(render, 'render_plot', render_plot)
+
+
+def test_cancel_running_job(worker_redis, monkeypatch):
+    job_id = jobs.create_job(worker_redis)['id']
+    _render_until_stopped(
+        monkeypatch, lambda: jobs.cancel_job(worker_redis, job_id)
+    )
+
+    _run_next_job(worker._render_job)
+
+    assert jobs.get_job(worker_redis, job_id)['status'] == 'cancelled'
+
+
+def test_job_over_its_timeout(worker_redis, monkeypatch):
+    job_id = jobs.create_job(worker_redis)['id']
+    monkeypatch.setitem(worker.JOB_TIMEOUTS, 'line', 0.05)
+    _render_until_stopped(monkeypatch)
+
+    _run_next_job(worker._render_job)
+
+    assert jobs.get_job(worker_redis, job_id)['status'] == 'timed_out'
+
+
+def test_guard_without_job_id_only_checks_deadline(monkeypatch):
+    def is_cancelled(redis_client, job_id):
+        raise AssertionError('cancellation checked without a job')
+
+    monkeypatch.setattr(worker, 'GUARD_INTERVAL', 0.01)
+    monkeypatch.setattr(jobs, 'is_cancelled', is_cancelled)
+
+    with worker._job_guard(None, time.monotonic() + 5):
+        time.sleep(0.05)
+
+    with pytest.raises(worker.JobTimeout):
+        with worker._job_guard(None, time.monotonic() + 0.02):
+            time.sleep(5)